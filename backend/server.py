@@ -1,12 +1,15 @@
-from fastapi import FastAPI, APIRouter
+from fastapi import FastAPI, APIRouter, HTTPException, Query, Response
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import DESCENDING, UpdateOne
+import asyncio
+import base64
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict
-from typing import List
+from typing import List, Optional
 import uuid
 from datetime import datetime, timezone
 
@@ -16,9 +19,76 @@ load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+# tz_aware: timestamps come back as UTC datetimes, like the ones we store
+client = AsyncIOMotorClient(mongo_url, tz_aware=True)
 db = client[os.environ['DB_NAME']]
 
+STATUS_PAGE_SIZE = int(os.environ.get('STATUS_PAGE_SIZE', '100'))
+STATUS_BULK_LIMIT = int(os.environ.get('STATUS_BULK_LIMIT', '1000'))
+
+
+class WriteBuffer:
+    """Batches inserts into one collection into insert_many calls.
+
+    Documents are written once `max_batch` are queued or `flush_interval`
+    seconds after the first one arrived. Each caller waits for the batch
+    holding its documents, so concurrent requests share a round trip and a
+    successful response still means the documents are stored.
+    """
+
+    def __init__(self, collection, max_batch=500, flush_interval=0.02):
+        self.collection = collection
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self._docs = []
+        self._waiters = []
+        self._timer = None
+        self._writes = set()
+
+    async def add(self, docs):
+        future = asyncio.get_running_loop().create_future()
+        self._docs.extend(docs)
+        self._waiters.append(future)
+        if len(self._docs) >= self.max_batch:
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.flush_interval, self.flush)
+        # A client going away doesn't take its documents out of the batch
+        await asyncio.shield(future)
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._docs:
+            return
+        docs, waiters = self._docs, self._waiters
+        self._docs, self._waiters = [], []
+        write = asyncio.ensure_future(self._write(docs, waiters))
+        self._writes.add(write)
+        write.add_done_callback(self._writes.discard)
+
+    async def _write(self, docs, waiters):
+        try:
+            await self.collection.insert_many(docs, ordered=False)
+        except Exception as e:
+            for waiter in waiters:
+                waiter.set_exception(e)
+            return
+        for waiter in waiters:
+            waiter.set_result(None)
+
+    async def close(self):
+        self.flush()
+        await asyncio.gather(*self._writes, return_exceptions=True)
+
+
+status_buffer = WriteBuffer(
+    db.status_checks,
+    max_batch=int(os.environ.get('STATUS_BUFFER_SIZE', '500')),
+    flush_interval=float(os.environ.get('STATUS_FLUSH_MS', '20')) / 1000,
+)
+
 # Create the main app without a prefix
 app = FastAPI()
 
@@ -42,28 +112,65 @@ class StatusCheckCreate(BaseModel):
 async def root():
     return {"message": "Hello World"}
 
+def encode_cursor(check):
+    value = f"{check['timestamp'].isoformat()}|{check['id']}"
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        timestamp, _, check_id = base64.urlsafe_b64decode(cursor.encode()).decode().partition('|')
+        return datetime.fromisoformat(timestamp), check_id
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
 @api_router.post("/status", response_model=StatusCheck)
 async def create_status_check(input: StatusCheckCreate):
     status_dict = input.model_dump()
     status_obj = StatusCheck(**status_dict)
     
-    # Convert to dict and serialize datetime to ISO string for MongoDB
-    doc = status_obj.model_dump()
-    doc['timestamp'] = doc['timestamp'].isoformat()
-    
-    _ = await db.status_checks.insert_one(doc)
+    # Timestamps are stored as BSON dates so they can be indexed and ranged on
+    await status_buffer.add([status_obj.model_dump()])
     return status_obj
 
+@api_router.post("/status/bulk", response_model=List[StatusCheck])
+async def create_status_checks(inputs: List[StatusCheckCreate]):
+    if len(inputs) > STATUS_BULK_LIMIT:
+        raise HTTPException(status_code=400, detail=f"At most {STATUS_BULK_LIMIT} status checks per request")
+    status_objs = [StatusCheck(**input.model_dump()) for input in inputs]
+    await status_buffer.add([status_obj.model_dump() for status_obj in status_objs])
+    return status_objs
+
 @api_router.get("/status", response_model=List[StatusCheck])
-async def get_status_checks():
-    # Exclude MongoDB's _id field from the query results
-    status_checks = await db.status_checks.find({}, {"_id": 0}).to_list(1000)
+async def get_status_checks(
+    response: Response,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(default=STATUS_PAGE_SIZE, ge=1, le=1000),
+):
+    # Newest first, walked with a (timestamp, id) cursor on the timestamp index;
+    # the next page's cursor is returned in X-Next-Cursor
+    query = {}
+    if since or until:
+        query['timestamp'] = {}
+        if since:
+            query['timestamp']['$gte'] = since
+        if until:
+            query['timestamp']['$lt'] = until
+    if cursor:
+        timestamp, check_id = decode_cursor(cursor)
+        query['$or'] = [
+            {'timestamp': {'$lt': timestamp}},
+            {'timestamp': timestamp, 'id': {'$lt': check_id}},
+        ]
     
-    # Convert ISO string timestamps back to datetime objects
-    for check in status_checks:
-        if isinstance(check['timestamp'], str):
-            check['timestamp'] = datetime.fromisoformat(check['timestamp'])
+    # Exclude MongoDB's _id field from the query results
+    status_checks = await db.status_checks.find(query, {"_id": 0}).sort(
+        [('timestamp', DESCENDING), ('id', DESCENDING)]
+    ).to_list(limit)
     
+    if len(status_checks) == limit:
+        response.headers['X-Next-Cursor'] = encode_cursor(status_checks[-1])
     return status_checks
 
 # Include the router in the main app
@@ -84,6 +191,26 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+async def migrate_status_timestamps(batch_size=1000):
+    # Older documents stored the timestamp as an ISO string
+    while True:
+        docs = await db.status_checks.find(
+            {'timestamp': {'$type': 'string'}}, {'_id': 1, 'timestamp': 1}
+        ).to_list(batch_size)
+        if not docs:
+            return
+        await db.status_checks.bulk_write([
+            UpdateOne({'_id': doc['_id']}, {'$set': {'timestamp': datetime.fromisoformat(doc['timestamp'])}})
+            for doc in docs
+        ], ordered=False)
+        logger.info("Converted %d status check timestamps", len(docs))
+
+@app.on_event("startup")
+async def prepare_status_checks():
+    await migrate_status_timestamps()
+    await db.status_checks.create_index([('timestamp', DESCENDING), ('id', DESCENDING)])
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await status_buffer.close()
     client.close()
\ No newline at end of file
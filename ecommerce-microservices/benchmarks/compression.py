@@ -0,0 +1,98 @@
+"""Bytes saved vs CPU spent when compressing catalog and order payloads.
+
+Serializes a product listing page and an order history the way the services
+do (FastJSONResponse), then compresses each body with gzip and brotli at a
+few levels using the middleware's Compressor.
+
+    python benchmarks/compression.py [page_size] [iterations]
+"""
+import importlib
+import os
+import sys
+import time
+import types
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+SERVICES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "services")
+LEVELS = {"gzip": (1, 5, 6, 9), "br": (1, 4, 5, 9, 11)}
+
+
+def load_product_service():
+    package = types.ModuleType("product_service")
+    package.__path__ = [os.path.join(SERVICES_DIR, "product-service", "app")]
+    sys.modules["product_service"] = package
+    return importlib.import_module("product_service.main"), importlib.import_module("product_service.compression")
+
+
+def make_products(count):
+    now = datetime(2024, 1, 1, 12, 0, 0)
+    return [{
+        "id": i + 1,
+        "name": f"Product {i + 1}",
+        "description": "Industry Leading Noise Cancelling Wireless Headphones, 30h battery",
+        "price": Decimal("29999.00") + i,
+        "original_price": Decimal("34999.00") + i,
+        "category": "Electronics",
+        "brand": "Sony",
+        "image_url": f"https://images.unsplash.com/photo-{1618366712010 + i}?w=500",
+        "stock": 100 + i,
+        "rating": Decimal("4.7"),
+        "reviews_count": 5621 + i,
+        "is_featured": i % 3 == 0,
+        "discount_percent": 14,
+        "created_at": now - timedelta(minutes=i),
+    } for i in range(count)]
+
+
+def make_orders(count):
+    now = datetime(2024, 1, 1, 12, 0, 0)
+    return [{
+        "id": f"3f2b8c1e-5d4a-4e7b-9c1d-{i:012d}",
+        "user_id": 42,
+        "items": [
+            {"product_id": j + 1, "name": f"Product {j + 1}", "price": 29999.0 + j, "quantity": 1 + j % 3}
+            for j in range(4)
+        ],
+        "subtotal": Decimal("125996.00"),
+        "shipping": Decimal("0.00"),
+        "tax": Decimal("22679.28"),
+        "total": Decimal("148675.28"),
+        "status": "delivered" if i % 4 else "pending",
+        "shipping_address": "221B Baker Street, London",
+        "payment_method": "card",
+        "created_at": now - timedelta(days=i),
+        "updated_at": now - timedelta(days=i),
+    } for i in range(count)]
+
+
+def measure(compression, encoding, level, body, iterations):
+    start = time.process_time()
+    for _ in range(iterations):
+        out = compression.Compressor(encoding, level).compress(body, final=True)
+    return len(out), (time.process_time() - start) / iterations * 1e6
+
+
+def main():
+    page_size = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    service, compression = load_product_service()
+    payloads = {
+        f"GET /products ({page_size} rows)": {"products": make_products(page_size), "total": 1000, "limit": page_size, "offset": 0},
+        f"GET /orders ({page_size} orders)": make_orders(page_size),
+    }
+    encodings = ["gzip"] + (["br"] if compression.brotli is not None else [])
+
+    for label, content in payloads.items():
+        body = service.FastJSONResponse(content).body
+        print(f"{label}: {len(body)} bytes uncompressed")
+        for encoding in encodings:
+            for level in LEVELS[encoding]:
+                size, cpu = measure(compression, encoding, level, body, iterations)
+                saved = len(body) - size
+                print(f"  {encoding:4} level {level:2}: {size:7} bytes ({size / len(body):5.1%})"
+                      f"  {cpu:8.1f} us CPU  {saved / cpu:7.1f} bytes saved/us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Per-page CPU cost of serializing a product listing.
+
+Compares the previous response path (RealDictRow -> dict -> jsonable_encoder ->
+json.dumps, what FastAPI does for a plain return value) with returning
+FastJSONResponse directly (rows encoded by orjson, Decimal/datetime handled
+natively).
+
+    python benchmarks/json_serialization.py [page_size] [iterations]
+"""
+import importlib
+import json
+import os
+import sys
+import time
+import types
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from fastapi.encoders import jsonable_encoder
+from psycopg2.extras import RealDictRow
+
+SERVICES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "services")
+
+
+def load_product_service():
+    package = types.ModuleType("product_service")
+    package.__path__ = [os.path.join(SERVICES_DIR, "product-service", "app")]
+    sys.modules["product_service"] = package
+    return importlib.import_module("product_service.main")
+
+
+def make_rows(count):
+    now = datetime(2024, 1, 1, 12, 0, 0)
+    rows = []
+    for i in range(count):
+        rows.append(RealDictRow(
+            id=i + 1,
+            name=f"Product {i + 1}",
+            description="Industry Leading Noise Cancelling Wireless Headphones, 30h battery",
+            price=Decimal("29999.00") + i,
+            original_price=Decimal("34999.00") + i,
+            category="Electronics",
+            brand="Sony",
+            image_url=f"https://images.unsplash.com/photo-{1618366712010 + i}?w=500",
+            stock=100 + i,
+            rating=Decimal("4.7"),
+            reviews_count=5621 + i,
+            is_featured=i % 3 == 0,
+            discount_percent=14,
+            created_at=now - timedelta(minutes=i),
+        ))
+    return rows
+
+
+def previous_path(rows):
+    content = jsonable_encoder({"products": [dict(p) for p in rows], "total": 1000, "limit": len(rows), "offset": 0})
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+def fast_path(response_class, rows):
+    return response_class({"products": rows, "total": 1000, "limit": len(rows), "offset": 0}).body
+
+
+def measure(fn, iterations):
+    fn()
+    start = time.process_time()
+    for _ in range(iterations):
+        fn()
+    return (time.process_time() - start) / iterations * 1e6
+
+
+def main():
+    page_size = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    service = load_product_service()
+    rows = make_rows(page_size)
+
+    assert json.loads(previous_path(rows)) == json.loads(fast_path(service.FastJSONResponse, rows))
+
+    before = measure(lambda: previous_path(rows), iterations)
+    after = measure(lambda: fast_path(service.FastJSONResponse, rows), iterations)
+    print(f"{page_size} products/page, {iterations} iterations")
+    print(f"  jsonable_encoder + json.dumps: {before:9.1f} us CPU/page")
+    print(f"  FastJSONResponse (orjson):     {after:9.1f} us CPU/page")
+    print(f"  speedup:                       {before / after:9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
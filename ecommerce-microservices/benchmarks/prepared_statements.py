@@ -0,0 +1,137 @@
+"""Per-call latency of the hot reads: prepared and pooled vs. how they ran before.
+
+Runs each service's hot statements against a database the services have
+already initialized (DB_* settings as for the services), three ways:
+
+- connect: a new connection per call and the plain query, as every request
+  did before the pool
+- pooled: one reused connection, plain query (parsed and planned every call)
+- prepared: one reused connection, EXECUTE of the prepared statement
+
+    DB_HOST=localhost DB_NAME=ecommerce python benchmarks/prepared_statements.py [iterations]
+"""
+import importlib
+import os
+import re
+import statistics
+import sys
+import time
+import types
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+SERVICES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "services")
+
+
+def load_service(name):
+    package_name = name.replace("-", "_")
+    package = types.ModuleType(package_name)
+    package.__path__ = [os.path.join(SERVICES_DIR, name, "app")]
+    sys.modules[package_name] = package
+    return importlib.import_module(f"{package_name}.main"), importlib.import_module(f"{package_name}.pool")
+
+
+def connect(pool):
+    return psycopg2.connect(
+        host=os.environ.get("DB_HOST", "localhost"),
+        port=os.environ.get("DB_PORT", "5432"),
+        database=os.environ.get("DB_NAME", "ecommerce"),
+        user=os.environ.get("DB_USER", "postgres"),
+        password=os.environ.get("DB_PASSWORD", "postgres123"),
+        connection_factory=pool.PooledConnection,
+        cursor_factory=RealDictCursor,
+    )
+
+
+def plain_sql(statement):
+    # The same statement with client-side parameters, as cur.execute() sends it
+    return re.sub(r"\$\d+", "%s", statement.sql)
+
+
+def sample_params(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT id FROM products ORDER BY id LIMIT 20")
+    product_ids = [row["id"] for row in cur.fetchall()]
+    cur.execute("SELECT order_id, user_id FROM orders ORDER BY created_at DESC LIMIT 1")
+    order = cur.fetchone() or {"order_id": "ORD-NONE", "user_id": 1}
+    cur.execute("SELECT payment_id FROM payments WHERE user_id = %s LIMIT 1", (order["user_id"],))
+    payment = cur.fetchone() or {"payment_id": "PAY-NONE"}
+    cur.close()
+    conn.rollback()
+    return product_ids, order, payment
+
+
+def time_calls(run, iterations):
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        run()
+        timings.append((time.perf_counter() - start) * 1e6)
+    timings.sort()
+    return statistics.mean(timings), timings[len(timings) // 2], timings[int(len(timings) * 0.99) - 1]
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    product, pool = load_service("product-service")
+    cart, _ = load_service("cart-service")
+    order, _ = load_service("order-service")
+    payment, _ = load_service("payment-service")
+    user, _ = load_service("user-service")
+
+    conn = connect(pool)
+    product_ids, sample_order, sample_payment = sample_params(conn)
+    user_id = sample_order["user_id"]
+    cases = [
+        (product.PRODUCT_BY_ID, (product_ids[0],)),
+        (product.PRODUCTS_BY_IDS, (product_ids,)),
+        (product.FEATURED_PRODUCTS, ()),
+        (cart.CART_ROWS, (user_id,)),
+        (order.USER_ORDERS, (user_id,)),
+        (order.ORDER_BY_ID, (sample_order["order_id"], user_id)),
+        (payment.PAYMENT_BY_ID, (sample_payment["payment_id"], user_id)),
+        (payment.USER_PAYMENTS, (user_id,)),
+        (user.USER_PROFILE, (user_id,)),
+    ]
+
+    def per_connection(sql, params):
+        fresh = connect(pool)
+        cur = fresh.cursor()
+        cur.execute(sql, params)
+        cur.fetchall()
+        cur.close()
+        fresh.close()
+
+    def pooled(sql, params):
+        cur = conn.cursor()
+        cur.execute(sql, params)
+        cur.fetchall()
+        cur.close()
+        conn.commit()
+
+    def prepared(statement, params):
+        cur = conn.cursor()
+        pool.execute_prepared(cur, statement, params)
+        cur.fetchall()
+        cur.close()
+        conn.commit()
+
+    print(f"{iterations} calls each (connect: {max(iterations // 10, 1)}); mean / p50 / p99 in us")
+    for statement, params in cases:
+        sql = plain_sql(statement)
+        results = {
+            "connect": time_calls(lambda: per_connection(sql, params), max(iterations // 10, 1)),
+            "pooled": time_calls(lambda: pooled(sql, params), iterations),
+            "prepared": time_calls(lambda: prepared(statement, params), iterations),
+        }
+        print(statement.name)
+        for mode, (mean, p50, p99) in results.items():
+            print(f"  {mode:8} {mean:9.1f} {p50:9.1f} {p99:9.1f}")
+        speedup = results["pooled"][0] / results["prepared"][0]
+        print(f"  prepared vs pooled: {speedup:.2f}x, vs connect: {results['connect'][0] / results['prepared'][0]:.1f}x")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
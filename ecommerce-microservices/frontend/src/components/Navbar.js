@@ -1,8 +1,9 @@
-import React, { useState } from 'react';
+import React, { useState, useEffect } from 'react';
 import { Link, useNavigate } from 'react-router-dom';
 import { ShoppingCart, User, Search, Menu, X, Package, LogOut, Heart } from 'lucide-react';
 import { useAuth } from '../context/AuthContext';
 import { useCart } from '../context/CartContext';
+import api from '../utils/api';
 
 const Navbar = () => {
   const { isAuthenticated, user, logout } = useAuth();
@@ -11,6 +12,30 @@ const Navbar = () => {
   const [isMenuOpen, setIsMenuOpen] = useState(false);
   const [showUserMenu, setShowUserMenu] = useState(false);
   const [searchQuery, setSearchQuery] = useState('');
+  const [suggestions, setSuggestions] = useState([]);
+
+  // Typeahead: the autocomplete endpoint answers from memory, so a short
+  // debounce is enough; stale responses are dropped
+  useEffect(() => {
+    const query = searchQuery.trim();
+    if (!query) {
+      setSuggestions([]);
+      return undefined;
+    }
+    let cancelled = false;
+    const timer = setTimeout(async () => {
+      try {
+        const response = await api.get('/api/products/products/autocomplete', { params: { q: query, limit: 8 } });
+        if (!cancelled) setSuggestions(response.data.suggestions);
+      } catch (error) {
+        if (!cancelled) setSuggestions([]);
+      }
+    }, 80);
+    return () => {
+      cancelled = true;
+      clearTimeout(timer);
+    };
+  }, [searchQuery]);
 
   const handleSearch = (e) => {
     e.preventDefault();
@@ -20,6 +45,17 @@ const Navbar = () => {
     }
   };
 
+  const handleSuggestion = (suggestion) => {
+    if (suggestion.type === 'product') {
+      navigate(`/products/${suggestion.id}`);
+    } else if (suggestion.type === 'category') {
+      navigate(`/products?category=${encodeURIComponent(suggestion.name)}`);
+    } else {
+      navigate(`/products?search=${encodeURIComponent(suggestion.name)}`);
+    }
+    setSearchQuery('');
+  };
+
   const handleLogout = () => {
     logout();
     navigate('/');
@@ -100,6 +136,7 @@ const Navbar = () => {
               placeholder="Search products, brands..."
               value={searchQuery}
               onChange={(e) => setSearchQuery(e.target.value)}
+              onBlur={() => setSuggestions([])}
               style={{
                 width: '100%',
                 padding: '14px 20px 14px 48px',
@@ -111,6 +148,50 @@ const Navbar = () => {
                 transition: 'all 0.3s ease',
               }}
             />
+            {suggestions.length > 0 && (
+              <div style={{
+                position: 'absolute',
+                top: '100%',
+                left: 0,
+                right: 0,
+                marginTop: '8px',
+                background: 'var(--bg-card)',
+                border: '1px solid var(--border-color)',
+                borderRadius: '12px',
+                overflow: 'hidden',
+                boxShadow: 'var(--shadow-lg)',
+              }}>
+                {suggestions.map((suggestion) => (
+                  <button
+                    key={`${suggestion.type}-${suggestion.id || suggestion.name}`}
+                    type="button"
+                    onMouseDown={(e) => e.preventDefault()}
+                    onClick={() => handleSuggestion(suggestion)}
+                    style={{
+                      width: '100%',
+                      display: 'flex',
+                      alignItems: 'center',
+                      justifyContent: 'space-between',
+                      gap: '12px',
+                      padding: '10px 16px',
+                      border: 'none',
+                      background: 'transparent',
+                      color: 'var(--text-primary)',
+                      cursor: 'pointer',
+                      fontSize: '14px',
+                      textAlign: 'left',
+                    }}
+                    onMouseEnter={(e) => e.currentTarget.style.background = 'var(--bg-hover)'}
+                    onMouseLeave={(e) => e.currentTarget.style.background = 'transparent'}
+                  >
+                    <span>{suggestion.name}</span>
+                    <span style={{ fontSize: '12px', color: 'var(--text-muted)' }}>
+                      {suggestion.type === 'product' ? suggestion.category : `${suggestion.type} · ${suggestion.count}`}
+                    </span>
+                  </button>
+                ))}
+              </div>
+            )}
           </div>
         </form>
 
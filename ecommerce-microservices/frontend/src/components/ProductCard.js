@@ -2,6 +2,7 @@ import React from 'react';
 import { Link } from 'react-router-dom';
 import { ShoppingCart, Star, Heart } from 'lucide-react';
 import { useCart } from '../context/CartContext';
+import { imageUrl } from '../utils/api';
 
 const ProductCard = ({ product }) => {
   const { addToCart } = useCart();
@@ -34,7 +35,7 @@ const ProductCard = ({ product }) => {
         background: 'var(--bg-secondary)',
       }}>
         <img
-          src={product.image_url || 'https://via.placeholder.com/400'}
+          src={imageUrl(product.image_url, 'card') || 'https://via.placeholder.com/400'}
           alt={product.name}
           style={{
             width: '100%',
@@ -1,5 +1,5 @@
 import React, { createContext, useContext, useState, useEffect } from 'react';
-import api from '../utils/api';
+import api, { loadHome } from '../utils/api';
 
 const AuthContext = createContext();
 
@@ -12,12 +12,33 @@ export const AuthProvider = ({ children }) => {
 
   useEffect(() => {
     if (token) {
-      fetchProfile();
+      // The first load takes the profile from the homepage call; logins refetch it
+      loading ? bootstrap() : fetchProfile();
     } else {
       setLoading(false);
     }
   }, [token]);
 
+  const bootstrap = async () => {
+    // Ask user-service directly only when the profile part didn't make it in time
+    try {
+      const data = await loadHome();
+      if (data.profile) {
+        setUser(data.profile);
+        setLoading(false);
+        return;
+      }
+      if (data.errors.profile === 'unauthorized') {
+        logout();
+        setLoading(false);
+        return;
+      }
+    } catch (error) {
+      // fall through to the direct call
+    }
+    await fetchProfile();
+  };
+
   const fetchProfile = async () => {
     try {
       const response = await api.get('/api/users/profile');
@@ -3,6 +3,7 @@ import { Link, useNavigate } from 'react-router-dom';
 import { Trash2, Minus, Plus, ShoppingBag, ArrowRight } from 'lucide-react';
 import { useCart } from '../context/CartContext';
 import { useAuth } from '../context/AuthContext';
+import { imageUrl } from '../utils/api';
 
 const Cart = () => {
   const { cart, updateQuantity, removeFromCart, loading } = useCart();
@@ -116,7 +117,7 @@ const Cart = () => {
                   flexShrink: 0,
                 }}>
                   <img
-                    src={item.product?.image_url || 'https://via.placeholder.com/140'}
+                    src={imageUrl(item.product?.image_url, 'thumb') || 'https://via.placeholder.com/140'}
                     alt={item.product?.name}
                     style={{
                       width: '100%',
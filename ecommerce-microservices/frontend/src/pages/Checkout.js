@@ -3,13 +3,12 @@ import { useNavigate } from 'react-router-dom';
 import { MapPin, ArrowRight, ChevronLeft } from 'lucide-react';
 import { useAuth } from '../context/AuthContext';
 import { useCart } from '../context/CartContext';
-import api from '../utils/api';
+import { imageUrl } from '../utils/api';
 
 const Checkout = () => {
   const navigate = useNavigate();
   const { user, isAuthenticated, updateShippingAddress } = useAuth();
   const { cart } = useCart();
-  const [loading, setLoading] = useState(false);
   const [formData, setFormData] = useState({
     full_name: '',
     phone: '',
@@ -49,11 +48,15 @@ const Checkout = () => {
     }).format(price);
   };
 
+  const shippingCost = cart.total >= 500 ? 0 : 40;
+  const tax = Math.round(cart.total * 0.18);
+  const grandTotal = cart.total + shippingCost + tax;
+
   const handleChange = (e) => {
     setFormData({ ...formData, [e.target.name]: e.target.value });
   };
 
-  const handleSubmit = async (e) => {
+  const handleSubmit = (e) => {
     e.preventDefault();
     
     // Validate
@@ -65,28 +68,19 @@ const Checkout = () => {
       }
     }
 
-    setLoading(true);
-    try {
-      // Create order
-      const response = await api.post('/api/orders/orders', {
-        shipping_address: formData
-      });
-      
-      // Save order data and navigate to payment
-      localStorage.setItem('currentOrder', JSON.stringify(response.data));
-      navigate('/payment');
-    } catch (error) {
-      console.error('Error creating order:', error);
-      alert('Failed to create order. Please try again.');
-    } finally {
-      setLoading(false);
-    }
+    // The order is placed and paid in one call from the payment page; this
+    // draft only carries the address and the summary shown there
+    localStorage.setItem('currentOrder', JSON.stringify({
+      items: cart.items,
+      subtotal: cart.total,
+      shipping_cost: shippingCost,
+      tax,
+      total: grandTotal,
+      shipping_address: formData,
+    }));
+    navigate('/payment');
   };
 
-  const shippingCost = cart.total >= 500 ? 0 : 40;
-  const tax = Math.round(cart.total * 0.18);
-  const grandTotal = cart.total + shippingCost + tax;
-
   const states = [
     'Andhra Pradesh', 'Bihar', 'Delhi', 'Gujarat', 'Karnataka',
     'Kerala', 'Madhya Pradesh', 'Maharashtra', 'Punjab', 'Rajasthan',
@@ -282,7 +276,6 @@ const Checkout = () => {
                 <button
                   type="submit"
                   className="btn btn-primary"
-                  disabled={loading}
                   style={{
                     width: '100%',
                     padding: '18px',
@@ -290,7 +283,7 @@ const Checkout = () => {
                     marginTop: '32px',
                   }}
                 >
-                  {loading ? 'Processing...' : 'Continue to Payment'}
+                  Continue to Payment
                   <ArrowRight size={20} />
                 </button>
               </form>
@@ -323,7 +316,7 @@ const Checkout = () => {
                   borderBottom: '1px solid var(--border-color)',
                 }}>
                   <img
-                    src={item.product?.image_url}
+                    src={imageUrl(item.product?.image_url, 'thumb')}
                     alt={item.product?.name}
                     style={{
                       width: '50px',
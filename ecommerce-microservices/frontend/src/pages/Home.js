@@ -1,7 +1,7 @@
 import React, { useState, useEffect } from 'react';
 import { Link } from 'react-router-dom';
 import { ArrowRight, Truck, Shield, RefreshCw, Star, ChevronRight } from 'lucide-react';
-import api from '../utils/api';
+import api, { loadHome } from '../utils/api';
 import ProductCard from '../components/ProductCard';
 
 const Home = () => {
@@ -15,12 +15,12 @@ const Home = () => {
 
   const fetchData = async () => {
     try {
-      const [productsRes, categoriesRes] = await Promise.all([
-        api.get('/api/products/products/featured'),
-        api.get('/api/products/products/categories')
-      ]);
-      setFeaturedProducts(productsRes.data);
-      setCategories(categoriesRes.data);
+      let { home } = await loadHome().catch(() => ({}));
+      if (!home) {
+        home = (await api.get('/api/products/products/home')).data;
+      }
+      setFeaturedProducts(home.featured);
+      setCategories(home.categories);
     } catch (error) {
       console.error('Error fetching data:', error);
     } finally {
@@ -1,7 +1,7 @@
 import React, { useState, useEffect } from 'react';
 import { useParams, Link } from 'react-router-dom';
 import { CheckCircle, Package, Truck, Home, ArrowRight } from 'lucide-react';
-import api from '../utils/api';
+import api, { imageUrl } from '../utils/api';
 
 const OrderConfirmation = () => {
   const { orderId } = useParams();
@@ -208,7 +208,7 @@ const OrderConfirmation = () => {
                 marginBottom: '12px',
               }}>
                 <img
-                  src={item.product?.image_url}
+                  src={imageUrl(item.product?.image_url, 'thumb')}
                   alt={item.product?.name}
                   style={{
                     width: '80px',
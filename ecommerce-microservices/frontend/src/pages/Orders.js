@@ -1,7 +1,7 @@
 import React, { useState, useEffect } from 'react';
 import { Link, useNavigate } from 'react-router-dom';
 import { Package, ChevronRight } from 'lucide-react';
-import api from '../utils/api';
+import api, { imageUrl } from '../utils/api';
 import { useAuth } from '../context/AuthContext';
 
 const Orders = () => {
@@ -158,7 +158,7 @@ const Orders = () => {
                 {order.items?.slice(0, 4).map((item, idx) => (
                   <img
                     key={idx}
-                    src={item.product?.image_url}
+                    src={imageUrl(item.product?.image_url, 'thumb')}
                     alt={item.product?.name}
                     style={{
                       width: '60px',
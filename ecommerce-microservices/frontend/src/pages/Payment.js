@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { useNavigate } from 'react-router-dom';
 import { CreditCard, Smartphone, Building, Lock, ChevronLeft } from 'lucide-react';
 import api from '../utils/api';
@@ -6,7 +6,7 @@ import { useCart } from '../context/CartContext';
 
 const Payment = () => {
   const navigate = useNavigate();
-  const { clearCart } = useCart();
+  const { fetchCart } = useCart();
   const [order, setOrder] = useState(null);
   const [loading, setLoading] = useState(false);
   const [paymentMethod, setPaymentMethod] = useState('credit_card');
@@ -17,6 +17,9 @@ const Payment = () => {
     cvv: '',
   });
   const [upiId, setUpiId] = useState('');
+  // One key per attempt: resubmitting after a lost response reports on the
+  // checkout already placed instead of placing another
+  const attemptKey = useRef(null);
 
   useEffect(() => {
     const savedOrder = localStorage.getItem('currentOrder');
@@ -74,8 +77,7 @@ const Payment = () => {
 
     try {
       const paymentData = {
-        order_id: order.order_id,
-        amount: order.total,
+        shipping_address: order.shipping_address,
         payment_method: paymentMethod,
       };
 
@@ -88,16 +90,33 @@ const Payment = () => {
         paymentData.upi_id = upiId;
       }
 
-      const response = await api.post('/api/payments/payments/process', paymentData);
-      
-      if (response.data.success) {
-        localStorage.removeItem('currentOrder');
-        await clearCart();
-        navigate(`/order-confirmation/${order.order_id}`);
+      // Places the order, reserves its stock, pays and clears the cart in one call
+      attemptKey.current = attemptKey.current || `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+      const response = await api.post('/api/orders/checkout', paymentData, {
+        headers: { 'Idempotency-Key': attemptKey.current },
+      });
+
+      // A busy gateway can leave the payment queued; long-poll for the outcome
+      let result = response.data;
+      while (result.status === 'pending') {
+        const { data } = await api.get(`/api/orders/checkout/${result.order_id}`, { params: { wait: 25 } });
+        result = data;
+      }
+      attemptKey.current = null;
+      if (result.status === 'failed') {
+        throw new Error(result.detail || 'Payment failed. Please try again or use a different payment method.');
       }
+
+      localStorage.removeItem('currentOrder');
+      await fetchCart();
+      navigate(`/order-confirmation/${result.order_id}`);
     } catch (error) {
       console.error('Payment error:', error);
-      alert(error.response?.data?.detail || 'Payment failed. Please try again.');
+      // A declined or refused checkout is final; only a lost response is retried as the same attempt
+      if (error.response) {
+        attemptKey.current = null;
+      }
+      alert(error.response?.data?.detail || error.message || 'Payment failed. Please try again.');
     } finally {
       setLoading(false);
     }
@@ -381,19 +400,21 @@ const Payment = () => {
           }}>
             <h2 style={{ fontSize: '22px', marginBottom: '24px' }}>Order Summary</h2>
 
-            <div style={{
-              padding: '16px',
-              background: 'var(--bg-card)',
-              borderRadius: '12px',
-              marginBottom: '24px',
-            }}>
-              <p style={{ fontSize: '13px', color: 'var(--text-muted)', marginBottom: '4px' }}>
-                Order ID
-              </p>
-              <p style={{ fontWeight: '600', fontFamily: 'monospace' }}>
-                {order.order_id}
-              </p>
-            </div>
+            {order.order_id && (
+              <div style={{
+                padding: '16px',
+                background: 'var(--bg-card)',
+                borderRadius: '12px',
+                marginBottom: '24px',
+              }}>
+                <p style={{ fontSize: '13px', color: 'var(--text-muted)', marginBottom: '4px' }}>
+                  Order ID
+                </p>
+                <p style={{ fontWeight: '600', fontFamily: 'monospace' }}>
+                  {order.order_id}
+                </p>
+              </div>
+            )}
 
             {/* Items */}
             <div style={{ marginBottom: '24px' }}>
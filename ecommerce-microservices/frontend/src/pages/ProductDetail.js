@@ -1,7 +1,7 @@
 import React, { useState, useEffect } from 'react';
 import { useParams, useNavigate } from 'react-router-dom';
 import { ShoppingCart, Heart, Star, Truck, Shield, RefreshCw, Minus, Plus, ChevronLeft } from 'lucide-react';
-import api from '../utils/api';
+import api, { imageUrl } from '../utils/api';
 import { useCart } from '../context/CartContext';
 import { useAuth } from '../context/AuthContext';
 
@@ -125,7 +125,7 @@ const ProductDetail = () => {
               </span>
             )}
             <img
-              src={product.image_url || 'https://via.placeholder.com/600'}
+              src={imageUrl(product.image_url, 'detail') || 'https://via.placeholder.com/600'}
               alt={product.name}
               style={{
                 width: '100%',
@@ -32,4 +32,21 @@ api.interceptors.response.use(
   }
 );
 
+// Product images go through product-service, which resizes and caches them
+export const imageUrl = (url, variant) =>
+  url ? `${API_BASE_URL}/api/products/products/images/${variant}?src=${encodeURIComponent(url)}` : url;
+
+// Homepage blocks, cart count and profile in one call. Callers mounting
+// together (auth bootstrap and the home page) share the request in flight
+let homeRequest = null;
+export const loadHome = () => {
+  if (!homeRequest) {
+    homeRequest = api.get('/api/bff/bff/home').then((response) => response.data);
+    homeRequest.finally(() => {
+      homeRequest = null;
+    }).catch(() => {});
+  }
+  return homeRequest;
+};
+
 export default api;
@@ -0,0 +1,97 @@
+"""Monolith mode: run all the services in a single ASGI process.
+
+Each service app is mounted under the same /api/<service> prefix the frontend
+nginx and the ingress use, and the inter-service HTTP calls (cart -> product,
+order -> cart, payment -> order/cart, bff -> product/cart/user) are routed
+through in-process ASGI transports instead of the network. The microservice
+images are unchanged.
+
+    DB_HOST=localhost DB_NAME=ecommerce uvicorn monolith.main:app --port 8000
+
+All services share the DB_* settings, so a single Postgres database holds every
+table (products, cart_items, orders, payments and users do not collide).
+"""
+import importlib
+import inspect
+import os
+import sys
+import types
+from pathlib import Path
+
+import httpx
+from fastapi import FastAPI
+
+SERVICES_DIR = Path(os.environ.get("SERVICES_DIR", Path(__file__).resolve().parent.parent / "services"))
+
+# Service name -> mount prefix (matches the frontend nginx proxy locations)
+SERVICES = {
+    "user-service": "/api/users",
+    "product-service": "/api/products",
+    "cart-service": "/api/cart",
+    "order-service": "/api/orders",
+    "payment-service": "/api/payments",
+    "bff-service": "/api/bff",
+}
+
+os.environ.setdefault("DB_HOST", "localhost")
+os.environ.setdefault("DB_NAME", "ecommerce")
+
+def load_service(name: str):
+    # Every service ships its code as an `app` package; load each one under
+    # its own package name so the `app.main` modules don't clash.
+    package = name.replace("-", "_")
+    module = types.ModuleType(package)
+    module.__path__ = [str(SERVICES_DIR / name / "app")]
+    sys.modules[package] = module
+    return importlib.import_module(f"{package}.main")
+
+services = {name: load_service(name) for name in SERVICES}
+
+def wire_transports():
+    transports = {
+        name: httpx.ASGITransport(app=module.app, raise_app_exceptions=False)
+        for name, module in services.items()
+    }
+    for module in services.values():
+        mounts = getattr(module, "SERVICE_TRANSPORTS", None)
+        if mounts is None:
+            continue
+        # PRODUCT_SERVICE_URL -> product-service, and so on
+        for attr, url in vars(module).items():
+            if not attr.endswith("_SERVICE_URL"):
+                continue
+            target = attr[: -len("_URL")].lower().replace("_", "-")
+            if target in transports:
+                mounts[url.rstrip("/")] = transports[target]
+
+wire_transports()
+
+app = FastAPI(title="E-Commerce Monolith", version="1.0.0")
+
+for name, prefix in SERVICES.items():
+    app.mount(prefix, services[name].app)
+
+async def run_handlers(handlers):
+    for handler in handlers:
+        result = handler()
+        if inspect.isawaitable(result):
+            await result
+
+# Mounted sub-applications don't receive lifespan events, so forward them
+@app.on_event("startup")
+async def startup():
+    for module in services.values():
+        await run_handlers(module.app.router.on_startup)
+
+@app.on_event("shutdown")
+async def shutdown():
+    for module in services.values():
+        await run_handlers(module.app.router.on_shutdown)
+
+@app.get("/health")
+async def health():
+    return {"status": "healthy", "service": "monolith", "services": list(SERVICES)}
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=8000)
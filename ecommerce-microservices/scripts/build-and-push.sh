@@ -6,7 +6,7 @@
 set -e
 
 DOCKERHUB_USERNAME="kastrov"
-SERVICES=("user-service" "product-service" "cart-service" "order-service" "payment-service")
+SERVICES=("user-service" "product-service" "cart-service" "order-service" "payment-service" "bff-service")
 
 echo "=========================================="
 echo "  E-Commerce Microservices Build Script"
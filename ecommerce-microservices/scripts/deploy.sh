@@ -45,7 +45,7 @@ kubectl apply -f services/
 echo "Waiting for service pods to be ready..."
 
 # Wait for services to be ready
-for svc in user-service product-service cart-service order-service payment-service frontend; do
+for svc in user-service product-service cart-service order-service payment-service bff-service frontend; do
     echo "Waiting for $svc..."
     kubectl wait --for=condition=available deployment/$svc -n ecommerce --timeout=180s || true
 done
@@ -0,0 +1,135 @@
+"""Concurrent fan-out for aggregated responses.
+
+fan_out() starts every upstream call of a response at once and waits for each
+at most its own timeout, so the response costs the slowest part that answers
+in time rather than the sum of them. A part that is slow or fails comes back
+as an error next to the parts that worked, instead of failing the response.
+
+Parts that don't depend on the caller are SharedParts. The last good body is
+served for `ttl` seconds without asking upstream. After that it is
+revalidated with If-None-Match, where a 304 keeps it, and concurrent
+revalidations share one request. While upstream is slow or down the old body
+is served stale, so a catalog outage only ages the data on the page. Bodies
+are kept as the upstream's JSON bytes and embedded into the response without
+being decoded or encoded again.
+"""
+import asyncio
+import time
+
+import httpx
+import orjson
+
+
+class UpstreamError(Exception):
+    """An upstream answered with something other than the part's data."""
+
+
+def reason(error):
+    if isinstance(error, asyncio.TimeoutError):
+        return "timeout"
+    if isinstance(error, UpstreamError):
+        return str(error)
+    if isinstance(error, httpx.HTTPError):
+        return "unavailable"
+    return "error"
+
+
+async def get_json(client, url, headers=None):
+    response = await client.get(url, headers=headers)
+    if response.status_code == 401:
+        raise UpstreamError("unauthorized")
+    if response.status_code != 200:
+        raise UpstreamError(f"upstream returned {response.status_code}")
+    return response.json()
+
+
+async def fan_out(calls):
+    """Run `calls` (name -> (awaitable, timeout)) concurrently.
+
+    Returns (results, errors, timings): the value of each call that finished
+    in time, the reason for each that didn't, and how long each took. A
+    timeout of None means the call bounds itself.
+    """
+    timings = {}
+
+    async def run(name, awaitable, timeout):
+        start = time.perf_counter()
+        try:
+            if timeout is None:
+                return await awaitable
+            return await asyncio.wait_for(awaitable, timeout)
+        finally:
+            timings[name] = time.perf_counter() - start
+
+    tasks = {name: asyncio.ensure_future(run(name, *call)) for name, call in calls.items()}
+    await asyncio.wait(tasks.values())
+    results, errors = {}, {}
+    for name, task in tasks.items():
+        error = task.exception()
+        if error is None:
+            results[name] = task.result()
+        else:
+            errors[name] = reason(error)
+    return results, errors, timings
+
+
+class SharedPart:
+    def __init__(self, url, ttl=5.0, timeout=1.0):
+        self.url = url
+        self.ttl = ttl
+        self.timeout = timeout
+        self.body = None  # orjson.Fragment of the upstream's JSON
+        self.etag = None
+        self.checked_at = None
+        self.hits = 0
+        self.revalidations = 0
+        self.not_modified = 0
+        self.stale = 0
+        self._refresh = None
+
+    async def get(self, client):
+        """The body, and whether it is stale (upstream failed or was too slow)."""
+        if self.body is not None and time.monotonic() - self.checked_at < self.ttl:
+            self.hits += 1
+            return self.body, False
+        if self._refresh is None:
+            self._refresh = asyncio.ensure_future(self._revalidate(client))
+            self._refresh.add_done_callback(self._refreshed)
+        try:
+            # Shielded: a refresh that outlasts this caller still lands for the next
+            return await asyncio.wait_for(asyncio.shield(self._refresh), self.timeout), False
+        except (asyncio.TimeoutError, UpstreamError, httpx.HTTPError):
+            if self.body is None:
+                raise
+            self.stale += 1
+            return self.body, True
+
+    def _refreshed(self, task):
+        self._refresh = None
+        if not task.cancelled():
+            task.exception()  # retrieved here, so an unawaited failure isn't logged
+
+    async def _revalidate(self, client):
+        self.revalidations += 1
+        headers = {"If-None-Match": self.etag} if self.etag and self.body is not None else None
+        response = await client.get(self.url, headers=headers)
+        if response.status_code == 304:
+            self.not_modified += 1
+        elif response.status_code == 200:
+            self.body = orjson.Fragment(response.content)
+            self.etag = response.headers.get("etag")
+        else:
+            raise UpstreamError(f"upstream returned {response.status_code}")
+        self.checked_at = time.monotonic()
+        return self.body
+
+    def snapshot(self):
+        return {
+            "url": self.url,
+            "cached": self.body is not None,
+            "age_seconds": round(time.monotonic() - self.checked_at, 3) if self.checked_at else None,
+            "hits": self.hits,
+            "revalidations": self.revalidations,
+            "not_modified": self.not_modified,
+            "stale": self.stale,
+        }
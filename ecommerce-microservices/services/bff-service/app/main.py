@@ -0,0 +1,151 @@
+from fastapi import FastAPI, HTTPException, Depends, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+import os
+import jwt
+import httpx
+import orjson
+from decimal import Decimal
+
+from .aggregate import SharedPart, fan_out, get_json
+from .compression import CompressionMiddleware, CompressionStats
+
+def json_default(value):
+    # Same as jsonable_encoder: integral Decimals become int, the rest float
+    if isinstance(value, Decimal):
+        return int(value) if value.as_tuple().exponent >= 0 else float(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+def dumps_json(content) -> bytes:
+    return orjson.dumps(content, default=json_default, option=orjson.OPT_NON_STR_KEYS)
+
+class FastJSONResponse(JSONResponse):
+    # orjson encodes straight to bytes, cached upstream bodies (Fragments) included
+    def render(self, content) -> bytes:
+        return dumps_json(content)
+
+app = FastAPI(title="BFF Service", version="1.0.0", default_response_class=FastJSONResponse)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+compression_stats = CompressionStats()
+app.add_middleware(CompressionMiddleware, stats=compression_stats)
+
+security = HTTPBearer()
+JWT_SECRET = os.environ.get("JWT_SECRET", "ecommerce-secret-key-2024")
+ADMIN_EMAILS = {e.strip().lower() for e in os.environ.get("ADMIN_EMAILS", "").split(",") if e.strip()}
+PRODUCT_SERVICE_URL = os.environ.get("PRODUCT_SERVICE_URL", "http://product-service:8000")
+CART_SERVICE_URL = os.environ.get("CART_SERVICE_URL", "http://cart-service:8000")
+USER_SERVICE_URL = os.environ.get("USER_SERVICE_URL", "http://user-service:8000")
+HOME_CACHE_SECONDS = float(os.environ.get("HOME_CACHE_SECONDS", "5"))
+
+# Seconds each part may take before the response goes out without it;
+# BFF_PART_TIMEOUTS="home=1,cart_count=0.3,profile=0.3" overrides them
+PART_TIMEOUTS = {"home": 1.0, "cart_count": 0.3, "profile": 0.3}
+for spec in os.environ.get("BFF_PART_TIMEOUTS", "").split(","):
+    key, _, value = spec.strip().partition("=")
+    if key in PART_TIMEOUTS and value:
+        PART_TIMEOUTS[key] = float(value)
+
+# Transports keyed by service URL; monolith mode mounts in-process ASGI apps here
+SERVICE_TRANSPORTS = {}
+
+def service_client():
+    # One client per worker, so upstream connections are kept alive between requests
+    return httpx.AsyncClient(
+        mounts=SERVICE_TRANSPORTS,
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=50),
+    )
+
+# The homepage blocks are the same for everyone, so they are shared
+home_part = SharedPart(f"{PRODUCT_SERVICE_URL}/products/home", ttl=HOME_CACHE_SECONDS, timeout=PART_TIMEOUTS["home"])
+
+@app.on_event("startup")
+async def startup():
+    app.state.client = service_client()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await app.state.client.aclose()
+
+def bearer_token(request: Request):
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    return token if scheme.lower() == "bearer" and token else None
+
+def token_is_valid(token: str):
+    # Checked here so a stale token doesn't cost two doomed upstream calls
+    try:
+        jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
+        return True
+    except jwt.InvalidTokenError:
+        return False
+
+def verify_admin(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    # Operational reports such as /debug/parts are limited to ADMIN_EMAILS
+    try:
+        payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=["HS256"])
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=401, detail="Token expired")
+    except jwt.InvalidTokenError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    if payload.get("email", "").lower() not in ADMIN_EMAILS:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return payload
+
+@app.get("/health")
+async def health():
+    return {"status": "healthy", "service": "bff-service"}
+
+@app.get("/debug/compression")
+async def compression_report(admin: dict = Depends(verify_admin)):
+    return compression_stats.snapshot()
+
+@app.get("/debug/parts")
+async def parts_report(admin: dict = Depends(verify_admin)):
+    return {"home": home_part.snapshot(), "timeouts": PART_TIMEOUTS}
+
+@app.get("/bff/home")
+async def get_home(request: Request):
+    client = app.state.client
+    calls = {"home": (home_part.get(client), None)}
+    token = bearer_token(request)
+    errors = {}
+    if token and token_is_valid(token):
+        auth = {"Authorization": f"Bearer {token}"}
+        calls["cart_count"] = (get_json(client, f"{CART_SERVICE_URL}/cart/count", auth), PART_TIMEOUTS["cart_count"])
+        calls["profile"] = (get_json(client, f"{USER_SERVICE_URL}/profile", auth), PART_TIMEOUTS["profile"])
+    elif token:
+        errors = {"cart_count": "unauthorized", "profile": "unauthorized"}
+
+    results, failed, timings = await fan_out(calls)
+    errors.update(failed)
+    home, stale = results.get("home", (None, False))
+    cart_count = results.get("cart_count")
+    content = {
+        "home": home,
+        "cart_count": cart_count["count"] if cart_count else None,
+        "profile": results.get("profile"),
+        "stale": ["home"] if stale else [],
+        "errors": errors,
+    }
+    complete = not errors and not stale
+    headers = {
+        "Server-Timing": ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items()),
+        # Only a complete anonymous response may be shared, and a shared cache
+        # must not hand it to a request that carries a token
+        "Cache-Control": f"public, max-age={HOME_CACHE_SECONDS:g}" if complete and not token else "private, no-store",
+        "Vary": "Authorization",
+    }
+    return FastJSONResponse(content, headers=headers)
+
+if __name__ == "__main__":
+    import sys
+    from .serve import Launcher
+    sys.exit(Launcher().run())
@@ -1,16 +1,40 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
-from typing import Optional, List
+from typing import Optional, List, Literal
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import execute_values
 import os
 import jwt
 import time
 import httpx
+import asyncio
+import orjson
+from decimal import Decimal
 
-app = FastAPI(title="Cart Service", version="1.0.0")
+from .admission import AdmissionMiddleware, RouteClass, admission_limiter, CRITICAL, NORMAL
+from .compression import CompressionMiddleware, CompressionStats
+from .querylog import QueryLogMiddleware, query_logger
+from .pool import ConnectionPool, PooledConnection, Statement, execute_prepared
+
+def json_default(value):
+    # Same as jsonable_encoder: integral Decimals become int, the rest float
+    if isinstance(value, Decimal):
+        return int(value) if value.as_tuple().exponent >= 0 else float(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+def dumps_json(content) -> bytes:
+    return orjson.dumps(content, default=json_default, option=orjson.OPT_NON_STR_KEYS)
+
+class FastJSONResponse(JSONResponse):
+    # orjson encodes rows (datetimes included) straight to bytes; hot routes
+    # return this directly so FastAPI skips the generic jsonable_encoder pass
+    def render(self, content) -> bytes:
+        return dumps_json(content)
+
+app = FastAPI(title="Cart Service", version="1.0.0", default_response_class=FastJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -20,11 +44,44 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+compression_stats = CompressionStats()
+app.add_middleware(CompressionMiddleware, stats=compression_stats)
+
 security = HTTPBearer()
 JWT_SECRET = os.environ.get("JWT_SECRET", "ecommerce-secret-key-2024")
+ADMIN_EMAILS = {e.strip().lower() for e in os.environ.get("ADMIN_EMAILS", "").split(",") if e.strip()}
 PRODUCT_SERVICE_URL = os.environ.get("PRODUCT_SERVICE_URL", "http://product-service:8000")
+SNAPSHOT_REFRESH_INTERVAL = int(os.environ.get("SNAPSHOT_REFRESH_INTERVAL", "300"))
+MAX_BATCH_OPERATIONS = int(os.environ.get("MAX_BATCH_OPERATIONS", "100"))
 
-def get_db_connection():
+# Transports keyed by service URL; monolith mode mounts in-process ASGI apps here
+SERVICE_TRANSPORTS = {}
+
+def service_client():
+    return httpx.AsyncClient(mounts=SERVICE_TRANSPORTS)
+
+# Admission control: the cart read and clear are part of checkout, so shed last
+CART_READ = RouteClass("cart_read", rate=10, burst=30, priority=CRITICAL)
+CART_WRITE = RouteClass("cart_write", rate=5, burst=20, priority=NORMAL)
+CHECKOUT = RouteClass("checkout", rate=1, burst=5, priority=CRITICAL)
+
+def classify_request(method, path, query):
+    if path == "/health" or path.startswith("/debug/"):
+        return None
+    if method == "GET":
+        return CART_READ
+    if method == "DELETE" and path == "/cart":
+        return CHECKOUT
+    return CART_WRITE
+
+admission = admission_limiter()
+app.add_middleware(AdmissionMiddleware, classify=classify_request, jwt_secret=JWT_SECRET, limiter=admission)
+
+# Times every statement by shape; slow ones are logged and sampled for EXPLAIN
+query_log = query_logger()
+app.add_middleware(QueryLogMiddleware)
+
+def open_db_connection():
     max_retries = 5
     for i in range(max_retries):
         try:
@@ -34,7 +91,8 @@ def get_db_connection():
                 database=os.environ.get("DB_NAME", "cartdb"),
                 user=os.environ.get("DB_USER", "postgres"),
                 password=os.environ.get("DB_PASSWORD", "postgres123"),
-                cursor_factory=RealDictCursor
+                connection_factory=PooledConnection,
+                cursor_factory=query_log.cursor_factory
             )
             return conn
         except psycopg2.OperationalError:
@@ -43,10 +101,23 @@ def get_db_connection():
             else:
                 raise
 
+# Requests reuse idle connections and the statements prepared on them;
+# anything that keeps session state (LISTEN, advisory locks) opens its own
+db_pool = ConnectionPool(
+    open_db_connection,
+    size=int(os.environ.get("DB_POOL_SIZE", "10")),
+    max_age=float(os.environ.get("DB_POOL_MAX_AGE_SECONDS", "1800")),
+)
+
+def get_db_connection():
+    return db_pool.get()
+
 def init_db():
     try:
-        conn = get_db_connection()
+        conn = open_db_connection()
         cur = conn.cursor()
+        # Workers and replicas starting together would otherwise race on the DDL
+        cur.execute("SELECT pg_advisory_lock(hashtext('schema:cart-service'))")
         cur.execute("""
             CREATE TABLE IF NOT EXISTS cart_items (
                 id SERIAL PRIMARY KEY,
@@ -58,6 +129,16 @@ def init_db():
                 UNIQUE(user_id, product_id)
             )
         """)
+        # Product snapshot taken at add time and refreshed in the background,
+        # so reading the cart never has to call product-service
+        cur.execute("""
+            ALTER TABLE cart_items
+                ADD COLUMN IF NOT EXISTS product_name VARCHAR(255),
+                ADD COLUMN IF NOT EXISTS product_brand VARCHAR(100),
+                ADD COLUMN IF NOT EXISTS product_image_url TEXT,
+                ADD COLUMN IF NOT EXISTS unit_price DECIMAL(10, 2),
+                ADD COLUMN IF NOT EXISTS price_updated_at TIMESTAMP
+        """)
         conn.commit()
         cur.close()
         conn.close()
@@ -68,6 +149,13 @@ def init_db():
 @app.on_event("startup")
 async def startup():
     init_db()
+    app.state.snapshot_refresher = asyncio.create_task(snapshot_refresher())
+    app.state.catalog_follower = asyncio.create_task(follow_catalog_changes())
+
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.snapshot_refresher.cancel()
+    app.state.catalog_follower.cancel()
 
 class CartItem(BaseModel):
     product_id: int
@@ -76,6 +164,14 @@ class CartItem(BaseModel):
 class CartItemUpdate(BaseModel):
     quantity: int
 
+class CartOperation(BaseModel):
+    op: Literal["add", "set", "remove"]
+    product_id: int
+    quantity: int = 1
+
+class CartBatch(BaseModel):
+    operations: List[CartOperation]
+
 def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
     try:
         payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=["HS256"])
@@ -85,9 +181,15 @@ def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+def verify_admin(payload: dict = Depends(verify_token)):
+    # Operational reports such as /debug/queries are limited to ADMIN_EMAILS
+    if payload.get("email", "").lower() not in ADMIN_EMAILS:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return payload
+
 async def get_product_details(product_id: int):
     try:
-        async with httpx.AsyncClient() as client:
+        async with service_client() as client:
             response = await client.get(f"{PRODUCT_SERVICE_URL}/products/{product_id}")
             if response.status_code == 200:
                 return response.json()
@@ -95,43 +197,257 @@ async def get_product_details(product_id: int):
         pass
     return None
 
+async def get_products_batch(product_ids):
+    # Returns {product_id: product}, or None if product-service couldn't answer
+    products = {}
+    product_ids = list(product_ids)
+    try:
+        async with service_client() as client:
+            for start in range(0, len(product_ids), 200):
+                response = await client.get(
+                    f"{PRODUCT_SERVICE_URL}/products/batch",
+                    params={"ids": product_ids[start:start + 200]}
+                )
+                if response.status_code != 200:
+                    return None
+                products.update((p["id"], p) for p in response.json())
+    except httpx.RequestError:
+        return None
+    return products
+
+def apply_snapshots(products, removed_ids=()):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    if products:
+        execute_values(cur, """
+            UPDATE cart_items AS c
+            SET product_name = v.name, product_brand = v.brand, product_image_url = v.image_url,
+                unit_price = v.price, price_updated_at = CURRENT_TIMESTAMP
+            FROM (VALUES %s) AS v (product_id, name, brand, image_url, price)
+            WHERE c.product_id = v.product_id
+              AND (c.product_name, c.product_brand, c.product_image_url, c.unit_price)
+                  IS DISTINCT FROM (v.name, v.brand, v.image_url, v.price)
+        """, [(p["id"], p["name"], p.get("brand"), p.get("image_url"), p["price"]) for p in products],
+            template="(%s::int, %s::varchar, %s::varchar, %s::text, %s::numeric)")
+    if removed_ids:
+        # Product no longer exists in the catalog
+        cur.execute("DELETE FROM cart_items WHERE product_id = ANY(%s)", (list(removed_ids),))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+def get_carted_product_ids():
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT DISTINCT product_id FROM cart_items")
+    product_ids = [row["product_id"] for row in cur.fetchall()]
+    cur.close()
+    conn.close()
+    return product_ids
+
+async def refresh_snapshots(product_ids=None):
+    if product_ids is None:
+        product_ids = await asyncio.to_thread(get_carted_product_ids)
+    if not product_ids:
+        return
+    products = await get_products_batch(product_ids)
+    if products is None:
+        return
+    removed_ids = set(product_ids) - set(products)
+    await asyncio.to_thread(apply_snapshots, list(products.values()), removed_ids)
+
+async def snapshot_refresher():
+    while True:
+        await asyncio.sleep(SNAPSHOT_REFRESH_INTERVAL)
+        try:
+            await refresh_snapshots()
+        except Exception as e:
+            print(f"Snapshot refresh error: {e}")
+
+async def follow_catalog_changes():
+    # Apply product-service's change feed to the snapshots as changes happen;
+    # the periodic refresher above only reconciles anything missed
+    since = None
+    while True:
+        try:
+            async with service_client() as client:
+                if since is None:
+                    response = await client.get(f"{PRODUCT_SERVICE_URL}/products/changes", params={"limit": 1})
+                    response.raise_for_status()
+                    since = response.json()["latest"]
+                    await refresh_snapshots()
+                    continue
+                response = await client.get(
+                    f"{PRODUCT_SERVICE_URL}/products/changes",
+                    params={"since": since, "wait": 30},
+                    timeout=40
+                )
+                response.raise_for_status()
+                data = response.json()
+            
+            if data.get("resync"):
+                # Changes we hadn't seen were pruned from the feed
+                await refresh_snapshots()
+                since = data["version"]
+                continue
+            changed = {}
+            removed = set()
+            for change in data["changes"]:
+                product_id = change["product_id"]
+                if change["operation"] == "delete":
+                    changed.pop(product_id, None)
+                    removed.add(product_id)
+                elif change["operation"] != "stock":
+                    changed[product_id] = change["product"]
+                    removed.discard(product_id)
+            if changed or removed:
+                await asyncio.to_thread(apply_snapshots, list(changed.values()), removed)
+            since = data["version"]
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Catalog change feed error: {e}")
+            await asyncio.sleep(5)
+
+# A single statement per write, so concurrent adds of the same product can't
+# race; {quantity} either adds to the existing line or replaces it
+UPSERT_ITEMS = """
+    INSERT INTO cart_items (user_id, product_id, quantity, product_name, product_brand,
+                            product_image_url, unit_price, price_updated_at)
+    VALUES %s
+    ON CONFLICT (user_id, product_id) DO UPDATE SET
+        quantity = {quantity},
+        product_name = EXCLUDED.product_name,
+        product_brand = EXCLUDED.product_brand,
+        product_image_url = EXCLUDED.product_image_url,
+        unit_price = EXCLUDED.unit_price,
+        price_updated_at = EXCLUDED.price_updated_at,
+        updated_at = CURRENT_TIMESTAMP
+"""
+UPSERT_TEMPLATE = "(%s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)"
+
+def upsert_items(cur, user_id, quantities, products, add):
+    execute_values(
+        cur,
+        UPSERT_ITEMS.format(quantity="cart_items.quantity + EXCLUDED.quantity" if add else "EXCLUDED.quantity"),
+        [
+            (user_id, product_id, quantity, products[product_id]["name"], products[product_id].get("brand"),
+             products[product_id].get("image_url"), products[product_id]["price"])
+            for product_id, quantity in quantities.items()
+        ],
+        template=UPSERT_TEMPLATE
+    )
+
+def fold_operations(operations):
+    """Reduce operations, applied in order, to one final effect per product.
+
+    Returns ({product_id: quantity to add}, {product_id: quantity to set},
+    {product_ids to remove}).
+    """
+    adds, sets, removes = {}, {}, set()
+    for operation in operations:
+        product_id = operation.product_id
+        if operation.op == "remove" or (operation.op == "set" and operation.quantity <= 0):
+            adds.pop(product_id, None)
+            sets.pop(product_id, None)
+            removes.add(product_id)
+        elif operation.op == "set":
+            adds.pop(product_id, None)
+            removes.discard(product_id)
+            sets[product_id] = operation.quantity
+        elif product_id in sets:
+            sets[product_id] += operation.quantity
+        elif product_id in removes:
+            # Removed earlier in the batch, so this add starts from zero
+            removes.discard(product_id)
+            sets[product_id] = operation.quantity
+        else:
+            adds[product_id] = adds.get(product_id, 0) + operation.quantity
+    return adds, sets, removes
+
+def cart_product(item):
+    return {
+        "id": item["product_id"],
+        "name": item["product_name"],
+        "brand": item["product_brand"],
+        "image_url": item["product_image_url"],
+        "price": float(item["unit_price"]),
+    }
+
 @app.get("/health")
 async def health():
     return {"status": "healthy", "service": "cart-service"}
 
-@app.get("/cart")
-async def get_cart(payload: dict = Depends(verify_token)):
+@app.get("/debug/compression")
+async def compression_report(admin: dict = Depends(verify_admin)):
+    return compression_stats.snapshot()
+
+@app.get("/debug/admission")
+async def admission_report(admin: dict = Depends(verify_admin)):
+    return admission.snapshot()
+
+@app.get("/debug/queries")
+async def query_report(
+    limit: int = Query(default=20, ge=1, le=500),
+    sort: str = Query(default="total", pattern="^(total|mean|max|calls)$"),
+    admin: dict = Depends(verify_admin)
+):
+    return {**query_log.report(limit, sort), "pool": db_pool.snapshot()}
+
+@app.delete("/debug/queries")
+async def reset_query_report(admin: dict = Depends(verify_admin)):
+    query_log.reset()
+    return {"message": "Query stats reset"}
+
+# Hot fixed reads, prepared once per connection
+CART_ROWS = Statement("cart_rows", """
+    SELECT id, product_id, quantity, product_name, product_brand, product_image_url, unit_price
+    FROM cart_items WHERE user_id = $1 ORDER BY created_at DESC
+""", ("integer",))
+CART_COUNT = Statement(
+    "cart_count", "SELECT COALESCE(SUM(quantity), 0) as count FROM cart_items WHERE user_id = $1", ("integer",)
+)
+
+def get_cart_rows(user_id):
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute(
-        "SELECT id, product_id, quantity FROM cart_items WHERE user_id = %s ORDER BY created_at DESC",
-        (payload["user_id"],)
-    )
+    execute_prepared(cur, CART_ROWS, (user_id,))
     items = cur.fetchall()
     cur.close()
     conn.close()
+    return items
+
+@app.get("/cart")
+async def get_cart(payload: dict = Depends(verify_token)):
+    items = get_cart_rows(payload["user_id"])
+    
+    # Rows added before snapshots existed are backfilled once
+    missing = [item["product_id"] for item in items if item["unit_price"] is None]
+    if missing:
+        await refresh_snapshots(missing)
+        items = get_cart_rows(payload["user_id"])
     
-    # Fetch product details for each item
     cart_items = []
     total = 0
     for item in items:
-        product = await get_product_details(item["product_id"])
-        if product:
-            item_total = float(product["price"]) * item["quantity"]
-            cart_items.append({
-                "id": item["id"],
-                "product_id": item["product_id"],
-                "quantity": item["quantity"],
-                "product": product,
-                "item_total": item_total
-            })
-            total += item_total
+        if item["unit_price"] is None:
+            continue
+        product = cart_product(item)
+        item_total = product["price"] * item["quantity"]
+        cart_items.append({
+            "id": item["id"],
+            "product_id": item["product_id"],
+            "quantity": item["quantity"],
+            "product": product,
+            "item_total": item_total
+        })
+        total += item_total
     
-    return {
+    return FastJSONResponse({
         "items": cart_items,
         "total": total,
         "item_count": len(cart_items)
-    }
+    })
 
 @app.post("/cart")
 async def add_to_cart(item: CartItem, payload: dict = Depends(verify_token)):
@@ -142,33 +458,48 @@ async def add_to_cart(item: CartItem, payload: dict = Depends(verify_token)):
     
     conn = get_db_connection()
     cur = conn.cursor()
+    upsert_items(cur, payload["user_id"], {item.product_id: item.quantity}, {item.product_id: product}, add=True)
+    conn.commit()
+    cur.close()
+    conn.close()
     
-    # Check if item already in cart
-    cur.execute(
-        "SELECT id, quantity FROM cart_items WHERE user_id = %s AND product_id = %s",
-        (payload["user_id"], item.product_id)
-    )
-    existing = cur.fetchone()
+    return {"message": "Item added to cart"}
+
+@app.post("/cart/batch")
+async def batch_update_cart(batch: CartBatch, payload: dict = Depends(verify_token)):
+    # Re-order, guest cart merge at login, etc.: all operations or none
+    if len(batch.operations) > MAX_BATCH_OPERATIONS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_OPERATIONS} operations per batch")
+    for operation in batch.operations:
+        if operation.op == "add" and operation.quantity <= 0:
+            raise HTTPException(status_code=400, detail="Quantity to add must be positive")
+    adds, sets, removes = fold_operations(batch.operations)
     
-    if existing:
-        # Update quantity
-        new_quantity = existing["quantity"] + item.quantity
-        cur.execute(
-            "UPDATE cart_items SET quantity = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s",
-            (new_quantity, existing["id"])
-        )
-    else:
-        # Insert new item
+    # One lookup validates every product being added or set
+    product_ids = set(adds) | set(sets)
+    products = await get_products_batch(product_ids) if product_ids else {}
+    if products is None:
+        raise HTTPException(status_code=503, detail="Product service unavailable")
+    missing = sorted(product_ids - set(products))
+    if missing:
+        raise HTTPException(status_code=404, detail={"message": "Products not found", "product_ids": missing})
+    
+    conn = get_db_connection()
+    cur = conn.cursor()
+    if adds:
+        upsert_items(cur, payload["user_id"], adds, products, add=True)
+    if sets:
+        upsert_items(cur, payload["user_id"], sets, products, add=False)
+    if removes:
         cur.execute(
-            "INSERT INTO cart_items (user_id, product_id, quantity) VALUES (%s, %s, %s)",
-            (payload["user_id"], item.product_id, item.quantity)
+            "DELETE FROM cart_items WHERE user_id = %s AND product_id = ANY(%s)",
+            (payload["user_id"], list(removes))
         )
-    
     conn.commit()
     cur.close()
     conn.close()
     
-    return {"message": "Item added to cart"}
+    return {"message": "Cart updated", "added": len(adds), "set": len(sets), "removed": len(removes)}
 
 @app.put("/cart/{item_id}")
 async def update_cart_item(item_id: int, update: CartItemUpdate, payload: dict = Depends(verify_token)):
@@ -221,10 +552,7 @@ async def clear_cart(payload: dict = Depends(verify_token)):
 async def get_cart_count(payload: dict = Depends(verify_token)):
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute(
-        "SELECT COALESCE(SUM(quantity), 0) as count FROM cart_items WHERE user_id = %s",
-        (payload["user_id"],)
-    )
+    execute_prepared(cur, CART_COUNT, (payload["user_id"],))
     result = cur.fetchone()
     cur.close()
     conn.close()
@@ -232,5 +560,6 @@ async def get_cart_count(payload: dict = Depends(verify_token)):
     return {"count": int(result["count"])}
 
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    import sys
+    from .serve import Launcher
+    sys.exit(Launcher().run())
@@ -0,0 +1,248 @@
+"""Admission control: per-client rate limiting and priority load shedding.
+
+Each request is put in a route class by the service's `classify` function.
+A class has a token bucket per client (user id from the bearer token, else
+client IP); an empty bucket answers 429 with Retry-After. The client IP is
+the nearest address, walking back from the connection through X-Real-IP and
+X-Forwarded-For, that is not in TRUSTED_PROXIES, so headers a client sends
+itself are never believed. Admitted requests
+then take one of a fixed number of concurrency slots, standing in for DB
+connections. Lower-priority classes may only use part of the slots and give
+up waiting sooner. Once the average slot wait passes the threshold they are
+shed with 503 right away, so checkout and payment keep the capacity.
+"""
+import asyncio
+import heapq
+import ipaddress
+import itertools
+import math
+import os
+import time
+
+import jwt
+from starlette.responses import JSONResponse
+
+from .compression import route_path
+
+# Lower number = more important = shed last
+CRITICAL = 0
+NORMAL = 1
+BROWSE = 2
+
+SLOT_SHARE = {CRITICAL: 1.0, NORMAL: 0.8, BROWSE: 0.6}
+WAIT_SHARE = {CRITICAL: 1.0, NORMAL: 0.5, BROWSE: 0.25}
+
+# Proxies whose X-Real-IP / X-Forwarded-For are believed: the ingress and the
+# frontend nginx, which are on the cluster network
+DEFAULT_TRUSTED_PROXIES = "127.0.0.0/8,::1/128,10.0.0.0/8,172.16.0.0/12,192.168.0.0/16"
+
+
+class RouteClass:
+    def __init__(self, name, rate=None, burst=None, priority=NORMAL):
+        # RATE_LIMITS="search=5/20,cart=5/20" overrides rate/burst per class
+        for spec in os.environ.get("RATE_LIMITS", "").split(","):
+            key, _, value = spec.strip().partition("=")
+            if key == name and value:
+                rate, _, burst = value.partition("/")
+                rate, burst = float(rate), float(burst or rate)
+        self.name = name
+        self.rate = rate  # tokens per second; None means no rate limit
+        self.burst = burst if burst is not None else rate
+        self.priority = priority
+
+
+class TokenBuckets:
+    def __init__(self, max_clients=100000):
+        self.max_clients = max_clients
+        self._buckets = {}  # (class name, client) -> (tokens, last refill)
+
+    def take(self, route_class, client):
+        """Take a token; return 0 when allowed, else seconds until the next one."""
+        now = time.monotonic()
+        key = (route_class.name, client)
+        tokens, last = self._buckets.get(key, (route_class.burst, now))
+        tokens = min(route_class.burst, tokens + (now - last) * route_class.rate)
+        if tokens < 1:
+            self._buckets[key] = (tokens, now)
+            return (1 - tokens) / route_class.rate
+        if key not in self._buckets and len(self._buckets) >= self.max_clients:
+            self._prune(now)
+        self._buckets[key] = (tokens - 1, now)
+        return 0
+
+    def _prune(self, now):
+        # Drop clients idle long enough that their bucket would be full again;
+        # if none qualify, drop the oldest half
+        idle = [k for k, (_, last) in self._buckets.items() if now - last > 60]
+        if not idle:
+            idle = sorted(self._buckets, key=lambda k: self._buckets[k][1])[: len(self._buckets) // 2]
+        for key in idle:
+            del self._buckets[key]
+
+
+class ConcurrencyLimiter:
+    def __init__(self, limit, max_wait, shed_wait):
+        self.limit = limit
+        self.max_wait = max_wait
+        self.shed_wait = shed_wait
+        self.in_flight = 0
+        self.avg_wait = 0.0  # EWMA of slot wait, in seconds
+        self.shed = 0
+        self._waiters = []  # heap of (priority, seq, future)
+        self._seq = itertools.count()
+
+    def _fits(self, priority):
+        return self.in_flight < max(1, int(self.limit * SLOT_SHARE[priority]))
+
+    async def acquire(self, priority):
+        """Take a slot; return False when the request should be shed."""
+        self._wake()
+        if self._fits(priority) and (not self._waiters or priority < self._waiters[0][0]):
+            self.in_flight += 1
+            self._record(0.0)
+            return True
+        # No free slot: when waits have been long, don't queue behind them
+        if priority != CRITICAL and self.avg_wait > self.shed_wait * WAIT_SHARE[priority]:
+            self.shed += 1
+            return False
+
+        start = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._seq), future)
+        heapq.heappush(self._waiters, entry)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.max_wait * WAIT_SHARE[priority])
+        except asyncio.TimeoutError:
+            if not future.done():
+                future.cancel()
+                self._record(time.monotonic() - start)
+                self.shed += 1
+                return False
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()  # slot was granted as the client went away
+            else:
+                future.cancel()
+            raise
+        self._record(time.monotonic() - start)
+        return True
+
+    def release(self):
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        while self._waiters:
+            priority, _, future = self._waiters[0]
+            if future.done():  # timed out or cancelled
+                heapq.heappop(self._waiters)
+                continue
+            if not self._fits(priority):
+                return
+            heapq.heappop(self._waiters)
+            self.in_flight += 1
+            future.set_result(None)
+
+    def _record(self, wait):
+        self.avg_wait = 0.9 * self.avg_wait + 0.1 * wait
+
+    def snapshot(self):
+        return {
+            "in_flight": self.in_flight,
+            "waiting": sum(1 for _, _, f in self._waiters if not f.done()),
+            "avg_wait_ms": round(self.avg_wait * 1000, 3),
+            "shed": self.shed,
+        }
+
+
+def parse_networks(spec):
+    return [ipaddress.ip_network(part.strip(), strict=False) for part in spec.split(",") if part.strip()]
+
+
+def is_trusted(address, networks):
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in networks)
+
+
+def client_address(scope, headers, trusted):
+    # Hops from the client to us: X-Forwarded-For (appended by each proxy),
+    # X-Real-IP (set by the frontend nginx to its peer), then our own peer.
+    # The left end is whatever the client sent, so it is only reached when
+    # every hop after it is a trusted proxy
+    chain = [hop.strip() for hop in headers.get(b"x-forwarded-for", b"").decode("latin-1").split(",") if hop.strip()]
+    real_ip = headers.get(b"x-real-ip", b"").decode("latin-1").strip()
+    if real_ip:
+        chain.append(real_ip)
+    client = scope.get("client")
+    if client:
+        chain.append(client[0])
+    for address in reversed(chain):
+        if not is_trusted(address, trusted):
+            return address
+    return chain[0] if chain else "unknown"
+
+
+def client_identity(scope, jwt_secret, trusted=()):
+    headers = dict(scope["headers"])
+    authorization = headers.get(b"authorization", b"").decode("latin-1")
+    if authorization.lower().startswith("bearer "):
+        try:
+            payload = jwt.decode(authorization[7:], jwt_secret, algorithms=["HS256"])
+            return f"user:{payload['user_id']}"
+        except (jwt.PyJWTError, KeyError):
+            pass
+    return f"ip:{client_address(scope, headers, trusted)}"
+
+
+class AdmissionMiddleware:
+    def __init__(self, app, classify, jwt_secret, limiter=None, trusted_proxies=None):
+        self.app = app
+        self.classify = classify
+        self.jwt_secret = jwt_secret
+        self.buckets = TokenBuckets()
+        self.limiter = limiter or admission_limiter()
+        if trusted_proxies is None:
+            trusted_proxies = parse_networks(os.environ.get("TRUSTED_PROXIES", DEFAULT_TRUSTED_PROXIES))
+        self.trusted_proxies = trusted_proxies
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        route_class = self.classify(scope["method"], route_path(scope), scope["query_string"].decode("latin-1"))
+        if route_class is None:
+            await self.app(scope, receive, send)
+            return
+
+        if route_class.rate:
+            retry_after = self.buckets.take(route_class, client_identity(scope, self.jwt_secret, self.trusted_proxies))
+            if retry_after:
+                response = JSONResponse(
+                    {"detail": "Too many requests"}, status_code=429,
+                    headers={"Retry-After": str(math.ceil(retry_after))}
+                )
+                await response(scope, receive, send)
+                return
+
+        if not await self.limiter.acquire(route_class.priority):
+            response = JSONResponse(
+                {"detail": "Service busy, please retry"}, status_code=503,
+                headers={"Retry-After": str(max(1, math.ceil(self.limiter.avg_wait)))}
+            )
+            await response(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.limiter.release()
+
+
+def admission_limiter():
+    return ConcurrencyLimiter(
+        limit=int(os.environ.get("ADMISSION_MAX_CONCURRENCY", "32")),
+        max_wait=float(os.environ.get("ADMISSION_MAX_WAIT_SECONDS", "5")),
+        shed_wait=float(os.environ.get("ADMISSION_SHED_WAIT_SECONDS", "1")),
+    )
@@ -0,0 +1,313 @@
+"""Incremental sales analytics.
+
+Daily rollups (sales, orders per status, units and revenue per product) are
+maintained by statement-level triggers on `orders`: inserted orders add their
+contribution, and updated orders subtract the old rows' and add the new ones',
+so payment and status changes move the numbers. Each statement is aggregated
+before it touches the rollups, so bulk writes update each counter row once.
+Rows are spread over a few shards per day so concurrent checkouts don't all
+queue on one counter row.
+
+Orders that existed before the trigger was installed (id <= cutoff_id) are
+counted by the backfill, one id range at a time; the trigger only tracks an
+old order once the backfill has passed it, so every order is counted once.
+"""
+import asyncio
+
+SHARDS = 8
+DEFAULT_BATCH_SIZE = 1000
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS analytics_daily_sales (
+        day DATE NOT NULL,
+        shard SMALLINT NOT NULL,
+        orders INTEGER NOT NULL DEFAULT 0,
+        revenue DECIMAL(14, 2) NOT NULL DEFAULT 0,
+        items INTEGER NOT NULL DEFAULT 0,
+        paid_orders INTEGER NOT NULL DEFAULT 0,
+        paid_revenue DECIMAL(14, 2) NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, shard)
+    );
+
+    CREATE TABLE IF NOT EXISTS analytics_daily_status (
+        day DATE NOT NULL,
+        shard SMALLINT NOT NULL,
+        order_status VARCHAR(50) NOT NULL,
+        orders INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, order_status, shard)
+    );
+
+    CREATE TABLE IF NOT EXISTS analytics_daily_products (
+        day DATE NOT NULL,
+        shard SMALLINT NOT NULL,
+        product_id INTEGER NOT NULL,
+        product_name VARCHAR(255),
+        quantity INTEGER NOT NULL DEFAULT 0,
+        revenue DECIMAL(14, 2) NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, product_id, shard)
+    );
+
+    CREATE TABLE IF NOT EXISTS analytics_state (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        cutoff_id INTEGER NOT NULL,
+        backfilled_through INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+
+    CREATE OR REPLACE FUNCTION analytics_order_items(items JSONB)
+    RETURNS TABLE (product_id INTEGER, product_name TEXT, quantity INTEGER, revenue DECIMAL) AS $$
+        SELECT (item->>'product_id')::int,
+               COALESCE(item->'product'->>'name', item->>'name'),
+               (item->>'quantity')::int,
+               COALESCE(
+                   (item->>'item_total')::decimal,
+                   (item->'product'->>'price')::decimal * (item->>'quantity')::int,
+                   0
+               )
+        FROM jsonb_array_elements(items) AS item
+    $$ LANGUAGE sql IMMUTABLE;
+
+    -- Orders at or below cutoff_id predate the trigger; they are tracked only
+    -- once the backfill has counted them
+    CREATE OR REPLACE FUNCTION analytics_tracked(order_id INTEGER) RETURNS BOOLEAN AS $$
+        SELECT COALESCE(order_id > cutoff_id OR order_id <= backfilled_through, TRUE)
+        FROM analytics_state WHERE id = 1
+    $$ LANGUAGE sql STABLE;
+
+    -- Add (sign = 1) or remove (sign = -1) the contribution of a set of orders.
+    -- Everything is aggregated first, so a bulk statement touches each
+    -- counter row once instead of once per order
+    CREATE OR REPLACE FUNCTION analytics_add_totals(rows orders[], sign INTEGER) RETURNS void AS $$
+    BEGIN
+        INSERT INTO analytics_daily_status AS s (day, shard, order_status, orders)
+        SELECT o.created_at::date, o.id % {shards}, o.order_status, sign * COUNT(*)
+        FROM unnest(rows) o GROUP BY 1, 2, 3
+        ON CONFLICT (day, order_status, shard) DO UPDATE SET orders = s.orders + EXCLUDED.orders;
+
+        INSERT INTO analytics_daily_sales AS s (day, shard, orders, revenue, items, paid_orders, paid_revenue)
+        SELECT o.created_at::date, o.id % {shards}, sign * COUNT(*), sign * SUM(o.total),
+               sign * COALESCE(SUM((SELECT SUM(i.quantity) FROM analytics_order_items(o.items) i)), 0),
+               sign * COUNT(*) FILTER (WHERE o.payment_status = 'completed'),
+               sign * COALESCE(SUM(o.total) FILTER (WHERE o.payment_status = 'completed'), 0)
+        FROM unnest(rows) o WHERE o.order_status <> 'cancelled' GROUP BY 1, 2
+        ON CONFLICT (day, shard) DO UPDATE SET
+            orders = s.orders + EXCLUDED.orders,
+            revenue = s.revenue + EXCLUDED.revenue,
+            items = s.items + EXCLUDED.items,
+            paid_orders = s.paid_orders + EXCLUDED.paid_orders,
+            paid_revenue = s.paid_revenue + EXCLUDED.paid_revenue;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION analytics_add_products(rows orders[], sign INTEGER) RETURNS void AS $$
+        INSERT INTO analytics_daily_products AS s (day, shard, product_id, product_name, quantity, revenue)
+        SELECT o.created_at::date, o.id % {shards}, i.product_id, MAX(i.product_name),
+               sign * SUM(i.quantity), sign * SUM(i.revenue)
+        FROM unnest(rows) o, analytics_order_items(o.items) i
+        WHERE o.order_status <> 'cancelled'
+        GROUP BY 1, 2, 3
+        ON CONFLICT (day, product_id, shard) DO UPDATE SET
+            product_name = COALESCE(EXCLUDED.product_name, s.product_name),
+            quantity = s.quantity + EXCLUDED.quantity,
+            revenue = s.revenue + EXCLUDED.revenue;
+    $$ LANGUAGE sql;
+
+    -- Statement-level triggers: the transition tables hold every row the
+    -- statement inserted or updated
+    CREATE OR REPLACE FUNCTION analytics_track_inserts() RETURNS trigger AS $$
+    DECLARE
+        added orders[] := ARRAY(SELECT n FROM new_orders n WHERE analytics_tracked(n.id));
+    BEGIN
+        PERFORM analytics_add_totals(added, 1);
+        PERFORM analytics_add_products(added, 1);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION analytics_changed(o orders, n orders) RETURNS BOOLEAN AS $$
+        SELECT (o.order_status, o.payment_status, o.total, o.items, o.created_at)
+               IS DISTINCT FROM (n.order_status, n.payment_status, n.total, n.items, n.created_at)
+    $$ LANGUAGE sql IMMUTABLE;
+
+    CREATE OR REPLACE FUNCTION analytics_products_changed(o orders, n orders) RETURNS BOOLEAN AS $$
+        SELECT o.items IS DISTINCT FROM n.items
+               OR o.created_at IS DISTINCT FROM n.created_at
+               OR (o.order_status = 'cancelled') <> (n.order_status = 'cancelled')
+    $$ LANGUAGE sql IMMUTABLE;
+
+    CREATE OR REPLACE FUNCTION analytics_track_updates() RETURNS trigger AS $$
+    DECLARE
+        before orders[] := ARRAY(
+            SELECT o FROM old_orders o JOIN new_orders n ON n.id = o.id
+            WHERE analytics_changed(o, n) AND analytics_tracked(n.id)
+        );
+        after orders[] := ARRAY(
+            SELECT n FROM old_orders o JOIN new_orders n ON n.id = o.id
+            WHERE analytics_changed(o, n) AND analytics_tracked(n.id)
+        );
+        before_items orders[] := ARRAY(
+            SELECT o FROM old_orders o JOIN new_orders n ON n.id = o.id
+            WHERE analytics_products_changed(o, n) AND analytics_tracked(n.id)
+        );
+        after_items orders[] := ARRAY(
+            SELECT n FROM old_orders o JOIN new_orders n ON n.id = o.id
+            WHERE analytics_products_changed(o, n) AND analytics_tracked(n.id)
+        );
+    BEGIN
+        PERFORM analytics_add_totals(before, -1);
+        PERFORM analytics_add_totals(after, 1);
+        PERFORM analytics_add_products(before_items, -1);
+        PERFORM analytics_add_products(after_items, 1);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION analytics_backfill(after_id INTEGER, upto_id INTEGER)
+    RETURNS INTEGER AS $$
+    DECLARE
+        -- Lock the rows so status updates wait until the range is counted
+        batch orders[] := ARRAY(
+            SELECT o FROM orders o WHERE o.id > after_id AND o.id <= upto_id ORDER BY o.id FOR UPDATE
+        );
+    BEGIN
+        PERFORM analytics_add_totals(batch, 1);
+        PERFORM analytics_add_products(batch, 1);
+        UPDATE analytics_state SET backfilled_through = upto_id, updated_at = CURRENT_TIMESTAMP WHERE id = 1;
+        RETURN cardinality(batch);
+    END;
+    $$ LANGUAGE plpgsql;
+""".replace("{shards}", str(SHARDS))
+
+TRIGGER = """
+    DROP TRIGGER IF EXISTS orders_analytics ON orders;
+    DROP FUNCTION IF EXISTS analytics_track_order();
+    DROP FUNCTION IF EXISTS analytics_apply(orders, INTEGER, BOOLEAN);
+
+    CREATE OR REPLACE TRIGGER orders_analytics_insert
+        AFTER INSERT ON orders REFERENCING NEW TABLE AS new_orders
+        FOR EACH STATEMENT EXECUTE FUNCTION analytics_track_inserts();
+
+    CREATE OR REPLACE TRIGGER orders_analytics_update
+        AFTER UPDATE ON orders REFERENCING OLD TABLE AS old_orders NEW TABLE AS new_orders
+        FOR EACH STATEMENT EXECUTE FUNCTION analytics_track_updates();
+"""
+
+
+def install(conn):
+    cur = conn.cursor()
+    # Replicas starting together would otherwise race on CREATE OR REPLACE
+    cur.execute("SELECT pg_advisory_xact_lock(hashtext('analytics_schema'))")
+    cur.execute(SCHEMA)
+    cur.execute("SELECT 1 FROM analytics_state WHERE id = 1")
+    if cur.fetchone() is None:
+        # Hold off order writes while the cutoff is taken and the trigger is
+        # created, so each order is counted by exactly one of the two paths
+        cur.execute("LOCK TABLE orders IN SHARE ROW EXCLUSIVE MODE")
+        cur.execute("""
+            INSERT INTO analytics_state (id, cutoff_id)
+            SELECT 1, COALESCE(MAX(id), 0) FROM orders
+        """)
+    cur.execute(TRIGGER)
+    conn.commit()
+    cur.close()
+
+
+def backfill_state(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT cutoff_id, backfilled_through, updated_at FROM analytics_state WHERE id = 1")
+    state = cur.fetchone()
+    cur.close()
+    return state
+
+
+def backfill_batch(conn, batch_size=DEFAULT_BATCH_SIZE):
+    """Count the next range of pre-trigger orders; return False once done."""
+    cur = conn.cursor()
+    cur.execute("SELECT cutoff_id, backfilled_through FROM analytics_state WHERE id = 1 FOR UPDATE")
+    state = cur.fetchone()
+    if state["backfilled_through"] >= state["cutoff_id"]:
+        conn.rollback()
+        cur.close()
+        return False
+    upto = min(state["backfilled_through"] + batch_size, state["cutoff_id"])
+    cur.execute("SELECT analytics_backfill(%s, %s)", (state["backfilled_through"], upto))
+    conn.commit()
+    cur.close()
+    return True
+
+
+async def run_backfill(connect, batch_size=DEFAULT_BATCH_SIZE, pause=0.05):
+    """Backfill in short transactions, yielding between batches."""
+    def step():
+        conn = connect()
+        try:
+            return backfill_batch(conn, batch_size)
+        finally:
+            conn.close()
+
+    while True:
+        try:
+            if not await asyncio.to_thread(step):
+                return
+        except Exception as e:
+            print(f"Analytics backfill error: {e}")
+            await asyncio.sleep(5)
+            continue
+        await asyncio.sleep(pause)
+
+
+def date_range(since, until):
+    clauses, params = [], []
+    if since:
+        clauses.append("day >= %s")
+        params.append(since)
+    if until:
+        clauses.append("day < %s")
+        params.append(until)
+    return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+
+def daily_sales(conn, since, until):
+    where, params = date_range(since, until)
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT day, SUM(orders) AS orders, SUM(revenue) AS revenue, SUM(items) AS items,
+               SUM(paid_orders) AS paid_orders, SUM(paid_revenue) AS paid_revenue
+        FROM analytics_daily_sales{where}
+        GROUP BY day ORDER BY day
+    """, params)
+    days = [dict(row) for row in cur.fetchall()]
+    cur.close()
+    for day in days:
+        day["avg_order_value"] = round(day["revenue"] / day["orders"], 2) if day["orders"] else None
+        day["avg_basket_size"] = round(day["items"] / day["orders"], 2) if day["orders"] else None
+    return days
+
+
+def orders_by_status(conn, since, until):
+    where, params = date_range(since, until)
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT order_status, SUM(orders) AS orders
+        FROM analytics_daily_status{where}
+        GROUP BY order_status HAVING SUM(orders) <> 0 ORDER BY orders DESC
+    """, params)
+    statuses = {row["order_status"]: row["orders"] for row in cur.fetchall()}
+    cur.close()
+    return statuses
+
+
+def top_products(conn, since, until, limit, by):
+    where, params = date_range(since, until)
+    order_by = "revenue" if by == "revenue" else "quantity"
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT product_id, MAX(product_name) AS product_name,
+               SUM(quantity) AS quantity, SUM(revenue) AS revenue
+        FROM analytics_daily_products{where}
+        GROUP BY product_id HAVING SUM(quantity) > 0
+        ORDER BY {order_by} DESC LIMIT %s
+    """, params + [limit])
+    products = [dict(row) for row in cur.fetchall()]
+    cur.close()
+    return products
@@ -1,19 +1,53 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
-from typing import Optional, List
+from typing import Optional, List, Union
 import psycopg2
-from psycopg2.extras import RealDictCursor
 import os
 import jwt
 import time
 import httpx
 import uuid
-from datetime import datetime
+from datetime import date, datetime, timedelta
 import json
+import orjson
+import asyncio
+from decimal import Decimal
 
-app = FastAPI(title="Order Service", version="1.0.0")
+from . import analytics, partitions
+from .admission import AdmissionMiddleware, RouteClass, admission_limiter, BROWSE, CRITICAL, NORMAL
+from .compression import CompressionMiddleware, CompressionStats
+from .querylog import QueryLogMiddleware, query_logger
+from .pool import ConnectionPool, PooledConnection, Statement, execute_prepared
+from .export import date_filter, export_response
+from .recommendations import AlsoBought
+from .saga import Checkout, CheckoutFailed, ProductUnavailable, RECORD_PAYMENT, SCHEMA as CHECKOUT_SCHEMA, order_totals
+
+def json_default(value):
+    # Same as jsonable_encoder: integral Decimals become int, the rest float
+    if isinstance(value, Decimal):
+        return int(value) if value.as_tuple().exponent >= 0 else float(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+def dumps_json(content) -> bytes:
+    return orjson.dumps(content, default=json_default, option=orjson.OPT_NON_STR_KEYS)
+
+class FastJSONResponse(JSONResponse):
+    # orjson encodes rows (datetimes included) straight to bytes; hot routes
+    # return this directly so FastAPI skips the generic jsonable_encoder pass
+    def render(self, content) -> bytes:
+        return dumps_json(content)
+
+class DuplexStreamingResponse(StreamingResponse):
+    # StreamingResponse listens on receive() for a disconnect, which would
+    # swallow the request body the endpoint is still reading; a client that
+    # goes away shows up as ClientDisconnect from request.stream() instead
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+
+app = FastAPI(title="Order Service", version="1.0.0", default_response_class=FastJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -23,13 +57,73 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+compression_stats = CompressionStats()
+app.add_middleware(CompressionMiddleware, stats=compression_stats)
+
 security = HTTPBearer()
 JWT_SECRET = os.environ.get("JWT_SECRET", "ecommerce-secret-key-2024")
 CART_SERVICE_URL = os.environ.get("CART_SERVICE_URL", "http://cart-service:8000")
 PAYMENT_SERVICE_URL = os.environ.get("PAYMENT_SERVICE_URL", "http://payment-service:8000")
 PRODUCT_SERVICE_URL = os.environ.get("PRODUCT_SERVICE_URL", "http://product-service:8000")
+ANALYTICS_BACKFILL_BATCH = int(os.environ.get("ANALYTICS_BACKFILL_BATCH", "1000"))
+RECOMMENDATIONS_TOP_K = int(os.environ.get("RECOMMENDATIONS_TOP_K", "20"))
+RECOMMENDATIONS_POLL_SECONDS = float(os.environ.get("RECOMMENDATIONS_POLL_SECONDS", "5"))
+RECOMMENDATIONS_REBUILD_SECONDS = float(os.environ.get("RECOMMENDATIONS_REBUILD_SECONDS", "21600"))
+BULK_STATUS_MAX = int(os.environ.get("BULK_STATUS_MAX", "10000"))
+BULK_STATUS_CHUNK = int(os.environ.get("BULK_STATUS_CHUNK", "1000"))
+# Months of orders kept in the live table; older ones are archived to
+# ARCHIVE_DIR (0 keeps everything)
+ARCHIVE_AFTER_MONTHS = int(os.environ.get("ARCHIVE_AFTER_MONTHS", "0"))
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "/data/archive")
+# A checkout waits this long for its payment before answering "pending";
+# sagas that have not moved for CHECKOUT_RECOVERY_AFTER_SECONDS are finished
+# or compensated by the recovery loop, so it must be longer
+CHECKOUT_PAYMENT_TIMEOUT = float(os.environ.get("CHECKOUT_PAYMENT_TIMEOUT_SECONDS", "40"))
+CHECKOUT_RECOVERY_AFTER = float(os.environ.get("CHECKOUT_RECOVERY_AFTER_SECONDS", "60"))
+CHECKOUT_RECOVERY_INTERVAL = float(os.environ.get("CHECKOUT_RECOVERY_INTERVAL_SECONDS", "10"))
+CHECKOUT_WAIT_MAX = 25.0
+ADMIN_EMAILS = {e.strip().lower() for e in os.environ.get("ADMIN_EMAILS", "").split(",") if e.strip()}
 
-def get_db_connection():
+# Transports keyed by service URL; monolith mode mounts in-process ASGI apps here
+SERVICE_TRANSPORTS = {}
+
+def service_client():
+    return httpx.AsyncClient(mounts=SERVICE_TRANSPORTS)
+
+# Admission control: placing and paying for orders is shed last
+CHECKOUT = RouteClass("checkout", rate=1, burst=5, priority=CRITICAL)
+PAYMENT_CALLBACK = RouteClass("payment_callback", rate=2, burst=10, priority=CRITICAL)
+ORDER_READ = RouteClass("order_read", rate=10, burst=30, priority=NORMAL)
+ORDER_WRITE = RouteClass("order_write", rate=5, burst=10, priority=NORMAL)
+EXPORT = RouteClass("export", rate=0.1, burst=2, priority=BROWSE)
+BULK_STATUS = RouteClass("bulk_status", rate=0.5, burst=5, priority=NORMAL)
+RECOMMENDATIONS = RouteClass("recommendations", rate=20, burst=60, priority=BROWSE)
+
+def classify_request(method, path, query):
+    if path == "/health" or path.startswith("/debug/"):
+        return None
+    if method == "POST" and path in ("/orders", "/checkout"):
+        return CHECKOUT
+    if path.endswith("/payment"):
+        return PAYMENT_CALLBACK
+    if path == "/orders/export" or path.startswith("/orders/archive"):
+        return EXPORT
+    if path.startswith("/orders/status/bulk"):
+        return BULK_STATUS
+    if path.startswith("/products/"):
+        return RECOMMENDATIONS
+    if method == "GET":
+        return ORDER_READ
+    return ORDER_WRITE
+
+admission = admission_limiter()
+app.add_middleware(AdmissionMiddleware, classify=classify_request, jwt_secret=JWT_SECRET, limiter=admission)
+
+# Times every statement by shape; slow ones are logged and sampled for EXPLAIN
+query_log = query_logger()
+app.add_middleware(QueryLogMiddleware)
+
+def open_db_connection():
     max_retries = 5
     for i in range(max_retries):
         try:
@@ -39,7 +133,8 @@ def get_db_connection():
                 database=os.environ.get("DB_NAME", "orderdb"),
                 user=os.environ.get("DB_USER", "postgres"),
                 password=os.environ.get("DB_PASSWORD", "postgres123"),
-                cursor_factory=RealDictCursor
+                connection_factory=PooledConnection,
+                cursor_factory=query_log.cursor_factory
             )
             return conn
         except psycopg2.OperationalError:
@@ -48,14 +143,31 @@ def get_db_connection():
             else:
                 raise
 
+# Requests reuse idle connections and the statements prepared on them;
+# anything that keeps session state (LISTEN, advisory locks) opens its own
+db_pool = ConnectionPool(
+    open_db_connection,
+    size=int(os.environ.get("DB_POOL_SIZE", "10")),
+    max_age=float(os.environ.get("DB_POOL_MAX_AGE_SECONDS", "1800")),
+)
+
+def get_db_connection():
+    return db_pool.get()
+
+also_bought = AlsoBought(get_db_connection, top_k=RECOMMENDATIONS_TOP_K)
+
 def init_db():
     try:
-        conn = get_db_connection()
+        conn = open_db_connection()
         cur = conn.cursor()
-        cur.execute("""
+        # Workers and replicas starting together would otherwise race on the DDL
+        cur.execute("SELECT pg_advisory_lock(hashtext('schema:order-service'))")
+        # Partitioned by month of created_at, so keys include it; order_id is
+        # kept unique across partitions by the order_ids key table
+        partitions.install(cur, "orders", """
             CREATE TABLE IF NOT EXISTS orders (
-                id SERIAL PRIMARY KEY,
-                order_id VARCHAR(50) UNIQUE NOT NULL,
+                id INTEGER NOT NULL DEFAULT nextval('orders_id_seq'),
+                order_id VARCHAR(50) NOT NULL,
                 user_id INTEGER NOT NULL,
                 items JSONB NOT NULL,
                 subtotal DECIMAL(10, 2) NOT NULL,
@@ -66,12 +178,23 @@ def init_db():
                 payment_status VARCHAR(50) DEFAULT 'pending',
                 order_status VARCHAR(50) DEFAULT 'pending',
                 payment_id VARCHAR(100),
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
+                paid_at TIMESTAMP,
+                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (id, created_at),
+                UNIQUE (order_id, created_at)
+            ) PARTITION BY RANGE (created_at)
         """)
+        partitions.unique_key(cur, "orders", "order_id")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_created ON orders (user_id, created_at DESC)")
+        # paid_at is set once, when the payment completes; recommendations
+        # follow it as a watermark so each paid order is counted once
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_paid_at ON orders (paid_at) WHERE paid_at IS NOT NULL")
+        cur.execute("UPDATE orders SET paid_at = updated_at WHERE payment_status = 'completed' AND paid_at IS NULL")
+        cur.execute(CHECKOUT_SCHEMA)
         conn.commit()
         cur.close()
+        analytics.install(conn)
         conn.close()
         print("Order database initialized successfully")
     except Exception as e:
@@ -80,6 +203,23 @@ def init_db():
 @app.on_event("startup")
 async def startup():
     init_db()
+    app.state.analytics_backfill = asyncio.create_task(
+        analytics.run_backfill(get_db_connection, ANALYTICS_BACKFILL_BATCH)
+    )
+    app.state.also_bought = asyncio.create_task(
+        also_bought.run(RECOMMENDATIONS_POLL_SECONDS, RECOMMENDATIONS_REBUILD_SECONDS)
+    )
+    app.state.partitions = asyncio.create_task(
+        partitions.run(open_db_connection, "orders", ARCHIVE_AFTER_MONTHS, ARCHIVE_DIR)
+    )
+    app.state.checkout_recovery = asyncio.create_task(checkout.run())
+
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.analytics_backfill.cancel()
+    app.state.also_bought.cancel()
+    app.state.partitions.cancel()
+    app.state.checkout_recovery.cancel()
 
 class ShippingAddress(BaseModel):
     full_name: str
@@ -92,6 +232,22 @@ class ShippingAddress(BaseModel):
 class CreateOrder(BaseModel):
     shipping_address: ShippingAddress
 
+class CheckoutRequest(BaseModel):
+    shipping_address: ShippingAddress
+    payment_method: str  # credit_card, debit_card, upi, net_banking
+    card_number: Optional[str] = None
+    card_holder_name: Optional[str] = None
+    expiry_date: Optional[str] = None
+    cvv: Optional[str] = None
+    upi_id: Optional[str] = None
+
+class StatusTransition(BaseModel):
+    order_id: str
+    status: str
+
+class BulkStatusUpdate(BaseModel):
+    transitions: List[StatusTransition]
+
 def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
     try:
         payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=["HS256"])
@@ -101,18 +257,247 @@ def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+def verify_admin(payload: dict = Depends(verify_token)):
+    # Cross-user reads such as exports are limited to ADMIN_EMAILS
+    if payload.get("email", "").lower() not in ADMIN_EMAILS:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return payload
+
+def verify_service(payload: dict = Depends(verify_token)):
+    # Only tokens minted by another service carry "service"; user tokens
+    # from the user service never do
+    if not payload.get("service"):
+        raise HTTPException(status_code=403, detail="Service access required")
+    return payload
+
+# Orders change only through payment/status updates, which bump updated_at
+ORDER_VERSION = "(EXTRACT(EPOCH FROM updated_at) * 1000000)::bigint"
+ORDER_CACHE_CONTROL = "private, no-cache"
+
+# Hot fixed reads, prepared once per connection; the orders partitions make
+# planning these comparatively expensive
+USER_ORDERS = Statement("user_orders", """
+    SELECT order_id, items, subtotal, shipping_cost, tax, total,
+           shipping_address, payment_status, order_status, created_at
+    FROM orders WHERE user_id = $1 ORDER BY created_at DESC
+""", ("integer",))
+ORDER_VERSION_BY_ID = Statement(
+    "order_version_by_id", f"SELECT {ORDER_VERSION} AS version FROM orders WHERE order_id = $1 AND user_id = $2",
+    ("text", "integer")
+)
+ORDER_BY_ID = Statement("order_by_id", f"""
+    SELECT order_id, items, subtotal, shipping_cost, tax, total,
+           shipping_address, payment_status, order_status, payment_id, created_at,
+           {ORDER_VERSION} AS version
+    FROM orders WHERE order_id = $1 AND user_id = $2
+""", ("text", "integer"))
+
+def order_etag(order_id: str, version: int):
+    return f'"{order_id}-{version}"'
+
+# Fulfillment only moves orders forward: target status -> statuses it can follow
+ORDER_TRANSITIONS = {
+    "confirmed": ["pending"],
+    "processing": ["confirmed"],
+    "shipped": ["confirmed", "processing"],
+    "delivered": ["shipped"],
+    "cancelled": ["pending", "confirmed", "processing"],
+}
+
+# Every order of a batch is locked up front, in order_id order, before any
+# per-status UPDATE runs; locking per status group would take the locks of
+# two batches in opposite orders, e.g. [X->shipped, Y->delivered] against
+# [Y->shipped, X->delivered]
+LOCK_ORDERS = """
+    SELECT order_id FROM orders WHERE order_id = ANY(%s::varchar[]) ORDER BY order_id FOR UPDATE
+"""
+
+TRANSITION_ORDERS = """
+    WITH requested AS (
+        SELECT unnest(%(order_ids)s::varchar[]) AS order_id
+    ), current AS (
+        SELECT o.order_id, o.order_status FROM orders o JOIN requested r USING (order_id)
+        ORDER BY o.order_id FOR UPDATE OF o
+    ), updated AS (
+        UPDATE orders o SET order_status = %(status)s, updated_at = CURRENT_TIMESTAMP
+        FROM current c
+        WHERE o.order_id = c.order_id AND c.order_status = ANY(%(allowed)s)
+        RETURNING o.order_id
+    )
+    SELECT r.order_id, c.order_status AS previous, u.order_id IS NOT NULL AS updated
+    FROM requested r LEFT JOIN current c USING (order_id) LEFT JOIN updated u USING (order_id)
+"""
+
+def transition_result(order_id, status, previous=None, updated=False):
+    if updated:
+        result = "updated"
+    elif status not in ORDER_TRANSITIONS:
+        result = "invalid_status"
+    elif previous is None:
+        result = "not_found"
+    elif previous == status:
+        result = "unchanged"
+    else:
+        result = "rejected"
+    return {"order_id": order_id, "status": status, "previous": previous, "result": result}
+
+def apply_transitions(transitions):
+    """Apply [(order_id, status)] in one transaction, one UPDATE per target status.
+
+    Returns one result per transition, in request order; an order listed
+    more than once is only moved by its first entry.
+    """
+    by_status = {}
+    results = {}
+    for order_id, status in transitions:
+        if order_id in results:
+            continue
+        results[order_id] = None
+        if status in ORDER_TRANSITIONS:
+            by_status.setdefault(status, []).append(order_id)
+        else:
+            results[order_id] = transition_result(order_id, status)
+    
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        if by_status:
+            cur.execute(LOCK_ORDERS, ([order_id for order_ids in by_status.values() for order_id in order_ids],))
+        for status, order_ids in by_status.items():
+            cur.execute(TRANSITION_ORDERS, {
+                "order_ids": order_ids, "status": status, "allowed": ORDER_TRANSITIONS[status]
+            })
+            for row in cur.fetchall():
+                results[row["order_id"]] = transition_result(row["order_id"], status, row["previous"], row["updated"])
+        conn.commit()
+        cur.close()
+    finally:
+        conn.close()
+    
+    seen = set()
+    ordered = []
+    for order_id, status in transitions:
+        if order_id in seen:
+            ordered.append({"order_id": order_id, "status": status, "previous": None, "result": "duplicate"})
+        else:
+            seen.add(order_id)
+            ordered.append(results[order_id])
+    return ordered
+
+def parse_transition(line):
+    try:
+        transition = orjson.loads(line)
+        return str(transition["order_id"]), str(transition["status"])
+    except (orjson.JSONDecodeError, KeyError, TypeError):
+        return None
+
 def generate_order_id():
     return f"ORD-{datetime.now().strftime('%Y%m%d')}-{uuid.uuid4().hex[:8].upper()}"
 
+def service_token(user_id: int):
+    # Checkout steps taken on the user's behalf: downstream services only
+    # need the user id, and stock reservations also require "service"
+    return jwt.encode(
+        {"user_id": user_id, "service": "order-service", "exp": datetime.utcnow() + timedelta(minutes=5)},
+        JWT_SECRET, algorithm="HS256"
+    )
+
+checkout = Checkout(
+    get_db_connection,
+    service_client,
+    service_token,
+    generate_order_id,
+    CART_SERVICE_URL,
+    PRODUCT_SERVICE_URL,
+    PAYMENT_SERVICE_URL,
+    on_paid=also_bought.poke,
+    payment_timeout=CHECKOUT_PAYMENT_TIMEOUT,
+    stale_after=CHECKOUT_RECOVERY_AFTER,
+    interval=CHECKOUT_RECOVERY_INTERVAL
+)
+
+# CheckoutFailed reason -> status code
+CHECKOUT_FAILURES = {
+    "empty_cart": 400,
+    "cart_unavailable": 503,
+    "insufficient_stock": 409,
+    "product_unavailable": 400,
+    "stock_unavailable": 503,
+    "payment_failed": 400,
+    "interrupted": 409,
+}
+
+def checkout_failure(e: CheckoutFailed):
+    content = {"detail": str(e), "reason": e.reason, "order_id": e.order_id, "status": "failed"}
+    if e.shortages:
+        content["shortages"] = e.shortages
+    return FastJSONResponse(status_code=CHECKOUT_FAILURES.get(e.reason, 400), content=content)
+
 @app.get("/health")
 async def health():
     return {"status": "healthy", "service": "order-service"}
 
+@app.get("/debug/compression")
+async def compression_report(admin: dict = Depends(verify_admin)):
+    return compression_stats.snapshot()
+
+@app.get("/debug/admission")
+async def admission_report(admin: dict = Depends(verify_admin)):
+    return admission.snapshot()
+
+@app.get("/debug/queries")
+async def query_report(
+    limit: int = Query(default=20, ge=1, le=500),
+    sort: str = Query(default="total", pattern="^(total|mean|max|calls)$"),
+    admin: dict = Depends(verify_admin)
+):
+    return {**query_log.report(limit, sort), "pool": db_pool.snapshot()}
+
+@app.delete("/debug/queries")
+async def reset_query_report(admin: dict = Depends(verify_admin)):
+    query_log.reset()
+    return {"message": "Query stats reset"}
+
+@app.get("/debug/checkout")
+async def checkout_report(admin: dict = Depends(verify_admin)):
+    return checkout.snapshot()
+
+@app.post("/checkout")
+async def place_checkout(
+    checkout_data: CheckoutRequest,
+    request: Request,
+    payload: dict = Depends(verify_token),
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    # One call for the whole checkout (saga.py): 200 when paid, 202 while the
+    # payment is still queued (poll GET /checkout/{order_id}); a retry with
+    # the same Idempotency-Key reports on the first attempt
+    payment = checkout_data.dict(exclude={"shipping_address"})
+    try:
+        result = await checkout.checkout(
+            payload["user_id"],
+            credentials.credentials,
+            checkout_data.shipping_address.dict(),
+            payment,
+            request.headers.get("idempotency-key")
+        )
+    except CheckoutFailed as e:
+        return checkout_failure(e)
+    return FastJSONResponse(status_code=200 if result["status"] == "completed" else 202, content=result)
+
+@app.get("/checkout/{order_id}")
+async def get_checkout(order_id: str, wait: float = 0, payload: dict = Depends(verify_token)):
+    # wait (seconds) long-polls a payment that is still queued
+    result = await checkout.status(order_id, payload["user_id"], min(max(wait, 0), CHECKOUT_WAIT_MAX))
+    if result is None:
+        raise HTTPException(status_code=404, detail="Checkout not found")
+    return FastJSONResponse(result)
+
 @app.post("/orders")
 async def create_order(order_data: CreateOrder, payload: dict = Depends(verify_token), credentials: HTTPAuthorizationCredentials = Depends(security)):
     # Get cart items
     try:
-        async with httpx.AsyncClient() as client:
+        async with service_client() as client:
             headers = {"Authorization": f"Bearer {credentials.credentials}"}
             cart_response = await client.get(f"{CART_SERVICE_URL}/cart", headers=headers)
             if cart_response.status_code != 200:
@@ -124,11 +509,28 @@ async def create_order(order_data: CreateOrder, payload: dict = Depends(verify_t
     if not cart_data.get("items"):
         raise HTTPException(status_code=400, detail="Cart is empty")
     
-    # Calculate totals
-    subtotal = cart_data["total"]
-    shipping_cost = 0 if subtotal >= 500 else 40  # Free shipping over ₹500
-    tax = round(subtotal * 0.18, 2)  # 18% GST
-    total = subtotal + shipping_cost + tax
+    # The cart holds price snapshots; revalidate them against the catalog in one call
+    try:
+        async with service_client() as client:
+            product_response = await client.get(
+                f"{PRODUCT_SERVICE_URL}/products/batch",
+                params={"ids": [item["product_id"] for item in cart_data["items"]]}
+            )
+            if product_response.status_code != 200:
+                raise HTTPException(status_code=400, detail="Failed to validate cart prices")
+            products = {p["id"]: p for p in product_response.json()}
+    except httpx.RequestError:
+        raise HTTPException(status_code=503, detail="Product service unavailable")
+    
+    try:
+        totals = order_totals(cart_data["items"], products)
+    except ProductUnavailable as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    items = totals["items"]
+    subtotal = totals["subtotal"]
+    shipping_cost = totals["shipping_cost"]
+    tax = totals["tax"]
+    total = totals["total"]
     
     # Create order
     order_id = generate_order_id()
@@ -141,7 +543,7 @@ async def create_order(order_data: CreateOrder, payload: dict = Depends(verify_t
     """, (
         order_id,
         payload["user_id"],
-        json.dumps(cart_data["items"]),
+        json.dumps(items),
         subtotal,
         shipping_cost,
         tax,
@@ -159,7 +561,7 @@ async def create_order(order_data: CreateOrder, payload: dict = Depends(verify_t
         "shipping_cost": shipping_cost,
         "tax": tax,
         "total": total,
-        "items": cart_data["items"],
+        "items": items,
         "shipping_address": order_data.shipping_address.dict()
     }
 
@@ -167,47 +569,88 @@ async def create_order(order_data: CreateOrder, payload: dict = Depends(verify_t
 async def get_orders(payload: dict = Depends(verify_token)):
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute("""
-        SELECT order_id, items, subtotal, shipping_cost, tax, total, 
-               shipping_address, payment_status, order_status, created_at
-        FROM orders WHERE user_id = %s ORDER BY created_at DESC
-    """, (payload["user_id"],))
+    execute_prepared(cur, USER_ORDERS, (payload["user_id"],))
     orders = cur.fetchall()
     cur.close()
     conn.close()
     
-    return [dict(o) for o in orders]
+    return FastJSONResponse(orders)
+
+@app.get("/orders/export")
+async def export_orders(
+    format: str = "ndjson",
+    since: Optional[Union[datetime, date]] = None,
+    until: Optional[Union[datetime, date]] = None,
+    status: Optional[str] = None,
+    payload: dict = Depends(verify_admin)
+):
+    where, params = date_filter("created_at", since, until)
+    if status:
+        where += (" AND" if where else " WHERE") + " order_status = %s"
+        params.append(status)
+    return export_response(get_db_connection, "orders", where, params, format, "orders")
+
+@app.get("/orders/archive")
+async def list_archived_orders(payload: dict = Depends(verify_admin)):
+    return await asyncio.to_thread(partitions.archived_months, ARCHIVE_DIR, "orders")
+
+@app.get("/orders/archive/{month}")
+async def query_archived_orders(
+    month: str,
+    user_id: Optional[int] = None,
+    order_id: Optional[str] = None,
+    status: Optional[str] = None,
+    limit: Optional[int] = None,
+    payload: dict = Depends(verify_admin)
+):
+    first = partitions.parse_month(month)
+    if first is None:
+        raise HTTPException(status_code=400, detail="month must be YYYY-MM")
+    path = partitions.archive_path(ARCHIVE_DIR, partitions.partition_name("orders", first))
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Month not archived")
+    filters = {"user_id": user_id, "order_id": order_id, "order_status": status}
+    filters = {field: str(value) for field, value in filters.items() if value is not None}
+    return StreamingResponse(partitions.stream_archive(path, filters, limit), media_type="application/x-ndjson")
 
 @app.get("/orders/{order_id}")
-async def get_order(order_id: str, payload: dict = Depends(verify_token)):
+async def get_order(order_id: str, request: Request, payload: dict = Depends(verify_token)):
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute("""
-        SELECT order_id, items, subtotal, shipping_cost, tax, total, 
-               shipping_address, payment_status, order_status, payment_id, created_at
-        FROM orders WHERE order_id = %s AND user_id = %s
-    """, (order_id, payload["user_id"]))
+    
+    # Revalidation only needs the row version, not the items payload
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        execute_prepared(cur, ORDER_VERSION_BY_ID, (order_id, payload["user_id"]))
+        row = cur.fetchone()
+        if row and order_etag(order_id, row["version"]) in (t.strip().removeprefix("W/") for t in if_none_match.split(",")):
+            cur.close()
+            conn.close()
+            return Response(status_code=304, headers={
+                "ETag": order_etag(order_id, row["version"]),
+                "Cache-Control": ORDER_CACHE_CONTROL
+            })
+    
+    execute_prepared(cur, ORDER_BY_ID, (order_id, payload["user_id"]))
     order = cur.fetchone()
     cur.close()
     conn.close()
     
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
-    return dict(order)
+    etag = order_etag(order_id, order.pop("version"))
+    return FastJSONResponse(order, headers={"ETag": etag, "Cache-Control": ORDER_CACHE_CONTROL})
 
 @app.put("/orders/{order_id}/payment")
-async def update_payment_status(order_id: str, payment_id: str, status: str):
+async def update_payment_status(order_id: str, payment_id: str, status: str, payload: dict = Depends(verify_service)):
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute("""
-        UPDATE orders SET payment_status = %s, payment_id = %s, 
-               order_status = CASE WHEN %s = 'completed' THEN 'confirmed' ELSE order_status END,
-               updated_at = CURRENT_TIMESTAMP
-        WHERE order_id = %s
-    """, (status, payment_id, status, order_id))
+    cur.execute(RECORD_PAYMENT, {"status": status, "payment_id": payment_id, "order_id": order_id})
     conn.commit()
     cur.close()
     conn.close()
+    if status == "completed":
+        also_bought.poke()
     
     return {"message": "Payment status updated"}
 
@@ -229,6 +672,107 @@ async def update_order_status(order_id: str, status: str, payload: dict = Depend
     
     return {"message": "Order status updated"}
 
+@app.post("/orders/status/bulk")
+async def bulk_update_order_status(update: BulkStatusUpdate, payload: dict = Depends(verify_admin)):
+    if len(update.transitions) > BULK_STATUS_MAX:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {BULK_STATUS_MAX} transitions per request; use /orders/status/bulk/stream"
+        )
+    results = await asyncio.to_thread(apply_transitions, [(t.order_id, t.status) for t in update.transitions])
+    return FastJSONResponse({
+        "results": results,
+        "updated": sum(1 for r in results if r["result"] == "updated")
+    })
+
+@app.post("/orders/status/bulk/stream")
+async def bulk_update_order_status_stream(request: Request, payload: dict = Depends(verify_admin)):
+    # NDJSON in and out: one {"order_id", "status"} per line, applied in
+    # chunks of BULK_STATUS_CHUNK (a transaction each); results are streamed
+    # back as each chunk commits, so neither side holds the whole batch
+    async def lines():
+        pending = b""
+        async for data in request.stream():
+            *complete, pending = (pending + data).split(b"\n")
+            for line in complete:
+                yield line
+        yield pending
+    
+    async def results():
+        chunk = []
+        line_number = 0
+        async for line in lines():
+            line_number += 1
+            if not line.strip():
+                continue
+            transition = parse_transition(line)
+            if transition is None:
+                yield dumps_json({"line": line_number, "result": "invalid"}) + b"\n"
+                continue
+            chunk.append(transition)
+            if len(chunk) >= BULK_STATUS_CHUNK:
+                for result in await asyncio.to_thread(apply_transitions, chunk):
+                    yield dumps_json(result) + b"\n"
+                chunk = []
+        if chunk:
+            for result in await asyncio.to_thread(apply_transitions, chunk):
+                yield dumps_json(result) + b"\n"
+    
+    return DuplexStreamingResponse(results(), media_type="application/x-ndjson")
+
+@app.get("/products/{product_id}/also-bought")
+async def get_also_bought(product_id: int, limit: int = 10):
+    return FastJSONResponse({
+        "product_id": product_id,
+        "products": also_bought.neighbors(product_id, min(limit, RECOMMENDATIONS_TOP_K)),
+        "ready": also_bought.ready
+    })
+
+@app.get("/analytics/sales")
+async def get_sales_analytics(
+    since: Optional[date] = None,
+    until: Optional[date] = None,
+    payload: dict = Depends(verify_admin)
+):
+    conn = get_db_connection()
+    days = analytics.daily_sales(conn, since, until)
+    conn.close()
+    return FastJSONResponse({"days": days})
+
+@app.get("/analytics/status")
+async def get_status_analytics(
+    since: Optional[date] = None,
+    until: Optional[date] = None,
+    payload: dict = Depends(verify_admin)
+):
+    conn = get_db_connection()
+    statuses = analytics.orders_by_status(conn, since, until)
+    conn.close()
+    return FastJSONResponse({"statuses": statuses})
+
+@app.get("/analytics/top-products")
+async def get_top_products(
+    since: Optional[date] = None,
+    until: Optional[date] = None,
+    limit: int = 10,
+    by: str = "quantity",
+    payload: dict = Depends(verify_admin)
+):
+    conn = get_db_connection()
+    products = analytics.top_products(conn, since, until, min(limit, 100), by)
+    conn.close()
+    return FastJSONResponse({"products": products})
+
+@app.get("/analytics/backfill")
+async def get_backfill_status(payload: dict = Depends(verify_admin)):
+    conn = get_db_connection()
+    state = analytics.backfill_state(conn)
+    conn.close()
+    if not state:
+        raise HTTPException(status_code=503, detail="Analytics not initialized")
+    return {**state, "complete": state["backfilled_through"] >= state["cutoff_id"]}
+
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    import sys
+    from .serve import Launcher
+    sys.exit(Launcher().run())
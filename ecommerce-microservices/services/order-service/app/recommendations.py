@@ -0,0 +1,154 @@
+""""Frequently bought together" recommendations.
+
+Paid orders are folded into a sparse product co-occurrence matrix (pair counts
+plus per-product order counts). For every product the top-K neighbours by
+cosine similarity are kept as two small typed arrays, so a lookup is a dict
+access and a slice. The matrix is built once from all paid orders, then kept
+current by polling for orders paid since the last watermark, and rebuilt
+periodically to pick up drift such as neighbour scores that shifted because a
+third product got more popular.
+"""
+import asyncio
+import heapq
+import math
+import uuid
+from array import array
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+import psycopg2.extensions
+
+PAID_ORDERS = "SELECT id, items, paid_at FROM orders WHERE paid_at IS NOT NULL"
+
+
+def order_products(items):
+    return {int(item["product_id"]) for item in items if item.get("product_id") is not None}
+
+
+class AlsoBought:
+    def __init__(self, connect, top_k=20, overlap=60.0):
+        self.connect = connect
+        self.top_k = top_k
+        # paid_at is set when the payment transaction starts, so rows can
+        # commit slightly out of order; re-read this window and skip seen ids
+        self.overlap = timedelta(seconds=overlap)
+        self.top = {}  # product_id -> (array('i') neighbour ids, array('f') scores)
+        self.ready = False
+        self.watermark = None
+        self._pairs = defaultdict(Counter)
+        self._orders = Counter()
+        self._seen = {}  # order id -> paid_at, for orders inside the overlap window
+        self._poke = None
+
+    def neighbors(self, product_id, limit):
+        entry = self.top.get(product_id)
+        if entry is None:
+            return []
+        ids, scores = entry
+        return [
+            {"product_id": ids[i], "score": round(scores[i], 4)}
+            for i in range(min(limit, len(ids)))
+        ]
+
+    def _add(self, products, pairs, orders):
+        for product_id in products:
+            orders[product_id] += 1
+            row = pairs[product_id]
+            for other in products:
+                if other != product_id:
+                    row[other] += 1
+
+    def _rank(self, product_id, pairs, orders):
+        row = pairs.get(product_id)
+        if not row:
+            return None
+        norm = orders[product_id]
+        best = heapq.nlargest(
+            self.top_k,
+            ((count / math.sqrt(norm * orders[other]), other) for other, count in row.items())
+        )
+        return array("i", [other for _, other in best]), array("f", [score for score, _ in best])
+
+    def build(self):
+        """Rebuild everything from all paid orders (runs in a worker thread)."""
+        pairs, orders, seen, watermark = defaultdict(Counter), Counter(), {}, None
+        conn = self.connect()
+        cur = conn.cursor(name=f"also_bought_{uuid.uuid4().hex}", cursor_factory=psycopg2.extensions.cursor)
+        try:
+            cur.execute(PAID_ORDERS + " ORDER BY paid_at")
+            while True:
+                rows = cur.fetchmany(2000)
+                if not rows:
+                    break
+                for order_id, items, paid_at in rows:
+                    self._add(order_products(items), pairs, orders)
+                    seen[order_id] = paid_at
+                    watermark = paid_at
+        finally:
+            cur.close()
+            conn.close()
+
+        top = {}
+        for product_id in pairs:
+            ranked = self._rank(product_id, pairs, orders)
+            if ranked:
+                top[product_id] = ranked
+        if watermark is not None:
+            seen = {k: v for k, v in seen.items() if v > watermark - self.overlap}
+        self._pairs, self._orders, self._seen, self.watermark = pairs, orders, seen, watermark
+        self.top = top
+        self.ready = True
+
+    def poll(self):
+        """Fold in orders paid since the watermark (runs in a worker thread)."""
+        conn = self.connect()
+        cur = conn.cursor()
+        if self.watermark is None:
+            cur.execute(PAID_ORDERS + " ORDER BY paid_at")
+        else:
+            cur.execute(PAID_ORDERS + " AND paid_at > %s ORDER BY paid_at", (self.watermark - self.overlap,))
+        rows = cur.fetchall()
+        cur.close()
+        conn.close()
+
+        touched = set()
+        for row in rows:
+            if row["id"] in self._seen:
+                continue
+            products = order_products(row["items"])
+            self._add(products, self._pairs, self._orders)
+            touched |= products
+            self._seen[row["id"]] = row["paid_at"]
+            self.watermark = max(self.watermark or row["paid_at"], row["paid_at"])
+        for product_id in touched:
+            ranked = self._rank(product_id, self._pairs, self._orders)
+            if ranked:
+                self.top[product_id] = ranked
+        if self.watermark is not None:
+            cutoff = self.watermark - self.overlap
+            self._seen = {k: v for k, v in self._seen.items() if v > cutoff}
+        return len(touched)
+
+    def poke(self):
+        """Poll right away, e.g. after this replica recorded a payment."""
+        if self._poke is not None:
+            self._poke.set()
+
+    async def run(self, poll_interval=5.0, rebuild_interval=6 * 3600.0):
+        self._poke = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        rebuild_at = 0.0
+        while True:
+            try:
+                if loop.time() >= rebuild_at:
+                    await asyncio.to_thread(self.build)
+                    rebuild_at = loop.time() + rebuild_interval
+                else:
+                    await asyncio.to_thread(self.poll)
+            except Exception as e:
+                print(f"Recommendations refresh error: {e}")
+            try:
+                await asyncio.wait_for(self._poke.wait(), poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._poke.clear()
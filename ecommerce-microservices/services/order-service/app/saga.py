@@ -0,0 +1,523 @@
+"""Single-call checkout, run as a saga.
+
+POST /checkout places and pays for an order in one request. Its progress is
+recorded in `checkout_sagas`, keyed by the order id (which is also the stock
+reservation id), so a checkout that is interrupted is finished or undone
+instead of leaving reserved stock or an unpaid order behind:
+
+    started       saga recorded, stock being reserved; no order row yet
+    paying        stock reserved and order inserted, payment requested
+    paid          payment recorded on the order, ordered items being
+                  taken out of the cart
+    completed
+    compensating  stock being released, order cancelled
+    failed
+
+Steps that don't depend on each other run together: recording the saga and
+reading the cart; recording the payment and taking the ordered items out of
+the cart; cancelling the order and releasing the stock. Price revalidation and stock reservation are
+one call, as the product service answers a reservation with the current
+prices of what it reserved.
+
+Every state change is a compare-and-set on the state it leaves, so the
+request, a status poll and the recovery loop can all push the same saga and
+each step is taken once. Recovery picks up sagas that have not moved for
+`stale_after` seconds (the request died, or the payment is still queued)
+and drives them to completed or failed. Releasing a reservation and looking
+up a payment are idempotent, so repeating a step after a crash is harmless.
+The cart is never cleared wholesale: the quantities ordered (recorded on the
+saga) are subtracted from it, so items added since checkout stay put.
+"""
+import asyncio
+import json
+from collections import Counter
+
+import httpx
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS checkout_sagas (
+        order_id VARCHAR(50) PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        idempotency_key VARCHAR(100),
+        state VARCHAR(20) NOT NULL DEFAULT 'started',
+        payment_id VARCHAR(100),
+        error VARCHAR(50),
+        items JSONB,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE (user_id, idempotency_key)
+    );
+
+    ALTER TABLE checkout_sagas ADD COLUMN IF NOT EXISTS items JSONB;
+
+    CREATE INDEX IF NOT EXISTS idx_checkout_sagas_open ON checkout_sagas (updated_at)
+        WHERE state NOT IN ('completed', 'failed');
+"""
+
+FINAL_STATES = ("completed", "failed")
+
+# Records a payment outcome on the order; the payment callback uses it too
+RECORD_PAYMENT = """
+    UPDATE orders SET payment_status = %(status)s, payment_id = %(payment_id)s,
+           order_status = CASE WHEN %(status)s = 'completed' THEN 'confirmed' ELSE order_status END,
+           paid_at = CASE WHEN %(status)s = 'completed' THEN COALESCE(paid_at, CURRENT_TIMESTAMP) ELSE paid_at END,
+           updated_at = CURRENT_TIMESTAMP
+    WHERE order_id = %(order_id)s
+"""
+
+CANCEL_ORDER = """
+    UPDATE orders SET payment_status = 'failed', order_status = 'cancelled', updated_at = CURRENT_TIMESTAMP
+    WHERE order_id = %s AND payment_status <> 'completed'
+"""
+
+MOVE = """
+    UPDATE checkout_sagas SET state = %(to)s, payment_id = COALESCE(%(payment_id)s, payment_id),
+           error = COALESCE(%(error)s, error), updated_at = CURRENT_TIMESTAMP
+    WHERE order_id = %(order_id)s AND state = ANY(%(from)s)
+"""
+
+# Lease: claimed sagas get a fresh updated_at, so other replicas leave them
+# alone for another `stale_after`
+CLAIM_STALE = """
+    UPDATE checkout_sagas s SET updated_at = CURRENT_TIMESTAMP
+    FROM (
+        SELECT order_id FROM checkout_sagas
+        WHERE state NOT IN ('completed', 'failed')
+          AND updated_at < CURRENT_TIMESTAMP - %(stale_after)s * INTERVAL '1 second'
+        ORDER BY updated_at LIMIT %(batch)s
+        FOR UPDATE SKIP LOCKED
+    ) stale
+    WHERE s.order_id = stale.order_id
+    RETURNING s.*, s.items AS ordered
+"""
+
+LOAD = """
+    SELECT s.order_id, s.user_id, s.state, s.payment_id, s.error, s.items AS ordered,
+           o.subtotal, o.shipping_cost, o.tax, o.total
+    FROM checkout_sagas s LEFT JOIN orders o USING (order_id)
+    WHERE s.order_id = %s AND s.user_id = %s
+"""
+
+REASONS = {
+    "empty_cart": "Cart is empty",
+    "cart_unavailable": "Failed to fetch cart",
+    "insufficient_stock": "Some items are out of stock",
+    "product_unavailable": "Some items are no longer available",
+    "stock_unavailable": "Product service unavailable",
+    "payment_failed": "Payment failed. Please try again or use a different payment method.",
+    "interrupted": "Checkout was interrupted before payment; nothing was charged",
+}
+
+
+class ProductUnavailable(Exception):
+    def __init__(self, product_id):
+        super().__init__(f"Product {product_id} is no longer available")
+        self.product_id = product_id
+
+
+class CheckoutFailed(Exception):
+    """The checkout did not go through; whatever it took is (being) given back."""
+
+    def __init__(self, reason, order_id=None, shortages=None):
+        super().__init__(REASONS.get(reason, reason))
+        self.reason = reason
+        self.order_id = order_id
+        self.shortages = shortages
+
+
+def order_totals(cart_items, products):
+    """Order items priced from `products` (id -> product), with the totals."""
+    items = []
+    subtotal = 0
+    for item in cart_items:
+        product = products.get(item["product_id"])
+        if not product:
+            raise ProductUnavailable(item["product_id"])
+        item_total = float(product["price"]) * item["quantity"]
+        items.append({**item, "product": product, "item_total": item_total})
+        subtotal += item_total
+    shipping_cost = 0 if subtotal >= 500 else 40  # Free shipping over ₹500
+    tax = round(subtotal * 0.18, 2)  # 18% GST
+    return {
+        "items": items,
+        "subtotal": subtotal,
+        "shipping_cost": shipping_cost,
+        "tax": tax,
+        "total": subtotal + shipping_cost + tax,
+    }
+
+
+def ordered_quantities(items):
+    """[{"product_id", "quantity"}] of an order's items, one entry per product."""
+    quantities = {}
+    for item in items:
+        quantities[item["product_id"]] = quantities.get(item["product_id"], 0) + item["quantity"]
+    return [{"product_id": product_id, "quantity": quantity} for product_id, quantity in quantities.items()]
+
+
+def cart_removals(cart_items, ordered):
+    """/cart/batch operations that take `ordered` out of a cart holding `cart_items`."""
+    in_cart = {}
+    for item in cart_items:
+        in_cart[item["product_id"]] = in_cart.get(item["product_id"], 0) + item["quantity"]
+    operations = []
+    for item in ordered:
+        quantity = in_cart.get(item["product_id"])
+        if quantity is None:
+            continue
+        if quantity <= item["quantity"]:
+            operations.append({"op": "remove", "product_id": item["product_id"]})
+        else:
+            operations.append({"op": "set", "product_id": item["product_id"], "quantity": quantity - item["quantity"]})
+    return operations
+
+
+def summary(saga):
+    """What a client is told about a saga (a LOAD row)."""
+    if saga["state"] == "completed":
+        status = "completed"
+    elif saga["state"] in ("compensating", "failed"):
+        status = "failed"
+    else:
+        status = "pending"
+    result = {
+        "order_id": saga["order_id"],
+        "status": status,
+        "payment_id": saga["payment_id"],
+        "subtotal": saga["subtotal"],
+        "shipping_cost": saga["shipping_cost"],
+        "tax": saga["tax"],
+        "total": saga["total"],
+    }
+    if status == "failed":
+        result["detail"] = REASONS.get(saga["error"], saga["error"])
+    return result
+
+
+class Checkout:
+    def __init__(self, connect, client, token, new_order_id, cart_url, product_url, payment_url,
+                 on_paid=None, payment_timeout=40.0, stale_after=60.0, interval=10.0, batch=50):
+        self.connect = connect
+        self.client = client  # () -> httpx.AsyncClient
+        # user_id -> service token acting for the user: stock reservations
+        # require one, and steps taken after the request has gone use it
+        self.token = token
+        self.new_order_id = new_order_id
+        self.cart_url = cart_url
+        self.product_url = product_url
+        self.payment_url = payment_url
+        self.on_paid = on_paid
+        self.payment_timeout = payment_timeout
+        self.stale_after = stale_after
+        self.interval = interval
+        self.batch = batch
+        self.outcomes = Counter()
+        self.failures = Counter()
+        self.recovered = 0
+
+    # Database steps, each one transaction in a worker thread
+
+    def _run(self, step, *args):
+        conn = self.connect()
+        try:
+            cur = conn.cursor()
+            result = step(cur, *args)
+            conn.commit()
+            cur.close()
+            return result
+        finally:
+            conn.close()
+
+    def _db(self, step, *args):
+        return asyncio.to_thread(self._run, step, *args)
+
+    @staticmethod
+    def _move(cur, order_id, from_states, to, payment_id=None, error=None):
+        cur.execute(MOVE, {
+            "order_id": order_id, "from": list(from_states), "to": to, "payment_id": payment_id, "error": error
+        })
+        return cur.rowcount == 1
+
+    @staticmethod
+    def _begin(cur, order_id, user_id, idempotency_key):
+        """None for a new saga, or the saga already started under `idempotency_key`."""
+        cur.execute("""
+            INSERT INTO checkout_sagas (order_id, user_id, idempotency_key) VALUES (%s, %s, %s)
+            ON CONFLICT (user_id, idempotency_key) DO NOTHING
+        """, (order_id, user_id, idempotency_key))
+        if cur.rowcount == 1:
+            return None
+        cur.execute(
+            "SELECT order_id FROM checkout_sagas WHERE user_id = %s AND idempotency_key = %s",
+            (user_id, idempotency_key)
+        )
+        return cur.fetchone()["order_id"]
+
+    def _place(self, cur, order_id, user_id, order, shipping_address):
+        # The order only exists once the saga says so, so a saga still
+        # `started` never has an order to cancel
+        if not self._move(cur, order_id, ("started",), "paying"):
+            return False
+        cur.execute("UPDATE checkout_sagas SET items = %s WHERE order_id = %s", (json.dumps(ordered_quantities(order["items"])), order_id))
+        cur.execute("""
+            INSERT INTO orders (order_id, user_id, items, subtotal, shipping_cost, tax, total, shipping_address)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        """, (
+            order_id, user_id, json.dumps(order["items"]), order["subtotal"],
+            order["shipping_cost"], order["tax"], order["total"], json.dumps(shipping_address)
+        ))
+        return True
+
+    def _record_paid(self, cur, order_id, payment_id):
+        if not self._move(cur, order_id, ("paying",), "paid", payment_id=payment_id):
+            return False
+        cur.execute(RECORD_PAYMENT, {"status": "completed", "payment_id": payment_id, "order_id": order_id})
+        return True
+
+    def _cancel(self, cur, order_id, from_states, reason):
+        if not self._move(cur, order_id, from_states, "compensating", error=reason):
+            return False
+        cur.execute(CANCEL_ORDER, (order_id,))
+        return True
+
+    @staticmethod
+    def _load(cur, order_id, user_id):
+        cur.execute(LOAD, (order_id, user_id))
+        return cur.fetchone()
+
+    @staticmethod
+    def _claim(cur, stale_after, batch):
+        cur.execute(CLAIM_STALE, {"stale_after": stale_after, "batch": batch})
+        return cur.fetchall()
+
+    # Calls to other services
+
+    async def _get_cart(self, client, auth):
+        try:
+            response = await client.get(f"{self.cart_url}/cart", headers=auth)
+        except httpx.HTTPError:
+            return None
+        return response.json() if response.status_code == 200 else None
+
+    async def _remove_ordered(self, client, auth, ordered):
+        """Subtract the ordered quantities from the cart, keeping anything added since.
+
+        Read-then-update: a retry after an update whose answer was lost could
+        subtract twice from a line topped up in between, but never touches
+        products that were not ordered.
+        """
+        cart = await self._get_cart(client, auth)
+        if cart is None:
+            return False
+        operations = cart_removals(cart["items"], ordered)
+        if not operations:
+            return True
+        try:
+            response = await client.post(f"{self.cart_url}/cart/batch", json={"operations": operations}, headers=auth)
+        except httpx.HTTPError:
+            return False
+        return response.status_code == 200
+
+    async def _release(self, client, order_id, user_id):
+        try:
+            response = await client.delete(
+                f"{self.product_url}/products/stock/reservations/{order_id}",
+                headers={"Authorization": f"Bearer {self.token(user_id)}"}
+            )
+        except httpx.HTTPError:
+            return False
+        return response.status_code == 200
+
+    async def _payment(self, client, saga, auth, wait=0):
+        """The saga's payment, None when there is none, or status "unknown"."""
+        if saga["payment_id"]:
+            url, params = f"{self.payment_url}/payments/{saga['payment_id']}", {"wait": wait}
+        else:
+            url, params = f"{self.payment_url}/payments/order/{saga['order_id']}", None
+        try:
+            response = await client.get(url, params=params, headers=auth, timeout=wait + 5)
+        except httpx.HTTPError:
+            return {"status": "unknown"}
+        if response.status_code == 404:
+            return None
+        if response.status_code != 200:
+            return {"status": "unknown"}
+        return response.json()
+
+    # Saga steps
+
+    async def _complete(self, client, order_id, payment_id, auth, ordered):
+        paid, removed = await asyncio.gather(
+            self._db(self._record_paid, order_id, payment_id),
+            self._remove_ordered(client, auth, ordered),
+        )
+        if paid and self.on_paid:
+            self.on_paid()
+        # A cart that could not be updated is left to recovery
+        if removed:
+            await self._db(self._move, order_id, ("paid",), "completed")
+
+    async def _compensate(self, client, order_id, user_id, from_states, reason):
+        cancelled, released = await asyncio.gather(
+            self._db(self._cancel, order_id, from_states, reason),
+            self._release(client, order_id, user_id),
+        )
+        if cancelled:
+            self.failures[reason] += 1
+        # Stock that could not be released is left to recovery
+        if released:
+            await self._db(self._move, order_id, ("compensating",), "failed")
+
+    async def _fail(self, order_id, reason):
+        # Nothing was taken yet, so there is nothing to give back
+        await self._db(self._move, order_id, ("started",), "failed", None, reason)
+        self.failures[reason] += 1
+        raise CheckoutFailed(reason, order_id)
+
+    async def _advance(self, client, saga, stale=False, wait=0):
+        """Take the next step of an unfinished saga.
+
+        Steps whose outcome is not known yet (a reservation or payment that
+        may still be in flight) are only taken back once the saga is stale.
+        """
+        order_id, user_id, state = saga["order_id"], saga["user_id"], saga["state"]
+        auth = {"Authorization": f"Bearer {self.token(user_id)}"}
+        if state == "started":
+            if stale:
+                await self._compensate(client, order_id, user_id, ("started",), "interrupted")
+        elif state == "paying":
+            payment = await self._payment(client, saga, auth, wait)
+            if payment is None:
+                if stale:
+                    await self._compensate(client, order_id, user_id, ("paying",), "interrupted")
+            elif payment["status"] == "completed":
+                await self._complete(client, order_id, payment["payment_id"], auth, saga["ordered"])
+            elif payment["status"] == "failed":
+                await self._compensate(client, order_id, user_id, ("paying",), "payment_failed")
+        elif state == "paid":
+            if await self._remove_ordered(client, auth, saga["ordered"]):
+                await self._db(self._move, order_id, ("paid",), "completed")
+        elif state == "compensating":
+            if await self._release(client, order_id, saga["user_id"]):
+                await self._db(self._move, order_id, ("compensating",), "failed")
+
+    async def checkout(self, user_id, bearer, shipping_address, payment, idempotency_key=None):
+        """Place and pay for the user's cart; returns the order summary.
+
+        Raises CheckoutFailed once the checkout is known not to go through.
+        A payment that is still queued comes back as status "pending".
+        """
+        order_id = self.new_order_id()
+        auth = {"Authorization": f"Bearer {bearer}"}
+        self.outcomes["started"] += 1
+        async with self.client() as client:
+            existing, cart = await asyncio.gather(
+                self._db(self._begin, order_id, user_id, idempotency_key),
+                self._get_cart(client, auth),
+            )
+            if existing is not None:
+                # A retry of a checkout that already started: report on that one
+                self.outcomes["replayed"] += 1
+                return await self.status(existing, user_id, replay=True)
+            if cart is None:
+                await self._fail(order_id, "cart_unavailable")
+            if not cart.get("items"):
+                await self._fail(order_id, "empty_cart")
+
+            # Reserving stock also revalidates the cart's price snapshots
+            try:
+                response = await client.post(f"{self.product_url}/products/stock/reservations", json={
+                    "reservation_id": order_id,
+                    "items": [{"product_id": item["product_id"], "quantity": item["quantity"]} for item in cart["items"]],
+                }, headers={"Authorization": f"Bearer {self.token(user_id)}"})
+            except httpx.HTTPError:
+                response = None
+            if response is not None and response.status_code == 409:
+                shortages = response.json().get("shortages")
+                if await self._db(self._move, order_id, ("started",), "failed", None, "insufficient_stock"):
+                    self.failures["insufficient_stock"] += 1
+                raise CheckoutFailed("insufficient_stock", order_id, shortages)
+            if response is None or response.status_code != 200:
+                # The reservation may have been made before the call failed
+                await self._compensate(client, order_id, user_id, ("started",), "stock_unavailable")
+                raise CheckoutFailed("stock_unavailable", order_id)
+            try:
+                order = order_totals(cart["items"], {p["id"]: p for p in response.json()["products"]})
+            except ProductUnavailable:
+                await self._compensate(client, order_id, user_id, ("started",), "product_unavailable")
+                raise CheckoutFailed("product_unavailable", order_id)
+
+            if not await self._db(self._place, order_id, user_id, order, shipping_address):
+                return await self.status(order_id, user_id)
+
+            try:
+                response = await client.post(
+                    f"{self.payment_url}/payments/process",
+                    json={**payment, "order_id": order_id, "amount": order["total"], "settle": False},
+                    headers=auth,
+                    timeout=self.payment_timeout,
+                )
+            except httpx.HTTPError:
+                response = None
+            payment_id = None
+            if response is not None and response.status_code == 200:
+                payment_id = response.json()["payment_id"]
+                await self._complete(client, order_id, payment_id, auth, ordered_quantities(order["items"]))
+            elif response is not None and 400 <= response.status_code < 500:
+                # Declined, or refused before a payment was made
+                await self._compensate(client, order_id, user_id, ("paying",), "payment_failed")
+                raise CheckoutFailed("payment_failed", order_id)
+            elif response is not None and response.status_code == 202:
+                # Still queued; status polls and recovery follow it up by id
+                payment_id = response.json().get("payment_id")
+                await self._db(self._move, order_id, ("paying",), "paying", payment_id)
+
+        status = "completed" if response is not None and response.status_code == 200 else "pending"
+        self.outcomes[status] += 1
+        return {
+            "order_id": order_id,
+            "status": status,
+            "payment_id": payment_id,
+            **order,
+            "shipping_address": shipping_address,
+        }
+
+    async def status(self, order_id, user_id, wait=0, replay=False):
+        """The saga's summary, after resolving a payment that has finished.
+
+        `wait` long-polls a pending payment for that many seconds. With
+        `replay`, a failed saga raises CheckoutFailed like the original call.
+        """
+        saga = await self._db(self._load, order_id, user_id)
+        if saga is None:
+            return None
+        if saga["state"] not in FINAL_STATES:
+            async with self.client() as client:
+                await self._advance(client, saga, wait=wait)
+            saga = await self._db(self._load, order_id, user_id)
+        result = summary(saga)
+        if replay and result["status"] == "failed":
+            raise CheckoutFailed(saga["error"], order_id)
+        return result
+
+    async def run(self):
+        """Drive sagas that stopped moving to completed or failed."""
+        while True:
+            try:
+                sagas = await self._db(self._claim, self.stale_after, self.batch)
+                if sagas:
+                    async with self.client() as client:
+                        for saga in sagas:
+                            await self._advance(client, saga, stale=True)
+                    self.recovered += len(sagas)
+            except Exception as e:
+                print(f"Checkout recovery error: {e}")
+            await asyncio.sleep(self.interval)
+
+    def snapshot(self):
+        return {
+            "outcomes": dict(self.outcomes),
+            "failures": dict(self.failures),
+            "recovered": self.recovered,
+            "stale_after": self.stale_after,
+        }
@@ -0,0 +1,275 @@
+"""Response compression middleware (gzip / brotli).
+
+Compresses responses whose content type is on the allowlist and whose body is
+at least `minimum_size` bytes, picking brotli when the client accepts it.
+Levels are (gzip level, brotli quality) pairs and can be set per route
+prefix; brotli's cost climbs much faster than gzip's, so its default is lower.
+
+A compressed body is a different representation from the identity one, so a
+strong ETag gets the encoding appended ("abc" -> "abc-gzip") and the suffix is
+stripped from If-None-Match again before the app compares validators.
+Compressed bodies of public responses carrying an ETag are cached, so
+materialized/versioned responses are compressed once per version instead of
+once per request. Bytes saved and CPU spent are tracked in CompressionStats.
+"""
+import os
+import time
+import zlib
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always available
+    brotli = None
+
+DEFAULT_TYPES = "application/json,application/x-ndjson,text/csv,text/plain,text/html"
+
+
+class CompressionStats:
+    def __init__(self):
+        self.responses = 0
+        self.cache_hits = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_seconds = 0.0
+
+    def snapshot(self):
+        return {
+            "responses": self.responses,
+            "cache_hits": self.cache_hits,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "bytes_saved": self.bytes_in - self.bytes_out,
+            "ratio": round(self.bytes_out / self.bytes_in, 3) if self.bytes_in else None,
+            "cpu_ms": round(self.cpu_seconds * 1000, 3),
+        }
+
+
+class Compressor:
+    # Streams flush only after this much input; flushing tiny chunks one by
+    # one costs more bytes than compression saves
+    flush_size = 16 * 1024
+
+    def __init__(self, encoding, level):
+        self.encoding = encoding
+        self.pending = 0
+        if encoding == "br":
+            self._impl = brotli.Compressor(quality=level)
+        else:
+            self._impl = zlib.compressobj(level, zlib.DEFLATED, 31)  # 31: gzip container
+
+    def compress(self, data, final):
+        self.pending += len(data)
+        flush = final or self.pending >= self.flush_size
+        if flush:
+            self.pending = 0
+        if self.encoding == "br":
+            out = self._impl.process(data)
+            if final:
+                return out + self._impl.finish()
+            return out + self._impl.flush() if flush else out
+        out = self._impl.compress(data)
+        if final:
+            return out + self._impl.flush(zlib.Z_FINISH)
+        return out + self._impl.flush(zlib.Z_SYNC_FLUSH) if flush else out
+
+
+def route_path(scope):
+    # Mounted apps (monolith mode) see the full path plus their root_path
+    path, root_path = scope["path"], scope.get("root_path", "")
+    return path[len(root_path):] if root_path and path.startswith(root_path) else path
+
+
+def encoded_etag(etag, encoding):
+    # Weak validators already tolerate byte differences between encodings
+    if etag.startswith(b"W/") or not etag.endswith(b'"'):
+        return etag
+    return etag[:-1] + b"-" + encoding.encode() + b'"'
+
+
+def decoded_if_none_match(header, encoding):
+    """Strip this encoding's ETag suffix from If-None-Match.
+
+    Returns the rewritten header and whether any suffix was removed.
+    """
+    suffix = b"-" + encoding.encode() + b'"'
+    tags = [tag.strip() for tag in header.split(b",")]
+    decoded = [tag[:-len(suffix)] + b'"' if tag.endswith(suffix) else tag for tag in tags]
+    return b", ".join(decoded), decoded != tags
+
+
+def merged_vary(headers):
+    values = []
+    for key, value in headers:
+        if key.lower() == b"vary":
+            values.extend(v.strip() for v in value.split(b",") if v.strip())
+    if not any(v.lower() in (b"accept-encoding", b"*") for v in values):
+        values.append(b"Accept-Encoding")
+    return b", ".join(values)
+
+
+def accepted_encoding(accept_encoding):
+    accepted = set()
+    for part in accept_encoding.lower().split(","):
+        token, _, params = part.strip().partition(";")
+        if params.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.add(token.strip())
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+class CompressionMiddleware:
+    def __init__(self, app, stats=None, route_levels=None, minimum_size=None, levels=None,
+                 content_types=None, cache_entries=256):
+        self.app = app
+        self.stats = stats or CompressionStats()
+        self.minimum_size = minimum_size if minimum_size is not None else int(os.environ.get("COMPRESSION_MIN_SIZE", "1024"))
+        self.levels = levels or (
+            int(os.environ.get("GZIP_LEVEL", "6")),
+            int(os.environ.get("BROTLI_QUALITY", "4")),
+        )
+        types = content_types or os.environ.get("COMPRESSION_TYPES", DEFAULT_TYPES).split(",")
+        self.content_types = {t.strip() for t in types if t.strip()}
+        # Longest prefix first so "/products/home" wins over "/products"
+        self.route_levels = sorted((route_levels or {}).items(), key=lambda item: -len(item[0]))
+        self.cache = OrderedDict()
+        self.cache_entries = cache_entries
+
+    def level_for(self, path, encoding):
+        levels = self.levels
+        for prefix, route_levels in self.route_levels:
+            if path.startswith(prefix):
+                levels = route_levels
+                break
+        return levels[1] if encoding == "br" else levels[0]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "HEAD":
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        encoding = accepted_encoding(headers.get(b"accept-encoding", b"").decode("latin-1"))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        # Conditional requests echo the encoded ETag; the app only knows its own
+        encoded_validator = False
+        if b"if-none-match" in headers:
+            if_none_match, encoded_validator = decoded_if_none_match(headers[b"if-none-match"], encoding)
+            if encoded_validator:
+                # In place: outer middleware (the query log) reads the route the
+                # router records in this same scope
+                scope["headers"] = [
+                    (k, if_none_match if k == b"if-none-match" else v) for k, v in scope["headers"]
+                ]
+        responder = CompressionResponder(self, scope, encoding, send, encoded_validator)
+        await self.app(scope, receive, responder.send)
+
+
+class CompressionResponder:
+    def __init__(self, middleware, scope, encoding, send, encoded_validator=False):
+        self.middleware = middleware
+        self.scope = scope
+        self.encoding = encoding
+        self.level = middleware.level_for(route_path(scope), encoding)
+        self._send = send
+        self.start = None
+        self.compressor = None
+        self.passthrough = False
+        # The client revalidated a compressed copy, so a 304 must carry its ETag
+        self.encoded_validator = encoded_validator
+
+    def _compressible(self):
+        headers = {k.lower(): v for k, v in self.start["headers"]}
+        status = self.start["status"]
+        content_type = headers.get(b"content-type", b"").decode("latin-1").split(";")[0].strip()
+        if status < 200 or status in (204, 304) or b"content-encoding" in headers:
+            return False
+        return content_type in self.middleware.content_types
+
+    def _cache_key(self):
+        headers = {k.lower(): v for k, v in self.start["headers"]}
+        etag = headers.get(b"etag")
+        if not etag or etag.startswith(b"W/") or b"public" not in headers.get(b"cache-control", b""):
+            return None
+        return (route_path(self.scope), self.scope["query_string"], etag, self.encoding, self.level)
+
+    def _start_headers(self, length=None):
+        headers = [
+            (k, encoded_etag(v, self.encoding) if k.lower() == b"etag" else v)
+            for k, v in self.start["headers"]
+            if k.lower() not in (b"content-length", b"vary")
+        ]
+        headers.append((b"content-encoding", self.encoding.encode()))
+        headers.append((b"vary", merged_vary(self.start["headers"])))
+        if length is not None:
+            headers.append((b"content-length", str(length).encode()))
+        return {**self.start, "headers": headers}
+
+    async def send(self, message):
+        if message["type"] == "http.response.start":
+            self.start = message
+            # Decide from the headers alone when possible, so streams such as
+            # SSE get their headers right away instead of on the first chunk
+            if not self._compressible():
+                self.passthrough = True
+                if message["status"] == 304 and self.encoded_validator:
+                    message = {**message, "headers": [
+                        (k, encoded_etag(v, self.encoding) if k.lower() == b"etag" else v)
+                        for k, v in message["headers"]
+                    ]}
+                await self._send(message)
+            return
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self._send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        stats = self.middleware.stats
+
+        if self.compressor is None:
+            if not more_body and len(body) < self.middleware.minimum_size:
+                self.passthrough = True
+                await self._send(self.start)
+                await self._send(message)
+                return
+
+            if not more_body:
+                key = self._cache_key()
+                cache = self.middleware.cache
+                compressed = cache.get(key) if key else None
+                if compressed is not None:
+                    cache.move_to_end(key)
+                    stats.cache_hits += 1
+                else:
+                    cpu = time.thread_time()
+                    compressed = Compressor(self.encoding, self.level).compress(body, final=True)
+                    stats.cpu_seconds += time.thread_time() - cpu
+                    if key:
+                        cache[key] = compressed
+                        if len(cache) > self.middleware.cache_entries:
+                            cache.popitem(last=False)
+                stats.responses += 1
+                stats.bytes_in += len(body)
+                stats.bytes_out += len(compressed)
+                await self._send(self._start_headers(len(compressed)))
+                await self._send({"type": "http.response.body", "body": compressed})
+                return
+
+            # Streaming body: compress chunk by chunk
+            self.compressor = Compressor(self.encoding, self.level)
+            stats.responses += 1
+            await self._send(self._start_headers())
+
+        cpu = time.thread_time()
+        compressed = self.compressor.compress(body, final=not more_body)
+        stats.cpu_seconds += time.thread_time() - cpu
+        stats.bytes_in += len(body)
+        stats.bytes_out += len(compressed)
+        if compressed or not more_body:
+            await self._send({"type": "http.response.body", "body": compressed, "more_body": more_body})
@@ -0,0 +1,42 @@
+"""Payment gateways.
+
+A gateway authorizes one payment at a time and is called with the stored
+payment row; its payment_id doubles as the idempotency key, so a payment
+retried after a worker died is not charged twice by a real gateway.
+FakeGateway stands in for Razorpay, Stripe and the like: it answers after a
+configurable latency and approves a configurable share of payments.
+"""
+import asyncio
+import random
+import uuid
+
+# Payment method -> gateway that handles it; each gateway has its own
+# concurrency limit in the worker pool
+GATEWAYS = {
+    "credit_card": "card",
+    "debit_card": "card",
+    "upi": "upi",
+    "net_banking": "netbanking",
+}
+
+
+class Authorization:
+    def __init__(self, approved, transaction_id=None, reason=None):
+        self.approved = approved
+        self.transaction_id = transaction_id
+        self.reason = reason
+
+
+class FakeGateway:
+    def __init__(self, latency=0.0, jitter=0.0, success_rate=0.95):
+        self.latency = latency
+        self.jitter = jitter
+        self.success_rate = success_rate
+
+    async def authorize(self, payment):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        if random.random() >= self.success_rate:
+            return Authorization(False, reason="declined")
+        return Authorization(True, transaction_id=f"TXN{uuid.uuid4().hex[:12].upper()}")
@@ -1,18 +1,46 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
-from typing import Optional
+from typing import Optional, Union
 import psycopg2
-from psycopg2.extras import RealDictCursor
 import os
 import jwt
 import time
 import httpx
 import uuid
-from datetime import datetime
+from datetime import date, datetime, timedelta
+import orjson
+import asyncio
+from urllib.parse import parse_qs
+from decimal import Decimal
 
-app = FastAPI(title="Payment Service", version="1.0.0")
+from . import partitions
+from .gateway import GATEWAYS, FakeGateway
+from .processing import FINAL_STATUSES, PaymentQueue, parse_limits
+from .admission import AdmissionMiddleware, RouteClass, admission_limiter, BROWSE, CRITICAL, NORMAL
+from .compression import CompressionMiddleware, CompressionStats
+from .querylog import QueryLogMiddleware, query_logger
+from .pool import ConnectionPool, PooledConnection, Statement, execute_prepared
+from .export import date_filter, export_response
+
+def json_default(value):
+    # Same as jsonable_encoder: integral Decimals become int, the rest float
+    if isinstance(value, Decimal):
+        return int(value) if value.as_tuple().exponent >= 0 else float(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+def dumps_json(content) -> bytes:
+    return orjson.dumps(content, default=json_default, option=orjson.OPT_NON_STR_KEYS)
+
+class FastJSONResponse(JSONResponse):
+    # orjson encodes rows (datetimes included) straight to bytes; hot routes
+    # return this directly so FastAPI skips the generic jsonable_encoder pass
+    def render(self, content) -> bytes:
+        return dumps_json(content)
+
+app = FastAPI(title="Payment Service", version="1.0.0", default_response_class=FastJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -22,12 +50,77 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+compression_stats = CompressionStats()
+app.add_middleware(CompressionMiddleware, stats=compression_stats)
+
 security = HTTPBearer()
 JWT_SECRET = os.environ.get("JWT_SECRET", "ecommerce-secret-key-2024")
 ORDER_SERVICE_URL = os.environ.get("ORDER_SERVICE_URL", "http://order-service:8000")
 CART_SERVICE_URL = os.environ.get("CART_SERVICE_URL", "http://cart-service:8000")
+# Months of payments kept in the live table; older ones are archived to
+# ARCHIVE_DIR (0 keeps everything)
+ARCHIVE_AFTER_MONTHS = int(os.environ.get("ARCHIVE_AFTER_MONTHS", "0"))
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "/data/archive")
+# Payments are processed by a worker pool, at most PAYMENT_WORKERS at once and
+# at most PAYMENT_GATEWAY_LIMITS per gateway (e.g. "card=8,upi=8,netbanking=4").
+# Both are per pod; each of the WORKER_PROCESSES started by serve.py gets its share
+WORKER_PROCESSES = int(os.environ.get("WORKER_PROCESSES", "1"))
+PAYMENT_WORKERS = max(1, int(os.environ.get("PAYMENT_WORKERS", "16")) // WORKER_PROCESSES)
+PAYMENT_GATEWAY_LIMITS = {
+    name: max(1, limit // WORKER_PROCESSES)
+    for name, limit in parse_limits(os.environ.get("PAYMENT_GATEWAY_LIMITS", "card=8,upi=8,netbanking=4")).items()
+}
+PAYMENT_GATEWAY_LATENCY_MS = float(os.environ.get("PAYMENT_GATEWAY_LATENCY_MS", "0"))
+PAYMENT_GATEWAY_JITTER_MS = float(os.environ.get("PAYMENT_GATEWAY_JITTER_MS", "0"))
+PAYMENT_GATEWAY_SUCCESS_RATE = float(os.environ.get("PAYMENT_GATEWAY_SUCCESS_RATE", "0.95"))
+# How long /payments/process waits for the outcome before answering 202
+PAYMENT_SYNC_TIMEOUT = float(os.environ.get("PAYMENT_SYNC_TIMEOUT", "30"))
+PAYMENT_WAIT_MAX = 30.0
+ADMIN_EMAILS = {e.strip().lower() for e in os.environ.get("ADMIN_EMAILS", "").split(",") if e.strip()}
 
-def get_db_connection():
+# Transports keyed by service URL; monolith mode mounts in-process ASGI apps here
+SERVICE_TRANSPORTS = {}
+
+def service_client():
+    return httpx.AsyncClient(mounts=SERVICE_TRANSPORTS)
+
+# Admission control: processing payments is shed last
+PAYMENT = RouteClass("payment", rate=1, burst=5, priority=CRITICAL)
+PAYMENT_READ = RouteClass("payment_read", rate=10, burst=30, priority=NORMAL)
+EXPORT = RouteClass("export", rate=0.1, burst=2, priority=BROWSE)
+
+def is_payment_long_poll(method, path, query):
+    # GET /payments/{payment_id} with wait > 0; other reads are admitted
+    # whatever their query says
+    parts = path.split("/")
+    if method != "GET" or len(parts) != 3 or parts[1] != "payments" or parts[2] in ("export", "archive"):
+        return False
+    try:
+        return float(parse_qs(query).get("wait", ["0"])[-1]) > 0
+    except ValueError:
+        return False
+
+def classify_request(method, path, query):
+    if path == "/health" or path.startswith("/debug/"):
+        return None
+    if method == "POST":
+        return PAYMENT
+    # Long-polls for a payment outcome mostly sleep; like the catalog change
+    # feed they are not admitted against the request slots
+    if is_payment_long_poll(method, path, query):
+        return None
+    if path == "/payments/export" or path.startswith("/payments/archive"):
+        return EXPORT
+    return PAYMENT_READ
+
+admission = admission_limiter()
+app.add_middleware(AdmissionMiddleware, classify=classify_request, jwt_secret=JWT_SECRET, limiter=admission)
+
+# Times every statement by shape; slow ones are logged and sampled for EXPLAIN
+query_log = query_logger()
+app.add_middleware(QueryLogMiddleware)
+
+def open_db_connection():
     max_retries = 5
     for i in range(max_retries):
         try:
@@ -37,7 +130,8 @@ def get_db_connection():
                 database=os.environ.get("DB_NAME", "paymentdb"),
                 user=os.environ.get("DB_USER", "postgres"),
                 password=os.environ.get("DB_PASSWORD", "postgres123"),
-                cursor_factory=RealDictCursor
+                connection_factory=PooledConnection,
+                cursor_factory=query_log.cursor_factory
             )
             return conn
         except psycopg2.OperationalError:
@@ -46,24 +140,54 @@ def get_db_connection():
             else:
                 raise
 
+# Requests reuse idle connections and the statements prepared on them;
+# anything that keeps session state (LISTEN, advisory locks) opens its own
+db_pool = ConnectionPool(
+    open_db_connection,
+    size=int(os.environ.get("DB_POOL_SIZE", "10")),
+    max_age=float(os.environ.get("DB_POOL_MAX_AGE_SECONDS", "1800")),
+)
+
+def get_db_connection():
+    return db_pool.get()
+
 def init_db():
     try:
-        conn = get_db_connection()
+        conn = open_db_connection()
         cur = conn.cursor()
-        cur.execute("""
+        # Workers and replicas starting together would otherwise race on the DDL
+        cur.execute("SELECT pg_advisory_lock(hashtext('schema:payment-service'))")
+        # Partitioned by month of created_at, so keys include it; payment_id
+        # is kept unique across partitions by the payment_ids key table
+        partitions.install(cur, "payments", """
             CREATE TABLE IF NOT EXISTS payments (
-                id SERIAL PRIMARY KEY,
-                payment_id VARCHAR(50) UNIQUE NOT NULL,
+                id INTEGER NOT NULL DEFAULT nextval('payments_id_seq'),
+                payment_id VARCHAR(50) NOT NULL,
                 order_id VARCHAR(50) NOT NULL,
                 user_id INTEGER NOT NULL,
                 amount DECIMAL(10, 2) NOT NULL,
                 payment_method VARCHAR(50) NOT NULL,
                 card_last_four VARCHAR(4),
                 card_holder_name VARCHAR(255),
-                status VARCHAR(50) DEFAULT 'pending',
+                status VARCHAR(50) DEFAULT 'pending',  -- pending, processing, completed, failed
                 transaction_id VARCHAR(100),
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
+                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (id, created_at),
+                UNIQUE (payment_id, created_at)
+            ) PARTITION BY RANGE (created_at)
+        """)
+        partitions.unique_key(cur, "payments", "payment_id")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_payments_user_created ON payments (user_id, created_at DESC)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_payments_order ON payments (order_id)")
+        # Queue bookkeeping (see processing.py)
+        cur.execute("ALTER TABLE payments ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0")
+        cur.execute("ALTER TABLE payments ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMP")
+        cur.execute("ALTER TABLE payments ADD COLUMN IF NOT EXISTS completed_at TIMESTAMP")
+        cur.execute("ALTER TABLE payments ADD COLUMN IF NOT EXISTS failure_reason VARCHAR(100)")
+        cur.execute("ALTER TABLE payments ADD COLUMN IF NOT EXISTS settle BOOLEAN NOT NULL DEFAULT TRUE")
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_payments_queue ON payments (status, payment_method, id)
+            WHERE status IN ('pending', 'processing')
         """)
         conn.commit()
         cur.close()
@@ -75,6 +199,15 @@ def init_db():
 @app.on_event("startup")
 async def startup():
     init_db()
+    app.state.partitions = asyncio.create_task(
+        partitions.run(open_db_connection, "payments", ARCHIVE_AFTER_MONTHS, ARCHIVE_DIR)
+    )
+    app.state.payment_queue = asyncio.create_task(payment_queue.run())
+
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.partitions.cancel()
+    app.state.payment_queue.cancel()
 
 class PaymentRequest(BaseModel):
     order_id: str
@@ -85,6 +218,9 @@ class PaymentRequest(BaseModel):
     expiry_date: Optional[str] = None
     cvv: Optional[str] = None
     upi_id: Optional[str] = None
+    # False when the caller (the order service's checkout) records the outcome
+    # itself, so no settlement callbacks are made
+    settle: bool = True
 
 def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
     try:
@@ -95,36 +231,137 @@ def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+def verify_admin(payload: dict = Depends(verify_token)):
+    # Cross-user reads such as exports are limited to ADMIN_EMAILS
+    if payload.get("email", "").lower() not in ADMIN_EMAILS:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return payload
+
 def generate_payment_id():
     return f"PAY-{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:6].upper()}"
 
-def generate_transaction_id():
-    return f"TXN{uuid.uuid4().hex[:12].upper()}"
+def service_token(user_id: int):
+    # Settlement runs after the request is gone; downstream services only
+    # need the user id, and the order payment callback also requires "service"
+    return jwt.encode(
+        {"user_id": user_id, "service": "payment-service", "exp": datetime.utcnow() + timedelta(minutes=5)},
+        JWT_SECRET, algorithm="HS256"
+    )
+
+async def settle_payment(payment):
+    """Mark the order paid and clear the cart once a payment is approved."""
+    if not payment.get("settle", True):
+        return
+    try:
+        async with service_client() as client:
+            headers = {"Authorization": f"Bearer {service_token(payment['user_id'])}"}
+            await client.put(
+                f"{ORDER_SERVICE_URL}/orders/{payment['order_id']}/payment",
+                params={"payment_id": payment["payment_id"], "status": "completed"},
+                headers=headers
+            )
+            await client.delete(f"{CART_SERVICE_URL}/cart", headers=headers)
+    except Exception as e:
+        print(f"Payment settlement error ({payment['payment_id']}): {e}")
+
+payment_queue = PaymentQueue(
+    get_db_connection,
+    FakeGateway(
+        latency=PAYMENT_GATEWAY_LATENCY_MS / 1000,
+        jitter=PAYMENT_GATEWAY_JITTER_MS / 1000,
+        success_rate=PAYMENT_GATEWAY_SUCCESS_RATE
+    ),
+    settle_payment,
+    workers=PAYMENT_WORKERS,
+    limits=PAYMENT_GATEWAY_LIMITS
+)
+
+PAYMENT_COLUMNS = """payment_id, order_id, amount, payment_method, card_last_four,
+                     status, transaction_id, failure_reason, created_at, completed_at"""
+
+# Hot fixed reads, prepared once per connection; the payments partitions make
+# planning these comparatively expensive, and waiting clients poll the first
+PAYMENT_BY_ID = Statement(
+    "payment_by_id", f"SELECT {PAYMENT_COLUMNS} FROM payments WHERE payment_id = $1 AND user_id = $2",
+    ("text", "integer")
+)
+PAYMENT_BY_ORDER = Statement("payment_by_order", """
+    SELECT payment_id, order_id, amount, payment_method, card_last_four,
+           status, transaction_id, created_at
+    FROM payments WHERE order_id = $1 AND user_id = $2
+""", ("text", "integer"))
+USER_PAYMENTS = Statement("user_payments", """
+    SELECT payment_id, order_id, amount, payment_method, status, created_at
+    FROM payments WHERE user_id = $1 ORDER BY created_at DESC
+""", ("integer",))
+
+def fetch_payment(payment_id: str, user_id: int):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    execute_prepared(cur, PAYMENT_BY_ID, (payment_id, user_id))
+    payment = cur.fetchone()
+    cur.close()
+    conn.close()
+    return payment
+
+async def wait_for_payment(payment_id: str, user_id: int, timeout: float):
+    """The payment once it is completed or failed, or as it is after `timeout`."""
+    deadline = time.monotonic() + timeout
+    while True:
+        payment = fetch_payment(payment_id, user_id)
+        remaining = deadline - time.monotonic()
+        if payment is None or payment["status"] in FINAL_STATUSES or remaining <= 0:
+            return payment
+        # Woken as soon as this replica finishes it; re-read every second in
+        # case another replica does
+        await payment_queue.wait(payment_id, min(remaining, 1.0))
 
 @app.get("/health")
 async def health():
     return {"status": "healthy", "service": "payment-service"}
 
+@app.get("/debug/compression")
+async def compression_report(admin: dict = Depends(verify_admin)):
+    return compression_stats.snapshot()
+
+@app.get("/debug/admission")
+async def admission_report(admin: dict = Depends(verify_admin)):
+    return admission.snapshot()
+
+@app.get("/debug/queries")
+async def query_report(
+    limit: int = Query(default=20, ge=1, le=500),
+    sort: str = Query(default="total", pattern="^(total|mean|max|calls)$"),
+    admin: dict = Depends(verify_admin)
+):
+    return {**query_log.report(limit, sort), "pool": db_pool.snapshot()}
+
+@app.delete("/debug/queries")
+async def reset_query_report(admin: dict = Depends(verify_admin)):
+    query_log.reset()
+    return {"message": "Query stats reset"}
+
+@app.get("/debug/payments")
+async def payments_report(admin: dict = Depends(verify_admin)):
+    return payment_queue.snapshot()
+
 @app.post("/payments/process")
-async def process_payment(payment: PaymentRequest, payload: dict = Depends(verify_token), credentials: HTTPAuthorizationCredentials = Depends(security)):
-    # Simulate payment processing
-    # In production, integrate with actual payment gateway (Razorpay, Stripe, etc.)
+async def process_payment(payment: PaymentRequest, request: Request, payload: dict = Depends(verify_token)):
+    # Payments are queued and authorized by the worker pool (processing.py).
+    # With "Prefer: respond-async" this answers 202 with the pending payment
+    # right away; otherwise it waits for the outcome like before
+    if payment.payment_method not in GATEWAYS:
+        raise HTTPException(status_code=400, detail="Unsupported payment method")
     
     payment_id = generate_payment_id()
-    transaction_id = generate_transaction_id()
     card_last_four = payment.card_number[-4:] if payment.card_number else None
     
-    # Simulate payment success (90% success rate for demo)
-    import random
-    payment_success = random.random() < 0.95  # 95% success rate
-    status = "completed" if payment_success else "failed"
-    
     conn = get_db_connection()
     cur = conn.cursor()
     cur.execute("""
         INSERT INTO payments (payment_id, order_id, user_id, amount, payment_method, 
-                            card_last_four, card_holder_name, status, transaction_id)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                            card_last_four, card_holder_name, status, settle)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, 'pending', %s)
     """, (
         payment_id,
         payment.order_id,
@@ -133,89 +370,114 @@ async def process_payment(payment: PaymentRequest, payload: dict = Depends(verif
         payment.payment_method,
         card_last_four,
         payment.card_holder_name,
-        status,
-        transaction_id if payment_success else None
+        payment.settle
     ))
     conn.commit()
     cur.close()
     conn.close()
+    payment_queue.poke()
     
-    if payment_success:
-        # Update order payment status
-        try:
-            async with httpx.AsyncClient() as client:
-                await client.put(
-                    f"{ORDER_SERVICE_URL}/orders/{payment.order_id}/payment",
-                    params={"payment_id": payment_id, "status": "completed"}
-                )
-                # Clear cart after successful payment
-                headers = {"Authorization": f"Bearer {credentials.credentials}"}
-                await client.delete(f"{CART_SERVICE_URL}/cart", headers=headers)
-        except:
-            pass
-        
+    pending = {
+        "success": False,
+        "status": "pending",
+        "message": "Payment is being processed",
+        "payment_id": payment_id,
+        "order_id": payment.order_id,
+        "amount": payment.amount
+    }
+    if "respond-async" in request.headers.get("prefer", ""):
+        return JSONResponse(status_code=202, content=pending)
+    
+    result = await wait_for_payment(payment_id, payload["user_id"], PAYMENT_SYNC_TIMEOUT)
+    if result["status"] == "completed":
         return {
             "success": True,
+            "status": "completed",
             "message": "Payment successful!",
             "payment_id": payment_id,
-            "transaction_id": transaction_id,
+            "transaction_id": result["transaction_id"],
             "order_id": payment.order_id,
             "amount": payment.amount
         }
-    else:
+    if result["status"] == "failed":
         raise HTTPException(
             status_code=400,
             detail="Payment failed. Please try again or use a different payment method."
         )
+    pending["status"] = result["status"]
+    return JSONResponse(status_code=202, content=pending)
+
+@app.get("/payments/export")
+async def export_payments(
+    format: str = "ndjson",
+    since: Optional[Union[datetime, date]] = None,
+    until: Optional[Union[datetime, date]] = None,
+    status: Optional[str] = None,
+    payload: dict = Depends(verify_admin)
+):
+    where, params = date_filter("created_at", since, until)
+    if status:
+        where += (" AND" if where else " WHERE") + " status = %s"
+        params.append(status)
+    return export_response(get_db_connection, "payments", where, params, format, "payments")
+
+@app.get("/payments/archive")
+async def list_archived_payments(payload: dict = Depends(verify_admin)):
+    return await asyncio.to_thread(partitions.archived_months, ARCHIVE_DIR, "payments")
+
+@app.get("/payments/archive/{month}")
+async def query_archived_payments(
+    month: str,
+    user_id: Optional[int] = None,
+    order_id: Optional[str] = None,
+    payment_id: Optional[str] = None,
+    status: Optional[str] = None,
+    limit: Optional[int] = None,
+    payload: dict = Depends(verify_admin)
+):
+    first = partitions.parse_month(month)
+    if first is None:
+        raise HTTPException(status_code=400, detail="month must be YYYY-MM")
+    path = partitions.archive_path(ARCHIVE_DIR, partitions.partition_name("payments", first))
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Month not archived")
+    filters = {"user_id": user_id, "order_id": order_id, "payment_id": payment_id, "status": status}
+    filters = {field: str(value) for field, value in filters.items() if value is not None}
+    return StreamingResponse(partitions.stream_archive(path, filters, limit), media_type="application/x-ndjson")
 
 @app.get("/payments/{payment_id}")
-async def get_payment(payment_id: str, payload: dict = Depends(verify_token)):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT payment_id, order_id, amount, payment_method, card_last_four,
-               status, transaction_id, created_at
-        FROM payments WHERE payment_id = %s AND user_id = %s
-    """, (payment_id, payload["user_id"]))
-    payment = cur.fetchone()
-    cur.close()
-    conn.close()
-    
+async def get_payment(payment_id: str, wait: float = 0, payload: dict = Depends(verify_token)):
+    # wait (seconds) long-polls until the payment is completed or failed
+    payment = await wait_for_payment(payment_id, payload["user_id"], min(max(wait, 0), PAYMENT_WAIT_MAX))
     if not payment:
         raise HTTPException(status_code=404, detail="Payment not found")
-    return dict(payment)
+    return FastJSONResponse(payment)
 
 @app.get("/payments/order/{order_id}")
 async def get_payment_by_order(order_id: str, payload: dict = Depends(verify_token)):
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute("""
-        SELECT payment_id, order_id, amount, payment_method, card_last_four,
-               status, transaction_id, created_at
-        FROM payments WHERE order_id = %s AND user_id = %s
-    """, (order_id, payload["user_id"]))
+    execute_prepared(cur, PAYMENT_BY_ORDER, (order_id, payload["user_id"]))
     payment = cur.fetchone()
     cur.close()
     conn.close()
     
     if not payment:
         raise HTTPException(status_code=404, detail="Payment not found")
-    return dict(payment)
+    return FastJSONResponse(payment)
 
 @app.get("/payments")
 async def get_user_payments(payload: dict = Depends(verify_token)):
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute("""
-        SELECT payment_id, order_id, amount, payment_method, status, created_at
-        FROM payments WHERE user_id = %s ORDER BY created_at DESC
-    """, (payload["user_id"],))
+    execute_prepared(cur, USER_PAYMENTS, (payload["user_id"],))
     payments = cur.fetchall()
     cur.close()
     conn.close()
     
-    return [dict(p) for p in payments]
+    return FastJSONResponse(payments)
 
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    import sys
+    from .serve import Launcher
+    sys.exit(Launcher().run())
@@ -0,0 +1,294 @@
+"""Monthly range partitions on created_at, and archival of old months.
+
+A partitioned table gets one partition per calendar month (`orders_2026_10`)
+plus a default partition that only catches rows no month partition covers,
+so an insert never fails because maintenance fell behind. Partitions are kept
+MONTHS_AHEAD months ahead of the clock. A plain table of the same name, left
+by an older version of the service, is converted in place on install.
+
+Unique constraints on a partitioned table must include created_at, so a key
+that has to be unique on its own (order_id, payment_id) is claimed in a small
+unpartitioned key table by a trigger, in the inserting transaction.
+
+Archival detaches month partitions older than the retention period, writes
+each one to a gzipped NDJSON file (one row_to_json line per row, in id order)
+next to a small JSON manifest, and drops it. A partition is only dropped once
+its file is complete, and a detached partition left over by an interrupted
+run is archived on the next one. Archived months stay queryable by scanning
+their file.
+"""
+import asyncio
+import gzip
+import json
+import os
+import re
+import uuid
+from datetime import date, datetime
+
+import orjson
+import psycopg2.extensions
+
+MONTHS_AHEAD = 3
+BATCH_SIZE = 2000
+MONTH = re.compile(r"^(\d{4})-(\d{2})$")
+
+
+def month_start(day):
+    return date(day.year, day.month, 1)
+
+
+def add_months(month, n):
+    index = month.year * 12 + month.month - 1 + n
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table, month):
+    return f"{table}_{month:%Y_%m}"
+
+
+def parse_month(text):
+    """`2026-10` -> date(2026, 10, 1), or None."""
+    match = MONTH.match(text)
+    if match is None or not 1 <= int(match.group(2)) <= 12:
+        return None
+    return date(int(match.group(1)), int(match.group(2)), 1)
+
+
+def create_partitions(cur, table, first, last):
+    """Create the month partitions of `table` from `first` through `last`."""
+    month = month_start(first)
+    while month <= last:
+        cur.execute(
+            f"CREATE TABLE IF NOT EXISTS {partition_name(table, month)} PARTITION OF {table} "
+            "FOR VALUES FROM (%s) TO (%s)",
+            (month, add_months(month, 1))
+        )
+        month = add_months(month, 1)
+
+
+def ensure_partitions(cur, table, months_ahead=MONTHS_AHEAD):
+    # Replicas starting together would otherwise race on the same CREATE
+    cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (f"partitions:{table}",))
+    this_month = month_start(date.today())
+    create_partitions(cur, table, this_month, add_months(this_month, months_ahead))
+    cur.execute(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT")
+
+
+def unique_key(cur, table, column):
+    """Keep `column` of `table` unique across partitions via the `{column}s` table."""
+    keys = f"{column}s"
+    cur.execute("SELECT to_regclass(%s) IS NULL AS missing", (keys,))
+    missing = cur.fetchone()["missing"]
+    cur.execute(f"CREATE TABLE IF NOT EXISTS {keys} ({column} VARCHAR(100) PRIMARY KEY)")
+    if missing:
+        # Rows from before the key table; any duplicates among them stay as they are
+        cur.execute(f"INSERT INTO {keys} SELECT {column} FROM {table} ON CONFLICT DO NOTHING")
+    cur.execute(f"""
+        CREATE OR REPLACE FUNCTION claim_{column}() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO {keys} ({column}) VALUES (NEW.{column});
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    cur.execute(f"""
+        CREATE OR REPLACE TRIGGER {table}_{column}_unique
+            AFTER INSERT ON {table} FOR EACH ROW EXECUTE FUNCTION claim_{column}()
+    """)
+
+
+def install(cur, table, ddl, months_ahead=MONTHS_AHEAD):
+    """Create `table` from `ddl` (CREATE TABLE IF NOT EXISTS ... PARTITION BY
+    RANGE (created_at)) with its partitions, converting a plain table of the
+    same name. `ddl` takes its id default from the `{table}_id_seq` sequence,
+    which is kept across the conversion.
+    """
+    cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (f"partitions:{table}",))
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (table,))
+    row = cur.fetchone()
+    legacy = f"{table}_unpartitioned"
+    if row is not None and row["relkind"] == "r":
+        # Free the old names: the sequence outlives the old table, and its
+        # indexes would push the new ones to orders_pkey1 and so on
+        cur.execute(f"ALTER SEQUENCE IF EXISTS {table}_id_seq OWNED BY NONE")
+        cur.execute(f"ALTER TABLE {table} RENAME TO {legacy}")
+        # Its triggers are bound to the new table's name; the copy is not a change
+        cur.execute(f"ALTER TABLE {legacy} DISABLE TRIGGER USER")
+        cur.execute("SELECT indexname FROM pg_indexes WHERE tablename = %s", (legacy,))
+        for index in [r["indexname"] for r in cur.fetchall()]:
+            cur.execute(f"ALTER INDEX {index} RENAME TO {index}_unpartitioned")
+    else:
+        legacy = None
+    cur.execute(f"CREATE SEQUENCE IF NOT EXISTS {table}_id_seq")
+    cur.execute(ddl)
+    cur.execute(f"ALTER SEQUENCE {table}_id_seq OWNED BY {table}.id")
+    ensure_partitions(cur, table, months_ahead)
+    if legacy is None:
+        return
+
+    cur.execute(f"SELECT MIN(created_at) AS first, MAX(created_at) AS last FROM {legacy}")
+    bounds = cur.fetchone()
+    if bounds["first"] is not None:
+        cur.execute(f"UPDATE {legacy} SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL")
+        create_partitions(cur, table, bounds["first"].date(), bounds["last"].date())
+    cur.execute(
+        "SELECT column_name FROM information_schema.columns WHERE table_name = %s "
+        "AND column_name IN (SELECT column_name FROM information_schema.columns WHERE table_name = %s) "
+        "ORDER BY ordinal_position",
+        (table, legacy)
+    )
+    columns = ", ".join(r["column_name"] for r in cur.fetchall())
+    cur.execute(f"INSERT INTO {table} ({columns}) SELECT {columns} FROM {legacy}")
+    # CASCADE takes along functions typed on the old row type (and their
+    # triggers); whoever owns them installs them again on the new table
+    cur.execute(f"DROP TABLE {legacy} CASCADE")
+    print(f"Converted {table} to monthly partitions")
+
+
+def archive_path(directory, name):
+    return os.path.join(directory, f"{name}.ndjson.gz")
+
+
+def write_archive(conn, name, directory):
+    """Write partition `name` to its archive file and manifest; return the manifest."""
+    path = archive_path(directory, name)
+    partial = f"{path}.partial"
+    rows = 0
+    cur = conn.cursor(name=f"archive_{uuid.uuid4().hex}", cursor_factory=psycopg2.extensions.cursor)
+    try:
+        cur.execute(f"SELECT row_to_json(t)::text FROM {name} t ORDER BY t.id")
+        with open(partial, "wb") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="wb") as out:
+                while True:
+                    batch = cur.fetchmany(BATCH_SIZE)
+                    if not batch:
+                        break
+                    out.write(("\n".join(row[0] for row in batch) + "\n").encode())
+                    rows += len(batch)
+            raw.flush()
+            os.fsync(raw.fileno())
+    finally:
+        cur.close()
+    os.replace(partial, path)
+    manifest = {
+        "partition": name,
+        "rows": rows,
+        "bytes": os.path.getsize(path),
+        "archived_at": datetime.now().isoformat(timespec="seconds"),
+    }
+    with open(os.path.join(directory, f"{name}.json"), "w") as out:
+        json.dump(manifest, out)
+    return manifest
+
+
+def archive(connect, table, retention_months, directory):
+    """Move month partitions of `table` older than `retention_months` to files."""
+    cutoff = add_months(month_start(date.today()), -retention_months)
+    os.makedirs(directory, exist_ok=True)
+    pattern = f"^{table}_[0-9]{{4}}_[0-9]{{2}}$"
+    archived = []
+    conn = connect()
+    try:
+        cur = conn.cursor()
+        # Held until the connection closes; another replica already at it wins
+        cur.execute("SELECT pg_try_advisory_lock(hashtext(%s)) AS locked", (f"archive:{table}",))
+        if not cur.fetchone()["locked"]:
+            return archived
+        cur.execute(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = to_regclass(%s) AND c.relname ~ %s",
+            (table, pattern)
+        )
+        for name in sorted(r["relname"] for r in cur.fetchall()):
+            if date(int(name[-7:-3]), int(name[-2:]), 1) < cutoff:
+                cur.execute(f"ALTER TABLE {table} DETACH PARTITION {name}")
+        conn.commit()
+        # Detached above, or by a run that stopped before dropping them
+        cur.execute(
+            "SELECT relname FROM pg_class WHERE relkind = 'r' AND NOT relispartition "
+            "AND pg_table_is_visible(oid) AND relname ~ %s ORDER BY relname",
+            (pattern,)
+        )
+        for name in [r["relname"] for r in cur.fetchall()]:
+            archived.append(write_archive(conn, name, directory))
+            cur.execute(f"DROP TABLE {name}")
+            conn.commit()
+        cur.close()
+    finally:
+        conn.close()
+    return archived
+
+
+def maintain(connect, table, retention_months, directory):
+    conn = connect()
+    try:
+        cur = conn.cursor()
+        ensure_partitions(cur, table)
+        conn.commit()
+        cur.close()
+    finally:
+        conn.close()
+    if retention_months:
+        for manifest in archive(connect, table, retention_months, directory):
+            print(f"Archived {manifest['partition']}: {manifest['rows']} rows")
+
+
+async def run(connect, table, retention_months, directory, interval=6 * 3600.0):
+    while True:
+        try:
+            await asyncio.to_thread(maintain, connect, table, retention_months, directory)
+        except Exception as e:
+            print(f"Partition maintenance error ({table}): {e}")
+        await asyncio.sleep(interval)
+
+
+def archived_months(directory, table):
+    """Manifests of the archived months of `table`, oldest first."""
+    if not os.path.isdir(directory):
+        return []
+    manifests = []
+    prefix = f"{table}_"
+    for filename in sorted(os.listdir(directory)):
+        if filename.startswith(prefix) and filename.endswith(".json"):
+            with open(os.path.join(directory, filename)) as f:
+                manifest = json.load(f)
+            name = manifest["partition"]
+            manifests.append({"month": f"{name[-7:-3]}-{name[-2:]}", **manifest})
+    return manifests
+
+
+def read_archive(path, filters, limit):
+    """Yield batches of matching NDJSON lines; `filters` maps field -> string value."""
+    batch = []
+    matched = 0
+    with gzip.open(path, "rb") as lines:
+        for line in lines:
+            if filters:
+                row = orjson.loads(line)
+                if any(str(row.get(field)) != value for field, value in filters.items()):
+                    continue
+            batch.append(line if line.endswith(b"\n") else line + b"\n")
+            matched += 1
+            if matched == limit or len(batch) == BATCH_SIZE:
+                yield b"".join(batch)
+                batch = []
+                if matched == limit:
+                    return
+    if batch:
+        yield b"".join(batch)
+
+
+async def stream_archive(path, filters, limit):
+    # The gzip file is read in a worker thread a batch at a time
+    batches = read_archive(path, filters, limit)
+    done = object()
+    try:
+        while True:
+            chunk = await asyncio.to_thread(next, batches, done)
+            if chunk is done:
+                break
+            yield chunk
+    finally:
+        # A cancelled request can leave next() running in its thread
+        if not batches.gi_running:
+            batches.close()
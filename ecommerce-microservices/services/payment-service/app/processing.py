@@ -0,0 +1,199 @@
+"""Asynchronous payment processing.
+
+The payments table is the queue: a payment is stored `pending`, so it
+survives a restart and any replica can process it. Workers claim pending
+rows with FOR UPDATE SKIP LOCKED (marking them `processing`), authorize them
+with the gateway for their payment method and record the outcome,
+`completed` or `failed`; an approved payment is then settled (order marked
+paid, cart cleared). A row left `processing` by a worker that died goes back
+to `pending` after `stale_after` seconds, and fails after `max_attempts`.
+
+At most `workers` payments run at once, and at most a gateway's limit per
+gateway. Rows are only claimed for gateways with a free slot, so a slow
+gateway never holds up the others. A new payment pokes the local pool;
+payments queued on another replica are picked up on the next poll.
+"""
+import asyncio
+
+from .gateway import GATEWAYS
+
+# One statement claims for every gateway with free slots: up to `n` of the
+# oldest pending payments for each comma-separated list of methods, and the
+# oldest `room` of those overall (the rest are only locked until commit)
+CLAIM = """
+    WITH next AS (
+        SELECT q.id, q.created_at
+        FROM unnest(%(methods)s::text[], %(limits)s::int[]) AS w(methods, n),
+        LATERAL (
+            SELECT id, created_at FROM payments
+            WHERE status = 'pending' AND payment_method = ANY(string_to_array(w.methods, ','))
+            ORDER BY id LIMIT w.n
+            FOR UPDATE SKIP LOCKED
+        ) q
+        ORDER BY q.id LIMIT %(room)s
+    )
+    UPDATE payments p SET status = 'processing', attempts = p.attempts + 1, claimed_at = CURRENT_TIMESTAMP
+    FROM next WHERE p.id = next.id AND p.created_at = next.created_at
+    RETURNING p.*
+"""
+
+# Only the worker holding the claim records an outcome; one that outlived
+# `stale_after` finds the row already reclaimed or finished
+FINISH = """
+    UPDATE payments SET status = %(status)s, transaction_id = %(transaction_id)s,
+                        failure_reason = %(reason)s, completed_at = CURRENT_TIMESTAMP
+    WHERE id = %(id)s AND created_at = %(created_at)s AND status = 'processing' AND attempts = %(attempts)s
+"""
+
+RELEASE_STALE = """
+    UPDATE payments
+    SET status = CASE WHEN attempts >= %(max_attempts)s THEN 'failed' ELSE 'pending' END,
+        failure_reason = CASE WHEN attempts >= %(max_attempts)s THEN 'gateway timeout' END
+    WHERE status = 'processing' AND claimed_at < CURRENT_TIMESTAMP - %(stale_after)s * INTERVAL '1 second'
+"""
+
+FINAL_STATUSES = ("completed", "failed")
+
+
+def parse_limits(spec):
+    """`card=8,upi=4` -> {"card": 8, "upi": 4}."""
+    limits = {}
+    for item in spec.split(","):
+        name, _, value = item.strip().partition("=")
+        if name and value:
+            limits[name] = int(value)
+    return limits
+
+
+class PaymentQueue:
+    def __init__(self, connect, gateway, settle, workers=16, limits=None,
+                 poll_interval=1.0, stale_after=120.0, max_attempts=3):
+        self.connect = connect
+        self.gateway = gateway
+        self.settle = settle
+        self.workers = workers
+        self.limits = limits or {}
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.max_attempts = max_attempts
+        self.methods = {}  # gateway -> payment methods it handles
+        self.gateway_of = GATEWAYS
+        for method, name in GATEWAYS.items():
+            self.methods.setdefault(name, []).append(method)
+        self.busy = dict.fromkeys(self.methods, 0)
+        self.processed = 0
+        self._waiters = {}  # payment_id -> futures resolved when this replica finishes it
+        self._tasks = set()
+        self._wake = None
+
+    def poke(self):
+        """Claim right away, e.g. after this replica queued a payment."""
+        if self._wake is not None:
+            self._wake.set()
+
+    def snapshot(self):
+        return {
+            "workers": self.workers,
+            "busy": dict(self.busy),
+            "limits": {name: self.limits.get(name, self.workers) for name in self.methods},
+            "processed": self.processed,
+            "waiters": sum(len(futures) for futures in self._waiters.values()),
+        }
+
+    async def wait(self, payment_id, timeout):
+        """Wait until this replica finishes `payment_id`; False on timeout."""
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(payment_id, []).append(future)
+        try:
+            await asyncio.wait_for(future, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            futures = self._waiters.get(payment_id, [])
+            if future in futures:
+                futures.remove(future)
+            if not futures:
+                self._waiters.pop(payment_id, None)
+
+    def _resolve(self, payment_id):
+        for future in self._waiters.pop(payment_id, []):
+            if not future.done():
+                future.set_result(None)
+
+    def _free(self):
+        """Free slots in the pool, and per gateway (capped by the pool's)."""
+        room = self.workers - sum(self.busy.values())
+        free = {}
+        for name in self.methods:
+            slots = min(self.limits.get(name, self.workers) - self.busy[name], room)
+            if slots > 0:
+                free[name] = slots
+        return room, free
+
+    def _execute(self, query, params, fetch=False):
+        conn = self.connect()
+        try:
+            cur = conn.cursor()
+            cur.execute(query, params)
+            rows = cur.fetchall() if fetch else cur.rowcount
+            conn.commit()
+            cur.close()
+            return rows
+        finally:
+            conn.close()
+
+    async def run(self):
+        self._wake = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        release_at = 0.0
+        while True:
+            try:
+                if loop.time() >= release_at:
+                    await asyncio.to_thread(self._execute, RELEASE_STALE, {
+                        "stale_after": self.stale_after, "max_attempts": self.max_attempts
+                    })
+                    release_at = loop.time() + self.stale_after / 4
+                room, free = self._free()
+                if free:
+                    rows = await asyncio.to_thread(self._execute, CLAIM, {
+                        "methods": [",".join(self.methods[name]) for name in free],
+                        "limits": list(free.values()),
+                        "room": room,
+                    }, True)
+                    for payment in rows:
+                        name = self.gateway_of[payment["payment_method"]]
+                        self.busy[name] += 1
+                        task = asyncio.ensure_future(self._process(name, payment))
+                        self._tasks.add(task)
+                        task.add_done_callback(self._tasks.discard)
+            except Exception as e:
+                print(f"Payment queue error: {e}")
+            # A finished payment frees a slot and pokes the loop
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    async def _process(self, name, payment):
+        try:
+            result = await self.gateway.authorize(payment)
+            finished = await asyncio.to_thread(self._execute, FINISH, {
+                "status": "completed" if result.approved else "failed",
+                "transaction_id": result.transaction_id,
+                "reason": result.reason,
+                "id": payment["id"],
+                "created_at": payment["created_at"],
+                "attempts": payment["attempts"],
+            })
+            if finished and result.approved:
+                await self.settle(payment)
+            self.processed += 1
+        except Exception as e:
+            # Left `processing`; retried once it goes stale
+            print(f"Payment processing error ({payment['payment_id']}): {e}")
+        finally:
+            self.busy[name] -= 1
+            self._resolve(payment["payment_id"])
+            self.poke()
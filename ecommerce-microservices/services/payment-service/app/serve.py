@@ -0,0 +1,218 @@
+"""Production launcher: pre-forked uvicorn workers on one listening socket.
+
+    python -m app.serve
+
+The parent binds HOST:PORT once and forks WEB_CONCURRENCY workers (default:
+the CPUs the container may use, from its cgroup quota or CPU affinity). Each
+worker runs uvicorn on the shared socket, with uvloop and httptools when they
+are installed. The first worker starts alone, so schema setup in the startup
+handlers runs once before the others race it. The parent only supervises:
+
+- a worker that exits is replaced; with MAX_REQUESTS set, a worker exits after
+  that many requests plus up to MAX_REQUESTS_JITTER more, so they don't all
+  recycle at once
+- SIGTERM/SIGINT are passed on; workers stop accepting, finish in-flight
+  requests for up to GRACEFUL_TIMEOUT seconds and run their shutdown handlers,
+  and whatever is left after that is killed
+- workers that keep dying right after starting stop the launcher, so the pod
+  restarts instead of spinning
+
+DB_CONNECTION_BUDGET is the number of Postgres connections the whole pod may
+use. A request holds at most one at a time, so each worker admits its share
+of the budget, less DB_BACKGROUND_CONNECTIONS for its background tasks
+(ADMISSION_MAX_CONCURRENCY, unless that is set), and keeps at most its share
+idle in its pool (DB_POOL_SIZE, likewise). WORKER_PROCESSES tells the app how
+many workers share the pod.
+"""
+import importlib.util
+import math
+import os
+import random
+import signal
+import sys
+import time
+import urllib.request
+
+import uvicorn
+
+APP = "app.main:app"
+STARTUP_TIMEOUT = 120.0
+CRASH_WINDOW = 5.0  # a worker dying sooner than this after starting counts as a crash
+MAX_CRASHES = 5
+
+
+def cgroup_cpus():
+    """CPU quota of this container, or None when it has none."""
+    try:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        return None if quota == "max" else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        return quota / period if quota > 0 else None
+    except (OSError, ValueError):
+        return None
+
+
+def cpu_count():
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+    quota = cgroup_cpus()
+    if quota:
+        cpus = min(cpus, math.ceil(quota))
+    return max(1, cpus)
+
+
+def installed(module):
+    return importlib.util.find_spec(module) is not None
+
+
+def size_workers(workers):
+    """Per-worker settings, exported before forking so every worker inherits them."""
+    os.environ["WORKER_PROCESSES"] = str(workers)
+    budget = os.environ.get("DB_CONNECTION_BUDGET")
+    if not budget:
+        return
+    share = max(1, int(budget) // workers)
+    if "ADMISSION_MAX_CONCURRENCY" not in os.environ:
+        reserve = int(os.environ.get("DB_BACKGROUND_CONNECTIONS", "4"))
+        os.environ["ADMISSION_MAX_CONCURRENCY"] = str(max(1, share - reserve))
+    if "DB_POOL_SIZE" not in os.environ:
+        os.environ["DB_POOL_SIZE"] = str(min(share, 10))
+
+
+class Launcher:
+    def __init__(self):
+        self.host = os.environ.get("HOST", "0.0.0.0")
+        self.port = int(os.environ.get("PORT", "8000"))
+        self.workers = int(os.environ.get("WEB_CONCURRENCY", "0")) or cpu_count()
+        self.max_requests = int(os.environ.get("MAX_REQUESTS", "0"))
+        self.max_requests_jitter = int(os.environ.get("MAX_REQUESTS_JITTER", "0"))
+        self.graceful_timeout = float(os.environ.get("GRACEFUL_TIMEOUT", "30"))
+        self.loop = "uvloop" if installed("uvloop") else "asyncio"
+        self.http = "httptools" if installed("httptools") else "h11"
+        self.children = {}  # pid -> start time
+        self.crashes = 0
+        self.stopping = False
+        self.deadline = None
+
+    def config(self):
+        max_requests = None
+        if self.max_requests:
+            max_requests = self.max_requests + random.randint(0, self.max_requests_jitter)
+        return uvicorn.Config(
+            APP,
+            host=self.host,
+            port=self.port,
+            loop=self.loop,
+            http=self.http,
+            # Forwarding headers are interpreted by the admission
+            # middleware against TRUSTED_PROXIES, not by uvicorn
+            proxy_headers=False,
+            limit_max_requests=max_requests,
+            timeout_graceful_shutdown=self.graceful_timeout,
+        )
+
+    def spawn(self):
+        # Built per spawn, so every worker draws its own jitter
+        config = self.config()
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time.monotonic()
+            return pid
+        status = 1
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            uvicorn.Server(config).run(sockets=[self.socket])
+            status = 0
+        finally:
+            os._exit(status)
+
+    def wait_ready(self, pid):
+        """Wait until the first worker answers /health (its startup has finished)."""
+        host = "127.0.0.1" if self.host in ("0.0.0.0", "") else self.host
+        url = f"http://{host}:{self.port}/health"
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline and not self.stopping:
+            if os.waitpid(pid, os.WNOHANG)[0]:
+                self.children.pop(pid, None)
+                return False
+            try:
+                with urllib.request.urlopen(url, timeout=1):
+                    return True
+            except OSError:
+                time.sleep(0.2)
+        return False
+
+    def stop(self, signum, frame):
+        if not self.stopping:
+            self.stopping = True
+            self.deadline = time.monotonic() + self.graceful_timeout + 5
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        size_workers(self.workers)
+        self.socket = self.config().bind_socket()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        print(
+            f"Starting {self.workers} workers on {self.host}:{self.port} "
+            f"(loop={self.loop}, http={self.http}, max_requests={self.max_requests or 'off'})",
+            flush=True
+        )
+        ready = self.wait_ready(self.spawn())
+        if self.stopping:
+            return self.reap()
+        if not ready:
+            print("First worker did not start; stopping", flush=True)
+            self.stop(signal.SIGTERM, None)
+            self.reap()
+            return 1
+        for _ in range(self.workers - 1):
+            self.spawn()
+        return self.reap()
+
+    def reap(self):
+        status = 0
+        while self.children:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                if self.stopping and time.monotonic() > self.deadline:
+                    for pid in self.children:
+                        os.kill(pid, signal.SIGKILL)
+                    self.deadline = float("inf")
+                time.sleep(0.2)
+                continue
+            started = self.children.pop(pid, None)
+            if self.stopping or started is None:
+                continue
+            if time.monotonic() - started < CRASH_WINDOW:
+                self.crashes += 1
+                if self.crashes >= MAX_CRASHES:
+                    print("Workers keep crashing on startup; stopping", flush=True)
+                    self.stop(signal.SIGTERM, None)
+                    status = 1
+                    continue
+                time.sleep(1)
+            else:
+                self.crashes = 0
+            self.spawn()
+        self.socket.close()
+        return status
+
+
+if __name__ == "__main__":
+    sys.exit(Launcher().run())
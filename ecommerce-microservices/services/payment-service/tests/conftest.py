@@ -0,0 +1,76 @@
+"""Shared fixtures for the payment service tests.
+
+The queue lives in Postgres, so these tests need a server: TEST_DB_HOST,
+TEST_DB_PORT, TEST_DB_USER and TEST_DB_PASSWORD (defaults match the local
+docker-compose database). Each run creates its own scratch database and drops
+it afterwards; without a reachable server the tests are skipped.
+"""
+import os
+import sys
+import uuid
+
+import psycopg2
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+SERVER = {
+    "host": os.environ.get("TEST_DB_HOST", "localhost"),
+    "port": os.environ.get("TEST_DB_PORT", "5432"),
+    "user": os.environ.get("TEST_DB_USER", "postgres"),
+    "password": os.environ.get("TEST_DB_PASSWORD", "postgres123"),
+}
+
+
+def admin_connection():
+    conn = psycopg2.connect(database="postgres", connect_timeout=3, **SERVER)
+    conn.autocommit = True
+    return conn
+
+
+@pytest.fixture(scope="session")
+def service():
+    """app.main, pointed at a fresh database with its schema installed."""
+    try:
+        conn = admin_connection()
+    except psycopg2.OperationalError as e:
+        pytest.skip(f"Postgres not available: {e}")
+    name = f"paymentdb_test_{uuid.uuid4().hex[:8]}"
+    cur = conn.cursor()
+    cur.execute(f"CREATE DATABASE {name}")
+    os.environ.update({
+        "DB_HOST": SERVER["host"],
+        "DB_PORT": SERVER["port"],
+        "DB_USER": SERVER["user"],
+        "DB_PASSWORD": SERVER["password"],
+        "DB_NAME": name,
+    })
+    from app import main
+    main.init_db()
+    yield main
+    cur.execute(f"DROP DATABASE {name} WITH (FORCE)")
+    cur.close()
+    conn.close()
+
+
+@pytest.fixture
+def db(service):
+    """An empty payments queue; returns a function that queues payments."""
+    conn = service.open_db_connection()
+    cur = conn.cursor()
+    cur.execute("TRUNCATE payments, payment_ids")
+    conn.commit()
+
+    def queue(method, count=1, settle=False):
+        ids = [f"PAY-{uuid.uuid4().hex[:12].upper()}" for _ in range(count)]
+        for payment_id in ids:
+            cur.execute("""
+                INSERT INTO payments (payment_id, order_id, user_id, amount, payment_method, status, settle)
+                VALUES (%s, %s, 1, 10.00, %s, 'pending', %s)
+            """, (payment_id, f"ORD-{payment_id}", method, settle))
+        conn.commit()
+        return ids
+
+    yield queue
+    cur.close()
+    conn.close()
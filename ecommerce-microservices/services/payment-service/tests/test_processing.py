@@ -0,0 +1,161 @@
+import asyncio
+import time
+
+import jwt
+from fastapi.testclient import TestClient
+
+from app.gateway import GATEWAYS, FakeGateway
+from app.processing import CLAIM, PaymentQueue
+
+
+class CountingGateway(FakeGateway):
+    """FakeGateway that records the most payments it held at once per gateway."""
+
+    def __init__(self, latency):
+        super().__init__(latency=latency, success_rate=1.0)
+        self.active = {}
+        self.peak = {}
+
+    async def authorize(self, payment):
+        name = GATEWAYS[payment["payment_method"]]
+        self.active[name] = self.active.get(name, 0) + 1
+        self.peak[name] = max(self.peak.get(name, 0), self.active[name])
+        try:
+            return await super().authorize(payment)
+        finally:
+            self.active[name] -= 1
+
+
+def statuses(service):
+    conn = service.open_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT payment_id, status, attempts FROM payments")
+    rows = {row["payment_id"]: row for row in cur.fetchall()}
+    cur.close()
+    conn.close()
+    return rows
+
+
+async def drain(service, queues, timeout=15.0):
+    """Run `queues` until no payment is pending or processing."""
+    tasks = [asyncio.create_task(queue.run()) for queue in queues]
+    try:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            rows = await asyncio.to_thread(statuses, service)
+            if all(row["status"] in ("completed", "failed") for row in rows.values()):
+                return rows
+            await asyncio.sleep(0.05)
+        raise AssertionError("payments were not processed in time")
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def make_queue(service, gateway, settled, **options):
+    async def settle(payment):
+        settled.append(payment["payment_id"])
+    options.setdefault("poll_interval", 0.05)
+    return PaymentQueue(service.open_db_connection, gateway, settle, **options)
+
+
+def test_claim_skips_rows_locked_by_another_worker(service, db):
+    ids = db("credit_card", 4)
+    holder = service.open_db_connection()
+    cur = holder.cursor()
+    cur.execute("SELECT payment_id FROM payments WHERE payment_id = ANY(%s) FOR UPDATE", (ids[:2],))
+
+    queue = make_queue(service, FakeGateway(), [])
+    rows = queue._execute(CLAIM, {"methods": ["credit_card,debit_card"], "limits": [4], "room": 4}, True)
+    assert sorted(row["payment_id"] for row in rows) == sorted(ids[2:])
+    assert all(row["status"] == "processing" and row["attempts"] == 1 for row in rows)
+
+    holder.rollback()
+    rows = queue._execute(CLAIM, {"methods": ["credit_card,debit_card"], "limits": [4], "room": 4}, True)
+    assert sorted(row["payment_id"] for row in rows) == sorted(ids[:2])
+    cur.close()
+    holder.close()
+
+
+def test_replicas_never_process_a_payment_twice(service, db):
+    ids = db("credit_card", 20) + db("upi", 20)
+    settled = []
+    queues = [make_queue(service, FakeGateway(latency=0.01, success_rate=1.0), settled, workers=4)
+              for _ in range(3)]
+
+    rows = asyncio.run(drain(service, queues))
+
+    assert sorted(settled) == sorted(ids)
+    assert all(rows[payment_id]["status"] == "completed" for payment_id in ids)
+    assert all(rows[payment_id]["attempts"] == 1 for payment_id in ids)
+    assert sum(queue.processed for queue in queues) == len(ids)
+
+
+def test_gateway_limits_cap_concurrency(service, db):
+    db("credit_card", 6)
+    db("debit_card", 6)
+    db("upi", 8)
+    db("net_banking", 4)
+    gateway = CountingGateway(latency=0.05)
+    queue = make_queue(service, gateway, [], workers=16, limits={"card": 3, "upi": 2, "netbanking": 1})
+
+    asyncio.run(drain(service, [queue]))
+
+    assert gateway.peak == {"card": 3, "upi": 2, "netbanking": 1}
+    assert queue.busy == {"card": 0, "upi": 0, "netbanking": 0}
+    assert queue.processed == 24
+
+
+def test_pool_size_caps_all_gateways(service, db):
+    db("credit_card", 6)
+    db("upi", 6)
+    gateway = CountingGateway(latency=0.05)
+    queue = make_queue(service, gateway, [], workers=3)
+    peak = 0
+
+    async def watch():
+        nonlocal peak
+        while True:
+            peak = max(peak, sum(queue.busy.values()))
+            await asyncio.sleep(0.005)
+
+    async def scenario():
+        watcher = asyncio.create_task(watch())
+        try:
+            await drain(service, [queue])
+        finally:
+            watcher.cancel()
+
+    asyncio.run(scenario())
+    assert peak == 3
+    assert queue.processed == 12
+
+
+def test_respond_async_answers_202_before_the_gateway(service, db):
+    token = jwt.encode({"user_id": 42, "email": "buyer@example.com"}, service.JWT_SECRET, algorithm="HS256")
+    headers = {"Authorization": f"Bearer {token}"}
+    body = {"order_id": "ORD-ASYNC", "amount": 25.0, "payment_method": "upi",
+            "upi_id": "buyer@upi", "settle": False}
+    service.payment_queue.gateway = FakeGateway(latency=0.5, success_rate=1.0)
+
+    with TestClient(service.app) as client:
+        started = time.monotonic()
+        response = client.post("/payments/process", json=body,
+                               headers={**headers, "Prefer": "respond-async"})
+        assert time.monotonic() - started < 0.5
+        assert response.status_code == 202
+        pending = response.json()
+        assert pending["status"] == "pending"
+        assert pending["order_id"] == "ORD-ASYNC"
+
+        response = client.get(f"/payments/{pending['payment_id']}", params={"wait": 5}, headers=headers)
+        assert response.status_code == 200
+        payment = response.json()
+        assert payment["status"] == "completed"
+        assert payment["transaction_id"].startswith("TXN")
+
+        # Without the preference the request waits for the outcome
+        response = client.post("/payments/process", json={**body, "order_id": "ORD-SYNC"}, headers=headers)
+        assert response.status_code == 200
+        assert response.json()["status"] == "completed"
@@ -0,0 +1,268 @@
+"""Typeahead autocomplete over product names, brands and categories.
+
+Every searchable term lives in one sorted list of (term, kind, ref) entries:
+a product name and each of its later words (so "max" finds "Nike Air Max
+270"), and the same for every brand and category. A prefix lookup is two
+binary searches; the matching slice is ranked by weight, which for a product
+is its rating scaled by log(1 + reviews_count) and for a brand or category
+the sum over its products.
+
+Prefixes matching more entries than can be ranked per keystroke (a letter or
+two on a large catalog) keep a precomputed top list instead. Those lists are
+built bottom-up when the index is built, by merging the rankings of the
+prefix one letter longer, and are patched in place when products change.
+
+The index follows the change feed: changed products are reloaded in a
+debounced batch and applied in place; a resync or a large batch rebuilds the
+index in a worker thread and swaps it in.
+"""
+import asyncio
+import bisect
+import heapq
+import math
+import re
+
+PRODUCT = 0
+BRAND = 1
+CATEGORY = 2
+KINDS = {PRODUCT: "product", BRAND: "brand", CATEGORY: "category"}
+
+MAX_LIMIT = 20
+WIDE_KEEP = 2 * MAX_LIMIT  # spare entries so a removal rarely forces a recompute
+SCAN_LIMIT = 512  # matching entries ranked per request; wider prefixes are precomputed
+FULL_REBUILD = 100  # changed products in one batch above which a rebuild is cheaper
+RETRY_DELAY = 5
+COLUMNS = "id, name, brand, category, price, image_url, rating, reviews_count"
+PUNCTUATION = re.compile(r"[^\w\s]+")
+LAST = "\U0010ffff"
+
+
+def normalize(text):
+    return " ".join(PUNCTUATION.sub("", text.casefold()).split())
+
+
+def terms(text):
+    words = normalize(text).split()
+    return {" ".join(words[i:]) for i in range(len(words))}
+
+
+def product_weight(row):
+    # Products without reviews still rank by rating
+    return float(row["rating"] or 0) * (1 + math.log1p(row["reviews_count"] or 0))
+
+
+class PrefixIndex:
+    def __init__(self, rows=()):
+        self.entries = []  # sorted (term, kind, ref); ref is a product id or a brand/category name
+        self.products = {}  # product id -> suggestion
+        self.weights = {}  # (kind, ref) -> weight
+        self.counts = {}  # (BRAND | CATEGORY, name) -> number of products
+        # prefix -> ([(weight, key)] best first, floor); every key of the
+        # prefix missing from the list weighs at most floor (None: none missing)
+        self.wide = {}
+        for row in rows:
+            self.entries.extend(self._add(row)[0])
+        self.entries.sort()
+        self._top("", 0, len(self.entries), WIDE_KEEP)
+
+    def suggest(self, prefix, limit):
+        lo = bisect.bisect_left(self.entries, (prefix,))
+        hi = bisect.bisect_left(self.entries, (prefix + LAST,), lo)
+        return [self.suggestion(key) for _, key in self._top(prefix, lo, hi, limit)[:limit]]
+
+    def suggestion(self, key):
+        kind, ref = key
+        if kind == PRODUCT:
+            return self.products[ref]
+        return {"type": KINDS[kind], "name": ref, "count": self.counts[key]}
+
+    def _rank(self, lo, hi, n):
+        # A key matching through several of its terms is listed once
+        keys = dict.fromkeys((kind, ref) for _, kind, ref in self.entries[lo:hi])
+        return heapq.nlargest(n, ((self.weights[key], key) for key in keys), key=lambda pair: pair[0])
+
+    def _top(self, prefix, lo, hi, n):
+        if hi - lo <= SCAN_LIMIT:
+            return self._rank(lo, hi, n)
+        if prefix in self.wide:
+            return self.wide[prefix][0]
+        # The best keys under `prefix` are among the best under each
+        # one-letter-longer prefix, plus the terms equal to `prefix`
+        i = bisect.bisect_left(self.entries, (prefix + "\0",), lo, hi)
+        candidates = dict((key, weight) for weight, key in self._rank(lo, i, WIDE_KEEP))
+        while i < hi:
+            child = self.entries[i][0][:len(prefix) + 1]
+            j = bisect.bisect_left(self.entries, (child + LAST,), i, hi)
+            candidates.update((key, weight) for weight, key in self._top(child, i, j, WIDE_KEEP))
+            i = j
+        ranked = heapq.nlargest(WIDE_KEEP, ((w, k) for k, w in candidates.items()), key=lambda pair: pair[0])
+        self.wide[prefix] = (ranked, ranked[-1][0] if len(ranked) == WIDE_KEEP else None)
+        return ranked
+
+    def _add(self, row):
+        """Index a product; return the entries to insert and the keys whose weight changed."""
+        weight = product_weight(row)
+        key = (PRODUCT, row["id"])
+        self.products[row["id"]] = {
+            "type": "product",
+            "id": row["id"],
+            "name": row["name"],
+            "brand": row["brand"],
+            "category": row["category"],
+            "price": row["price"],
+            "image_url": row["image_url"],
+        }
+        self.weights[key] = weight
+        added = [(term, *key) for term in terms(row["name"])]
+        changed = [key]
+        for group in ((BRAND, row["brand"]), (CATEGORY, row["category"])):
+            if not group[1]:
+                continue
+            self.weights[group] = self.weights.get(group, 0.0) + weight
+            self.counts[group] = self.counts.get(group, 0) + 1
+            if self.counts[group] == 1:
+                added.extend((term, *group) for term in terms(group[1]))
+            changed.append(group)
+        return added, changed
+
+    def _remove(self, product_id):
+        """Drop a product; return the entries to delete and the keys whose weight changed."""
+        product = self.products.pop(product_id, None)
+        if product is None:
+            return [], []
+        key = (PRODUCT, product_id)
+        weight = self.weights.pop(key)
+        removed = [(term, *key) for term in terms(product["name"])]
+        changed = [key]
+        for group in ((BRAND, product["brand"]), (CATEGORY, product["category"])):
+            if group not in self.counts:
+                continue
+            self.counts[group] -= 1
+            if self.counts[group] == 0:
+                del self.counts[group]
+                del self.weights[group]
+                removed.extend((term, *group) for term in terms(group[1]))
+            else:
+                self.weights[group] -= weight
+            changed.append(group)
+        return removed, changed
+
+    def _key_terms(self, key):
+        kind, ref = key
+        if kind == PRODUCT:
+            return terms(self.products[ref]["name"]) if ref in self.products else set()
+        return terms(ref)
+
+    def update(self, product_ids, rows):
+        """Replace `product_ids` with `rows` (products no longer there are dropped)."""
+        old_terms = {(PRODUCT, product_id): self._key_terms((PRODUCT, product_id)) for product_id in product_ids}
+        removed, added, changed = [], [], set()
+        for product_id in product_ids:
+            entries, keys = self._remove(product_id)
+            removed.extend(entries)
+            changed.update(keys)
+        for row in rows:
+            entries, keys = self._add(row)
+            added.extend(entries)
+            changed.update(keys)
+        for entry in removed:
+            i = bisect.bisect_left(self.entries, entry)
+            if i < len(self.entries) and self.entries[i] == entry:
+                del self.entries[i]
+        for entry in added:
+            bisect.insort(self.entries, entry)
+        self._patch_wide({key: (old_terms.get(key, set()), self._key_terms(key)) for key in changed})
+
+    def _patch_wide(self, changed):
+        # Cached prefixes of any term a changed key had or has; a shorter one
+        # may have been dropped while longer ones are still cached
+        affected = {}
+        for key, (old, new) in changed.items():
+            for term in old | new:
+                for length in range(len(term) + 1):
+                    if term[:length] in self.wide:
+                        affected.setdefault(term[:length], set()).add(key)
+        for prefix, keys in affected.items():
+            ranked, floor = self.wide[prefix]
+            pairs = [(weight, key) for weight, key in ranked if key not in keys]
+            for key in keys:
+                weight = self.weights.get(key)
+                if weight is None or (floor is not None and weight < floor):
+                    continue
+                if any(term.startswith(prefix) for term in changed[key][1]):
+                    pairs.append((weight, key))
+            pairs.sort(key=lambda pair: pair[0], reverse=True)
+            if len(pairs) > WIDE_KEEP:
+                pairs = pairs[:WIDE_KEEP]
+                floor = pairs[-1][0]
+            if floor is not None and len(pairs) < MAX_LIMIT:
+                del self.wide[prefix]  # recomputed from the longer prefixes on the next lookup
+            else:
+                self.wide[prefix] = (pairs, floor)
+
+class Autocomplete:
+    def __init__(self, connect, debounce=0.2):
+        self.connect = connect
+        self.debounce = debounce
+        self.index = PrefixIndex()
+        self.ready = False
+        self._pending = set()
+        self._resync = False
+        self._task = None
+
+    def suggest(self, query, limit=8):
+        prefix = normalize(query)
+        if not prefix:
+            return []
+        return self.index.suggest(prefix, min(limit, MAX_LIMIT))
+
+    def _load(self, product_ids=None):
+        conn = self.connect()
+        try:
+            cur = conn.cursor()
+            if product_ids is None:
+                cur.execute(f"SELECT {COLUMNS} FROM products")
+            else:
+                cur.execute(f"SELECT {COLUMNS} FROM products WHERE id = ANY(%s)", (list(product_ids),))
+            rows = cur.fetchall()
+            cur.close()
+            return rows
+        finally:
+            conn.close()
+
+    def _build(self):
+        return PrefixIndex(self._load())
+
+    async def rebuild(self):
+        self.index = await asyncio.to_thread(self._build)
+        self.ready = True
+
+    async def update(self, product_ids):
+        rows = await asyncio.to_thread(self._load, product_ids)
+        self.index.update(product_ids, rows)
+
+    def on_change(self, change):
+        # Stock is not indexed
+        if change["operation"] == "stock":
+            return
+        if change["product_id"] is None:
+            self._resync = True
+        else:
+            self._pending.add(change["product_id"])
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while self._resync or self._pending:
+            await asyncio.sleep(self.debounce)
+            product_ids, self._pending = self._pending, set()
+            resync, self._resync = self._resync, False
+            try:
+                if resync or len(product_ids) > FULL_REBUILD or not self.ready:
+                    await self.rebuild()
+                else:
+                    await self.update(product_ids)
+            except Exception as e:
+                print(f"Autocomplete refresh error: {e}")
+                self._resync = True
+                await asyncio.sleep(RETRY_DELAY)
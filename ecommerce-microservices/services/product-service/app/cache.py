@@ -0,0 +1,92 @@
+"""In-process read cache with request coalescing for hot product reads.
+
+Concurrent misses for the same key share one in-flight load (single-flight),
+so a viral product costs one query instead of hundreds. Entries are refreshed
+early with a probability that rises as they approach expiry (XFetch), which
+spreads refreshes out instead of having every worker miss at the same moment.
+
+Invalidation is per key: dropping one product leaves loads of every other key
+shareable. The first load of a key after it was invalidated goes through
+`fresh_loader` when one is given (e.g. a primary read), so a replica that has
+not replayed the write yet can't put the old row back for a whole TTL.
+"""
+import asyncio
+import math
+import random
+import time
+
+
+class SingleFlightCache:
+    def __init__(self, ttl=30.0, beta=1.0, max_entries=10000):
+        self.ttl = ttl
+        self.beta = beta
+        self.max_entries = max_entries
+        self._entries = {}  # key -> (value, load duration, expiry)
+        self._flights = {}  # key -> (version, in-flight load future)
+        self._epoch = 0  # bumped by invalidate(None)
+        self._versions = {}  # key -> bumped by invalidate(key)
+        self._invalidated = set()  # keys whose next load must use fresh_loader
+
+    def _version(self, key):
+        return self._epoch, self._versions.get(key, 0)
+
+    async def get(self, key, loader, fresh_loader=None):
+        """Return the cached value for `key`, running `loader` in a thread on a miss.
+
+        `fresh_loader`, when given, replaces `loader` for the first load after
+        `key` was invalidated.
+        """
+        if fresh_loader is not None and key in self._invalidated:
+            loader = fresh_loader
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, delta, expires = entry
+            now = time.monotonic()
+            if now < expires:
+                # XFetch: -log(rand) is exponentially distributed, so slow
+                # loads and entries close to expiry are refreshed earlier
+                if now - delta * self.beta * math.log(1.0 - random.random()) >= expires:
+                    self._start(key, loader)
+                return value
+        return await asyncio.shield(self._start(key, loader))
+
+    def invalidate(self, key=None):
+        """Drop one key, or everything when `key` is None."""
+        if key is None:
+            # Keys that were cached or loading are the ones a replica could
+            # hand back stale; the rest load as any cold key does
+            self._invalidated.update(self._entries)
+            self._invalidated.update(self._flights)
+            self._epoch += 1
+            self._entries.clear()
+        else:
+            self._invalidated.add(key)
+            self._versions[key] = self._versions.get(key, 0) + 1
+            self._entries.pop(key, None)
+
+    def _start(self, key, loader):
+        # Loads of `key` started before its invalidation are not joined by new readers
+        version = self._version(key)
+        flight = self._flights.get(key)
+        if flight is None or flight[0] != version:
+            future = asyncio.ensure_future(self._load(key, loader, version))
+            # Background refreshes may have no awaiter; retrieve their errors
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+            flight = self._flights[key] = (version, future)
+        return flight[1]
+
+    async def _load(self, key, loader, version):
+        try:
+            start = time.monotonic()
+            value = await asyncio.to_thread(loader)
+            finished = time.monotonic()
+            # Don't store a result that raced with an invalidation of its key
+            if version == self._version(key):
+                if len(self._entries) >= self.max_entries:
+                    self._entries.pop(next(iter(self._entries)))
+                self._entries[key] = (value, finished - start, finished + self.ttl)
+                self._invalidated.discard(key)
+            return value
+        finally:
+            if self._flights.get(key, (None,))[0] == version:
+                del self._flights[key]
@@ -0,0 +1,252 @@
+"""Catalog change feed.
+
+Every write to `products` is recorded by a trigger in the `product_changes`
+log table (one increasing version per event) and announced with NOTIFY.
+ChangeFeed listens on that channel from the event loop and wakes up
+long-poll/SSE readers and in-process subscribers.
+
+Writers don't wait for each other, so versions can commit out of order. The
+feed's `version` is therefore the newest *settled* version: every transaction
+that drew a version up to it has committed or rolled back, so readers that
+follow `version > since` up to it never skip an event. Stock events only keep
+the new stock, and events older than the retention period are pruned.
+"""
+import asyncio
+import json
+import psycopg2
+import psycopg2.extensions
+
+CHANNEL = "product_changes"
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS product_changes (
+        version BIGSERIAL PRIMARY KEY,
+        product_id INTEGER NOT NULL,
+        operation VARCHAR(20) NOT NULL,
+        product JSONB,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+
+    CREATE OR REPLACE FUNCTION record_product_change() RETURNS trigger AS $$
+    DECLARE
+        change_operation VARCHAR(20);
+        change_product JSONB;
+        change_id INTEGER;
+        change_version BIGINT;
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            change_operation := 'delete';
+            change_id := OLD.id;
+        ELSE
+            change_id := NEW.id;
+            change_product := to_jsonb(NEW);
+            IF TG_OP = 'INSERT' THEN
+                change_operation := 'create';
+            ELSIF change_product = to_jsonb(OLD) THEN
+                RETURN NULL;
+            ELSIF change_product - 'stock' = to_jsonb(OLD) - 'stock' THEN
+                -- The most frequent event; the rest of the row is unchanged
+                change_operation := 'stock';
+                change_product := jsonb_build_object('id', NEW.id, 'stock', NEW.stock);
+            ELSE
+                change_operation := 'update';
+            END IF;
+        END IF;
+
+        INSERT INTO product_changes (product_id, operation, product)
+        VALUES (change_id, change_operation, change_product)
+        RETURNING version INTO change_version;
+
+        PERFORM pg_notify('product_changes', json_build_object(
+            'version', change_version, 'product_id', change_id, 'operation', change_operation
+        )::text);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE TRIGGER products_change_feed
+        AFTER INSERT OR UPDATE OR DELETE ON products
+        FOR EACH ROW EXECUTE FUNCTION record_product_change();
+"""
+
+
+# Version sequence behind product_changes.version, read to find what to settle
+VERSION_SEQUENCE = "product_changes_version_seq"
+
+
+def prune(connect, retention_hours):
+    """Delete change events older than `retention_hours`; returns how many."""
+    conn = connect()
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            "DELETE FROM product_changes WHERE created_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 hour'",
+            (retention_hours,)
+        )
+        deleted = cur.rowcount
+        conn.commit()
+        cur.close()
+    finally:
+        conn.close()
+    return deleted
+
+
+async def retain(connect, retention_hours, interval=3600.0):
+    while True:
+        try:
+            deleted = await asyncio.to_thread(prune, connect, retention_hours)
+            if deleted:
+                print(f"Pruned {deleted} product changes")
+        except Exception as e:
+            print(f"Product change retention error: {e}")
+        await asyncio.sleep(interval)
+
+
+class ChangeFeed:
+    def __init__(self, connect, reconnect_delay=5, settle_delay=0.05, max_settle_delay=1.0):
+        self.connect = connect
+        self.reconnect_delay = reconnect_delay
+        self.settle_delay = settle_delay
+        self.max_settle_delay = max_settle_delay
+        self.version = 0  # newest settled version
+        self.lsn = None  # primary WAL position once `version` settled, as text
+        self.subscribers = []
+        self._conn = None
+        self._fd = None
+        self._changed = None
+        self._listened = False
+        self._announced = 0  # newest version seen in a notification
+        self._candidate = None  # (version, xmax) waiting for older writers to finish
+        self._retry_settle = None
+        self._delay = settle_delay
+
+    @property
+    def connected(self):
+        return self._conn is not None
+
+    def subscribe(self, callback):
+        """Call `callback(change)` for every change notification received.
+
+        After a reconnect, notifications may have been missed; subscribers then
+        get a single change with operation "resync" and product_id None.
+        """
+        self.subscribers.append(callback)
+
+    async def start(self):
+        self._changed = asyncio.Event()
+        self._listen()
+
+    def stop(self):
+        if self._retry_settle is not None:
+            self._retry_settle.cancel()
+            self._retry_settle = None
+        self._candidate = None
+        if self._conn is not None:
+            asyncio.get_running_loop().remove_reader(self._fd)
+            self._conn.close()
+            self._conn = None
+
+    async def wait(self, version, timeout):
+        """Wait until a change newer than `version` is settled; False on timeout."""
+        while self.version <= version:
+            changed = self._changed
+            try:
+                await asyncio.wait_for(changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    def _listen(self):
+        try:
+            conn = self.connect()
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            cur = conn.cursor()
+            cur.execute(f"LISTEN {CHANNEL}")
+            cur.close()
+        except psycopg2.Error as e:
+            print(f"Change feed listen error: {e}")
+            self._retry()
+            return
+        self._conn = conn
+        self._fd = conn.fileno()
+        asyncio.get_running_loop().add_reader(self._fd, self._on_readable)
+        self._settle()
+        if self._listened:
+            self._notify({"version": self.version, "product_id": None, "operation": "resync"})
+        self._listened = True
+
+    def _retry(self):
+        asyncio.get_running_loop().call_later(self.reconnect_delay, self._listen)
+
+    def _on_readable(self):
+        try:
+            self._conn.poll()
+        except psycopg2.Error as e:
+            self._lost(e)
+            return
+        while self._conn.notifies:
+            change = json.loads(self._conn.notifies.pop(0).payload)
+            self._announced = max(self._announced, change["version"])
+            self._notify(change)
+        if self._announced > self.version:
+            # A commit may be the open writer a scheduled retry is waiting on
+            if self._retry_settle is not None:
+                self._retry_settle.cancel()
+            self._settle()
+
+    def _lost(self, error):
+        print(f"Change feed connection lost: {error}")
+        self.stop()
+        self._retry()
+
+    def _settle(self):
+        # Versions are drawn inside the writing transaction, after its first
+        # write, so each one drawn so far belongs to a transaction with an xid
+        # below the xmax of a snapshot taken afterwards. Once the oldest open
+        # transaction (xmin) is past that xmax, they have all finished.
+        self._retry_settle = None
+        while True:
+            try:
+                cur = self._conn.cursor()
+                if self._candidate is None:
+                    cur.execute(f"SELECT CASE WHEN is_called THEN last_value ELSE 0 END AS version FROM {VERSION_SEQUENCE}")
+                    version = cur.fetchone()["version"]
+                    cur.execute("SELECT pg_snapshot_xmax(pg_current_snapshot())::text::bigint AS xmax")
+                    self._candidate = (version, cur.fetchone()["xmax"])
+                cur.execute("""
+                    SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint AS xmin,
+                           pg_current_wal_lsn()::text AS lsn
+                """)
+                status = cur.fetchone()
+                cur.close()
+            except psycopg2.Error as e:
+                self._lost(e)
+                return
+            version, xmax = self._candidate
+            if status["xmin"] < xmax:
+                # A writer that may hold an earlier version is still open
+                self._retry_settle = asyncio.get_running_loop().call_later(self._delay, self._settle)
+                self._delay = min(self._delay * 2, self.max_settle_delay)
+                return
+            self._candidate = None
+            self._delay = self.settle_delay
+            # Every change up to `version` is in the WAL before this position,
+            # so a replica that has replayed it can serve data tagged `version`
+            self._advance(version, status["lsn"])
+            if self._announced <= self.version:
+                return
+
+    def _notify(self, change):
+        for callback in self.subscribers:
+            try:
+                callback(change)
+            except Exception as e:
+                print(f"Change feed subscriber error: {e}")
+
+    def _advance(self, version, lsn):
+        if version > self.version or self.lsn is None:
+            self.version = version
+            self.lsn = lsn
+            # Wake everyone waiting on the current event and arm a fresh one
+            self._changed.set()
+            self._changed = asyncio.Event()
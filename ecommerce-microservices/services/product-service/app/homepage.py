@@ -0,0 +1,122 @@
+"""Materialized homepage blocks.
+
+The homepage blocks (featured products, categories, top-rated per category and
+biggest discounts) are computed once, kept as pre-serialized JSON bytes and
+rebuilt when the change feed reports a relevant product write. Bursts of
+writes are debounced into a single rebuild.
+"""
+import asyncio
+import hashlib
+
+# What product reads select instead of `*`: a column added to the table later
+# stays out of responses, and doesn't break statements prepared before it
+PRODUCT_COLUMNS = (
+    "id, name, description, price, original_price, category, brand, image_url, "
+    "stock, rating, reviews_count, is_featured, discount_percent, created_at"
+)
+
+FEATURED_LIMIT = 8
+TOP_RATED_PER_CATEGORY = 4
+TOP_DISCOUNTS_LIMIT = 8
+
+
+def load_blocks(conn):
+    cur = conn.cursor()
+    cur.execute(
+        f"SELECT {PRODUCT_COLUMNS} FROM products WHERE is_featured = TRUE ORDER BY rating DESC LIMIT %s",
+        (FEATURED_LIMIT,)
+    )
+    featured = [dict(p) for p in cur.fetchall()]
+
+    cur.execute("SELECT DISTINCT category, COUNT(*) as count FROM products GROUP BY category ORDER BY count DESC")
+    categories = [dict(c) for c in cur.fetchall()]
+
+    cur.execute(f"""
+        SELECT {PRODUCT_COLUMNS} FROM (
+            SELECT {PRODUCT_COLUMNS}, ROW_NUMBER() OVER (
+                PARTITION BY category ORDER BY rating DESC, reviews_count DESC
+            ) AS category_rank
+            FROM products
+        ) ranked
+        WHERE category_rank <= %s
+        ORDER BY category, category_rank
+    """, (TOP_RATED_PER_CATEGORY,))
+    top_rated = {}
+    for row in cur.fetchall():
+        product = dict(row)
+        top_rated.setdefault(product["category"], []).append(product)
+
+    cur.execute(
+        f"SELECT {PRODUCT_COLUMNS} FROM products WHERE discount_percent > 0 "
+        "ORDER BY discount_percent DESC, rating DESC LIMIT %s",
+        (TOP_DISCOUNTS_LIMIT,)
+    )
+    top_discounts = [dict(p) for p in cur.fetchall()]
+    cur.close()
+
+    return {
+        "featured": featured,
+        "categories": categories,
+        "top_rated": top_rated,
+        "top_discounts": top_discounts,
+    }
+
+
+class HomepageBlocks:
+    def __init__(self, connect, serialize, debounce=0.5):
+        self.connect = connect
+        self.serialize = serialize
+        self.debounce = debounce
+        self.blocks = {}  # block name -> JSON bytes; "home" holds all of them
+        self.etags = {}  # block name -> strong ETag of its bytes
+        self.product_ids = set()
+        self._dirty = False
+        self._task = None
+
+    def get(self, name):
+        return self.blocks.get(name)
+
+    def etag(self, name):
+        return self.etags.get(name)
+
+    async def refresh(self):
+        data = await asyncio.to_thread(self._load)
+        blocks = {name: self.serialize(value) for name, value in data.items()}
+        blocks["home"] = self.serialize(data)
+        self.etags = {
+            name: f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+            for name, body in blocks.items()
+        }
+        self.blocks = blocks
+        self.product_ids = {
+            p["id"]
+            for block in (data["featured"], data["top_discounts"], *data["top_rated"].values())
+            for p in block
+        }
+
+    def _load(self):
+        conn = self.connect()
+        try:
+            return load_blocks(conn)
+        finally:
+            conn.close()
+
+    def on_change(self, change):
+        # Stock moves only matter for products that are actually displayed
+        if change["operation"] == "stock" and change["product_id"] not in self.product_ids:
+            return
+        self.schedule()
+
+    def schedule(self):
+        self._dirty = True
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while self._dirty:
+            await asyncio.sleep(self.debounce)
+            self._dirty = False
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f"Homepage refresh error: {e}")
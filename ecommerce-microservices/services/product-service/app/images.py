@@ -0,0 +1,274 @@
+"""Product image proxy: fetched once, resized to fixed variants, cached on disk.
+
+A product's image_url is fetched from its origin the first time any variant
+of it is asked for. Only URLs that some product actually uses, on an allowed
+host, are fetched, and every redirect hop is held to the same host allowlist.
+The original is kept under its SHA-256, and each variant (a fixed size, as
+WebP or JPEG) is rendered from it on first use and stored next to it, so URLs
+with the same content share everything:
+
+    sources/<sha256 of url>            -> sha256 of the content
+    blobs/<ab>/<sha256>.orig           original bytes
+    blobs/<ab>/<sha256>.<variant>.<fmt>
+
+Files are written to a temporary name and renamed into place, so workers
+sharing the directory never see a partial file. Blobs count toward
+`max_bytes`; past it, the least recently used ones (by mtime, bumped when
+served) are removed until the cache is back under 90%. A variant outlives
+its original, and a missing original is fetched again when a new variant
+needs it. Variants are handed out as bytes, not paths, so a sweep can't
+delete a file between lookup and response; one swept mid-lookup is rendered
+again.
+"""
+import asyncio
+import hashlib
+import io
+import os
+import time
+import uuid
+from urllib.parse import urljoin, urlsplit
+
+import httpx
+from fastapi import HTTPException
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+# name -> (width, height, crop): cropped variants fill the square product
+# cards; the detail variant keeps the whole image within the box
+VARIANTS = {
+    "thumb": (160, 160, True),
+    "card": (400, 400, True),
+    "detail": (800, 800, False),
+}
+FORMATS = {"webp": "image/webp", "jpeg": "image/jpeg"}
+QUALITY = {"webp": 80, "jpeg": 82}
+
+# Decoding a larger image is refused (decompression bombs)
+Image.MAX_IMAGE_PIXELS = 40_000_000
+# A served blob's mtime is bumped at most this often
+TOUCH_INTERVAL = 600.0
+# Redirects followed per fetch, each re-checked against the allowed hosts
+MAX_REDIRECTS = 3
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = f"{path}.{uuid.uuid4().hex}.partial"
+    with open(partial, "wb") as out:
+        out.write(data)
+    os.replace(partial, path)
+
+
+def check_image(data):
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            img.verify()
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, SyntaxError):
+        raise HTTPException(status_code=502, detail="Image origin did not return a usable image")
+
+
+def render(original, variant, fmt):
+    width, height, crop = VARIANTS[variant]
+    with Image.open(original) as img:
+        img = ImageOps.exif_transpose(img)
+        if crop:
+            img = ImageOps.fit(img, (width, height), Image.LANCZOS)
+        else:
+            img.thumbnail((width, height), Image.LANCZOS)
+        transparent = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+        if fmt == "jpeg" and transparent:
+            rgba = img.convert("RGBA")
+            img = Image.new("RGB", rgba.size, "white")
+            img.paste(rgba, mask=rgba.getchannel("A"))
+        elif img.mode not in ("RGB", "RGBA") or (fmt == "jpeg" and img.mode != "RGB"):
+            img = img.convert("RGBA" if transparent else "RGB")
+        out = io.BytesIO()
+        if fmt == "jpeg":
+            img.save(out, "JPEG", quality=QUALITY[fmt], optimize=True, progressive=True)
+        else:
+            img.save(out, "WEBP", quality=QUALITY[fmt], method=4)
+    return out.getvalue()
+
+
+class ImageCache:
+    def __init__(self, directory, verify, max_bytes=256 * 1024 * 1024, allowed_hosts=(),
+                 fetch_timeout=10.0, max_source_bytes=10 * 1024 * 1024):
+        self.directory = directory
+        self.verify = verify  # url -> True when a product uses it (called in a thread)
+        self.max_bytes = max_bytes
+        self.allowed_hosts = set(allowed_hosts)
+        self.fetch_timeout = fetch_timeout
+        self.max_source_bytes = max_source_bytes
+        self.fetches = 0
+        self.renders = 0
+        self.hits = 0
+        self.evicted = 0
+        self._written = 0
+        self._flights = {}  # url or variant path -> in-flight fetch or render
+
+    def _index_path(self, url):
+        return os.path.join(self.directory, "sources", sha256(url.encode()))
+
+    def _blob_path(self, digest, suffix):
+        return os.path.join(self.directory, "blobs", digest[:2], f"{digest}.{suffix}")
+
+    def _digest(self, url):
+        try:
+            with open(self._index_path(url)) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    async def get(self, url, variant, fmt):
+        """Bytes and content hash of `variant` of the image at `url`, as `fmt`."""
+        digest = self._digest(url)
+        if digest is not None:
+            data = await asyncio.to_thread(self._read, self._blob_path(digest, f"{variant}.{fmt}"))
+            if data is not None:
+                self.hits += 1
+                return data, digest
+        if digest is None or not os.path.exists(self._blob_path(digest, "orig")):
+            digest = await self._once(url, lambda: self._fetch(url))
+            # Another URL with the same content may have rendered it already
+            data = await asyncio.to_thread(self._read, self._blob_path(digest, f"{variant}.{fmt}"))
+            if data is not None:
+                self.hits += 1
+                return data, digest
+        path = self._blob_path(digest, f"{variant}.{fmt}")
+        try:
+            data = await self._once(path, lambda: self._render(digest, variant, fmt, path))
+        except FileNotFoundError:
+            # The original was swept between the check and the render
+            digest = await self._once(url, lambda: self._fetch(url))
+            path = self._blob_path(digest, f"{variant}.{fmt}")
+            data = await self._once(path, lambda: self._render(digest, variant, fmt, path))
+        return data, digest
+
+    def _read(self, path):
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+                if time.time() - os.fstat(f.fileno()).st_mtime > TOUCH_INTERVAL:
+                    os.utime(f.fileno())
+        except FileNotFoundError:
+            return None
+        return data
+
+    async def _once(self, key, start):
+        # Concurrent misses for the same image share one download or render
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = asyncio.ensure_future(start())
+            flight.add_done_callback(lambda _: self._flights.pop(key, None))
+        return await asyncio.shield(flight)
+
+    async def _render(self, digest, variant, fmt, path):
+        data = await asyncio.to_thread(render, self._blob_path(digest, "orig"), variant, fmt)
+        await asyncio.to_thread(write_atomic, path, data)
+        self.renders += 1
+        self._wrote(len(data))
+        return data
+
+    def _allowed(self, url):
+        parts = urlsplit(url)
+        return parts.scheme in ("http", "https") and (not self.allowed_hosts or parts.hostname in self.allowed_hosts)
+
+    async def _fetch(self, url):
+        if not self._allowed(url) or not await asyncio.to_thread(self.verify, url):
+            raise HTTPException(status_code=404, detail="Image not found")
+        try:
+            async with httpx.AsyncClient(timeout=self.fetch_timeout) as client:
+                data = await self._download(client, url)
+        except httpx.TimeoutException:
+            raise HTTPException(status_code=504, detail="Image origin timed out")
+        except httpx.HTTPError as e:
+            raise HTTPException(status_code=502, detail=f"Image origin unavailable: {e}")
+        data = bytes(data)
+        await asyncio.to_thread(check_image, data)
+        digest = sha256(data)
+        await asyncio.to_thread(write_atomic, self._blob_path(digest, "orig"), data)
+        await asyncio.to_thread(write_atomic, self._index_path(url), digest.encode())
+        self.fetches += 1
+        self._wrote(len(data))
+        return digest
+
+    async def _download(self, client, url):
+        # Redirects are followed by hand: httpx would follow them to any host
+        for _ in range(MAX_REDIRECTS + 1):
+            async with client.stream("GET", url) as response:
+                if response.is_redirect:
+                    url = urljoin(url, response.headers["location"])
+                    if not self._allowed(url):
+                        raise HTTPException(status_code=502, detail="Image origin redirected to a host that is not allowed")
+                    continue
+                if response.status_code != 200:
+                    raise HTTPException(status_code=502, detail=f"Image origin returned {response.status_code}")
+                if int(response.headers.get("content-length", 0)) > self.max_source_bytes:
+                    raise HTTPException(status_code=502, detail="Image is too large")
+                data = bytearray()
+                async for chunk in response.aiter_bytes():
+                    data += chunk
+                    if len(data) > self.max_source_bytes:
+                        raise HTTPException(status_code=502, detail="Image is too large")
+                return data
+        raise HTTPException(status_code=502, detail="Image origin redirected too many times")
+
+    def _wrote(self, size):
+        # Sweeping scans the whole cache, so only do it every tenth of the limit
+        self._written += size
+        if self._written >= self.max_bytes // 10:
+            self._written = 0
+            asyncio.get_running_loop().run_in_executor(None, self.sweep)
+
+    def sweep(self):
+        """Remove the least recently used blobs until the cache is under 90% of max_bytes."""
+        blobs = []
+        total = 0
+        root = os.path.join(self.directory, "blobs")
+        if not os.path.isdir(root):
+            return
+        for shard in os.scandir(root):
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(".partial"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                blobs.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        if total <= self.max_bytes:
+            return
+        for _, size, path in sorted(blobs):
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.evicted += 1
+
+    def snapshot(self):
+        return {
+            "hits": self.hits,
+            "fetches": self.fetches,
+            "renders": self.renders,
+            "evicted": self.evicted,
+            "in_flight": len(self._flights),
+        }
+
+
+def image_cache(verify):
+    hosts = os.environ.get("IMAGE_ALLOWED_HOSTS", "images.unsplash.com")
+    return ImageCache(
+        os.environ.get("IMAGE_CACHE_DIR", "/data/images"),
+        verify,
+        max_bytes=int(os.environ.get("IMAGE_CACHE_MAX_MB", "256")) * 1024 * 1024,
+        allowed_hosts=[host.strip() for host in hosts.split(",") if host.strip()],
+        fetch_timeout=float(os.environ.get("IMAGE_FETCH_TIMEOUT_SECONDS", "10")),
+        max_source_bytes=int(os.environ.get("IMAGE_MAX_SOURCE_MB", "10")) * 1024 * 1024,
+    )
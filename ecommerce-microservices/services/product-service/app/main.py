@@ -1,15 +1,49 @@
-from fastapi import FastAPI, HTTPException, Depends, Query
+from fastapi import FastAPI, HTTPException, Depends, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
-from typing import Optional, List
+from typing import Optional, List, Union
 import psycopg2
-from psycopg2.extras import RealDictCursor
 import os
 import jwt
+import hashlib
 import time
+import asyncio
+from functools import partial
+from datetime import date, datetime
+import orjson
+from decimal import Decimal
 
-app = FastAPI(title="Product Service", version="1.0.0")
+from .cache import SingleFlightCache
+from .admission import AdmissionMiddleware, RouteClass, admission_limiter, BROWSE, CRITICAL, NORMAL
+from .autocomplete import Autocomplete, MAX_LIMIT as AUTOCOMPLETE_MAX_LIMIT
+from .compression import CompressionMiddleware, CompressionStats
+from .querylog import QueryLogMiddleware, query_logger
+from .pool import ConnectionPool, PooledConnection, Statement, execute_prepared
+from .export import date_filter, export_response
+from .feed import ChangeFeed, SCHEMA as CHANGE_FEED_SCHEMA, retain as retain_changes
+from .homepage import HomepageBlocks, PRODUCT_COLUMNS
+from .images import FORMATS, VARIANTS, image_cache
+from .replicas import ReplicaRouter
+from .stock import InsufficientStock, ReservationReleased, SCHEMA as STOCK_SCHEMA, release, reserve
+
+def json_default(value):
+    # Same as jsonable_encoder: integral Decimals become int, the rest float
+    if isinstance(value, Decimal):
+        return int(value) if value.as_tuple().exponent >= 0 else float(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+def dumps_json(content) -> bytes:
+    return orjson.dumps(content, default=json_default, option=orjson.OPT_NON_STR_KEYS)
+
+class FastJSONResponse(JSONResponse):
+    # orjson encodes rows (datetimes included) straight to bytes; hot routes
+    # return this directly so FastAPI skips the generic jsonable_encoder pass
+    def render(self, content) -> bytes:
+        return dumps_json(content)
+
+app = FastAPI(title="Product Service", version="1.0.0", default_response_class=FastJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -19,10 +53,75 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+compression_stats = CompressionStats()
+# Materialized blocks are compressed once per version, so they can afford the
+# highest levels; /products/batch is in-cluster traffic and only needs level 1
+app.add_middleware(CompressionMiddleware, stats=compression_stats, route_levels={
+    "/products/home": (9, 9),
+    "/products/featured": (9, 9),
+    "/products/categories": (9, 9),
+    "/products/batch": (1, 1),
+})
+
 security = HTTPBearer(auto_error=False)
 JWT_SECRET = os.environ.get("JWT_SECRET", "ecommerce-secret-key-2024")
+ADMIN_EMAILS = {e.strip().lower() for e in os.environ.get("ADMIN_EMAILS", "").split(",") if e.strip()}
+CATALOG_CACHE_CONTROL = os.environ.get("CATALOG_CACHE_CONTROL", "public, max-age=30, stale-while-revalidate=300")
+# Read replicas as semicolon-separated libpq DSNs; empty means primary only
+DB_REPLICA_DSNS = [dsn.strip() for dsn in os.environ.get("DB_REPLICA_DSNS", "").split(";") if dsn.strip()]
+# Writers get the read-your-writes marker back as a cookie and a header; clients
+# that don't keep cookies (other services) forward the header instead
+READ_YOUR_WRITES_COOKIE = "read_your_writes"
+READ_YOUR_WRITES_HEADER = "x-read-your-writes"
+# Markers must not verify as user tokens, so they get their own key; the
+# default is derived from JWT_SECRET so every pod agrees on it
+READ_YOUR_WRITES_SECRET = os.environ.get("READ_YOUR_WRITES_SECRET") or hashlib.sha256(
+    f"read-your-writes:{JWT_SECRET}".encode()
+).hexdigest()
+# Change feed events are kept this long (0 keeps everything); a reader further
+# behind is told to resync
+PRODUCT_CHANGES_RETENTION_HOURS = float(os.environ.get("PRODUCT_CHANGES_RETENTION_HOURS", "168"))
 
-def get_db_connection():
+# Admission control: checkout-path calls are shed last. Their per-client rate
+# is sized for the cart and order services, whose calls share a bucket per pod
+SEARCH = RouteClass("search", rate=5, burst=20, priority=BROWSE)
+EXPORT = RouteClass("export", rate=0.1, burst=2, priority=BROWSE)
+CATALOG = RouteClass("catalog", rate=20, burst=60, priority=BROWSE)
+AUTOCOMPLETE = RouteClass("autocomplete", rate=20, burst=60, priority=BROWSE)
+CATALOG_WRITE = RouteClass("catalog_write", rate=5, burst=20, priority=NORMAL)
+IMAGES = RouteClass("images", rate=50, burst=200, priority=BROWSE)
+CHECKOUT = RouteClass("checkout", rate=50, burst=200, priority=CRITICAL)
+# Reservations come only from the order service, one bucket per user it acts for
+STOCK_RESERVATIONS = RouteClass("stock_reservations", rate=2, burst=10, priority=CRITICAL)
+
+def classify_request(method, path, query):
+    # Probes, and long-polls that hold no DB connection while they wait
+    if path == "/health" or path.startswith("/debug/") or path.startswith("/products/changes"):
+        return None
+    if path.startswith("/products/stock/"):
+        return STOCK_RESERVATIONS
+    if path == "/products/batch" or path.endswith("/stock"):
+        return CHECKOUT
+    if method != "GET":
+        return CATALOG_WRITE
+    if path == "/products/export":
+        return EXPORT
+    if path == "/products" and "search=" in query:
+        return SEARCH
+    if path == "/products/autocomplete":
+        return AUTOCOMPLETE
+    if path.startswith("/products/images/"):
+        return IMAGES
+    return CATALOG
+
+admission = admission_limiter()
+app.add_middleware(AdmissionMiddleware, classify=classify_request, jwt_secret=JWT_SECRET, limiter=admission)
+
+# Times every statement by shape; slow ones are logged and sampled for EXPLAIN
+query_log = query_logger()
+app.add_middleware(QueryLogMiddleware)
+
+def open_db_connection():
     max_retries = 5
     for i in range(max_retries):
         try:
@@ -32,7 +131,8 @@ def get_db_connection():
                 database=os.environ.get("DB_NAME", "productdb"),
                 user=os.environ.get("DB_USER", "postgres"),
                 password=os.environ.get("DB_PASSWORD", "postgres123"),
-                cursor_factory=RealDictCursor
+                connection_factory=PooledConnection,
+                cursor_factory=query_log.cursor_factory
             )
             return conn
         except psycopg2.OperationalError:
@@ -41,10 +141,23 @@ def get_db_connection():
             else:
                 raise
 
+# Requests reuse idle connections and the statements prepared on them;
+# anything that keeps session state (LISTEN, advisory locks) opens its own
+db_pool = ConnectionPool(
+    open_db_connection,
+    size=int(os.environ.get("DB_POOL_SIZE", "10")),
+    max_age=float(os.environ.get("DB_POOL_MAX_AGE_SECONDS", "1800")),
+)
+
+def get_db_connection():
+    return db_pool.get()
+
 def init_db():
     try:
-        conn = get_db_connection()
+        conn = open_db_connection()
         cur = conn.cursor()
+        # Workers and replicas starting together would otherwise race on the DDL
+        cur.execute("SELECT pg_advisory_lock(hashtext('schema:product-service'))")
         cur.execute("""
             CREATE TABLE IF NOT EXISTS products (
                 id SERIAL PRIMARY KEY,
@@ -63,6 +176,8 @@ def init_db():
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
+        cur.execute(CHANGE_FEED_SCHEMA)
+        cur.execute(STOCK_SCHEMA)
         
         # Check if products exist
         cur.execute("SELECT COUNT(*) as count FROM products")
@@ -104,9 +219,87 @@ def init_db():
     except Exception as e:
         print(f"Database init error: {e}")
 
+feed = ChangeFeed(open_db_connection)
+router = ReplicaRouter(
+    get_db_connection,
+    DB_REPLICA_DSNS,
+    READ_YOUR_WRITES_SECRET,
+    max_lag=float(os.environ.get("REPLICA_MAX_LAG_SECONDS", "5")),
+    strategy=os.environ.get("REPLICA_SELECTION", "round_robin"),
+    sticky_seconds=float(os.environ.get("READ_YOUR_WRITES_SECONDS", "10")),
+    cursor_factory=query_log.cursor_factory,
+    pool_size=db_pool.size,
+)
+product_cache = SingleFlightCache(ttl=float(os.environ.get("PRODUCT_CACHE_TTL", "30")))
+
+# Hot fixed reads, prepared once per connection
+# xmin changes with every update of the row and is the same on the primary
+# and its physical replicas, so it versions exactly the row that is served
+PRODUCT_BY_ID = Statement(
+    "product_by_id", f"SELECT {PRODUCT_COLUMNS}, xmin::text AS row_version FROM products WHERE id = $1", ("integer",)
+)
+PRODUCTS_BY_IDS = Statement(
+    "products_by_ids", f"SELECT {PRODUCT_COLUMNS} FROM products WHERE id = ANY($1)", ("integer[]",)
+)
+FEATURED_PRODUCTS = Statement(
+    "featured_products", f"SELECT {PRODUCT_COLUMNS} FROM products WHERE is_featured = TRUE ORDER BY rating DESC LIMIT 8"
+)
+PRODUCT_IMAGE = Statement("product_image", "SELECT 1 FROM products WHERE image_url = $1 LIMIT 1", ("text",))
+
+def is_product_image(url: str):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    execute_prepared(cur, PRODUCT_IMAGE, (url,))
+    found = cur.fetchone() is not None
+    cur.close()
+    conn.close()
+    return found
+
+# Resized product images, shared on disk by the workers
+images = image_cache(is_product_image)
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+def invalidate_product_cache(change):
+    if change["product_id"] is None:
+        product_cache.invalidate()
+        return
+    product_cache.invalidate(("product", change["product_id"]))
+
+# Materialized from the primary so a rebuild triggered by a change sees it
+homepage = HomepageBlocks(get_db_connection, serialize=dumps_json)
+autocomplete = Autocomplete(get_db_connection)
+
+# Subscribed to the feed so every worker reacts to writes made by any other
+feed.subscribe(invalidate_product_cache)
+feed.subscribe(homepage.on_change)
+feed.subscribe(autocomplete.on_change)
+
 @app.on_event("startup")
 async def startup():
     init_db()
+    await feed.start()
+    try:
+        await homepage.refresh()
+    except Exception as e:
+        print(f"Homepage refresh error: {e}")
+    try:
+        await autocomplete.rebuild()
+    except Exception as e:
+        print(f"Autocomplete rebuild error: {e}")
+    if router.replicas:
+        app.state.replica_monitor = asyncio.create_task(router.monitor())
+    if PRODUCT_CHANGES_RETENTION_HOURS:
+        app.state.change_retention = asyncio.create_task(
+            retain_changes(open_db_connection, PRODUCT_CHANGES_RETENTION_HOURS)
+        )
+
+@app.on_event("shutdown")
+async def shutdown():
+    feed.stop()
+    if PRODUCT_CHANGES_RETENTION_HOURS:
+        app.state.change_retention.cancel()
+    if router.replicas:
+        app.state.replica_monitor.cancel()
 
 # Models
 class ProductCreate(BaseModel):
@@ -133,6 +326,14 @@ class ProductUpdate(BaseModel):
     is_featured: Optional[bool] = None
     discount_percent: Optional[int] = None
 
+class StockItem(BaseModel):
+    product_id: int
+    quantity: int
+
+class StockReservation(BaseModel):
+    reservation_id: str
+    items: List[StockItem]
+
 def verify_admin(credentials: HTTPAuthorizationCredentials = Depends(security)):
     if not credentials:
         raise HTTPException(status_code=401, detail="Authentication required")
@@ -142,12 +343,109 @@ def verify_admin(credentials: HTTPAuthorizationCredentials = Depends(security)):
     except:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+def verify_ops_admin(payload: dict = Depends(verify_admin)):
+    # Catalog writes only need a login; operational reports need ADMIN_EMAILS
+    if payload.get("email", "").lower() not in ADMIN_EMAILS:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return payload
+
+def verify_service(payload: dict = Depends(verify_admin)):
+    # Only tokens minted by another service carry "service"; user tokens
+    # from the user service never do
+    if not payload.get("service"):
+        raise HTTPException(status_code=403, detail="Service access required")
+    return payload
+
+def optional_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    # Public routes stay anonymous; a valid token only affects replica routing
+    if not credentials:
+        return None
+    try:
+        return jwt.decode(credentials.credentials, JWT_SECRET, algorithms=["HS256"])
+    except jwt.InvalidTokenError:
+        return None
+
+def read_your_writes(request: Request, user: Optional[dict] = Depends(optional_user)):
+    """True while the reader is inside the window after one of its writes."""
+    marker = request.cookies.get(READ_YOUR_WRITES_COOKIE) or request.headers.get(READ_YOUR_WRITES_HEADER)
+    return router.is_sticky(marker, user.get("user_id") if user else None)
+
+def mark_write(response: Response, user: dict):
+    marker = router.mark_write(user.get("user_id"))
+    if marker:
+        response.set_cookie(READ_YOUR_WRITES_COOKIE, marker, max_age=int(router.sticky_seconds) + 1,
+                            httponly=True, samesite="lax")
+        response.headers[READ_YOUR_WRITES_HEADER] = marker
+
+async def cached_read(key, loader, sticky: bool):
+    # Readers inside their read-your-writes window bypass the shared cache
+    if sticky:
+        return loader(primary=True)
+    # The first load after a change reads the primary, which has it for sure
+    return await product_cache.get(key, loader, partial(loader, primary=True))
+
+def catalog_etag():
+    """ETag of catalog-wide reads, and the WAL position the data must include.
+
+    Read where that position has been replayed, the body is never older than
+    its tag. Versions are only trustworthy while the change feed is connected.
+    """
+    if not feed.connected or feed.lsn is None:
+        return None, None
+    return f'"c{feed.version}"', feed.lsn
+
+def etag_matches(request: Request, etag: Optional[str]):
+    header = request.headers.get("if-none-match")
+    if not etag or not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return etag in (t.strip().removeprefix("W/") for t in header.split(","))
+
+def not_modified(request: Request, etag: Optional[str]):
+    # Checked before querying or serializing anything
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": CATALOG_CACHE_CONTROL})
+    return None
+
+def with_cache_headers(response: Response, etag: Optional[str]):
+    response.headers["Cache-Control"] = CATALOG_CACHE_CONTROL
+    if etag:
+        response.headers["ETag"] = etag
+    return response
+
 @app.get("/health")
 async def health():
     return {"status": "healthy", "service": "product-service"}
 
+@app.get("/debug/compression")
+async def compression_report(admin: dict = Depends(verify_ops_admin)):
+    return compression_stats.snapshot()
+
+@app.get("/debug/admission")
+async def admission_report(admin: dict = Depends(verify_ops_admin)):
+    return admission.snapshot()
+
+@app.get("/debug/images")
+async def image_report(admin: dict = Depends(verify_ops_admin)):
+    return images.snapshot()
+
+@app.get("/debug/queries")
+async def query_report(
+    limit: int = Query(default=20, ge=1, le=500),
+    sort: str = Query(default="total", pattern="^(total|mean|max|calls)$"),
+    admin: dict = Depends(verify_ops_admin)
+):
+    return {**query_log.report(limit, sort), "pool": db_pool.snapshot()}
+
+@app.delete("/debug/queries")
+async def reset_query_report(admin: dict = Depends(verify_ops_admin)):
+    query_log.reset()
+    return {"message": "Query stats reset"}
+
 @app.get("/products")
 async def get_products(
+    request: Request,
     category: Optional[str] = None,
     search: Optional[str] = None,
     featured: Optional[bool] = None,
@@ -155,12 +453,16 @@ async def get_products(
     max_price: Optional[float] = None,
     sort_by: Optional[str] = "created_at",
     limit: int = Query(default=50, le=100),
-    offset: int = 0
+    offset: int = 0,
+    sticky: bool = Depends(read_your_writes)
 ):
-    conn = get_db_connection()
-    cur = conn.cursor()
+    # A listing can only change when the catalog version moves
+    etag, lsn = catalog_etag()
+    response = not_modified(request, etag)
+    if response:
+        return response
     
-    query = "SELECT * FROM products WHERE 1=1"
+    query = f"SELECT {PRODUCT_COLUMNS} FROM products WHERE 1=1"
     params = []
     
     if category:
@@ -191,9 +493,6 @@ async def get_products(
     query += " LIMIT %s OFFSET %s"
     params.extend([limit, offset])
     
-    cur.execute(query, params)
-    products = cur.fetchall()
-    
     # Get total count
     count_query = "SELECT COUNT(*) as total FROM products WHERE 1=1"
     count_params = []
@@ -204,54 +503,210 @@ async def get_products(
         count_query += " AND (name ILIKE %s OR description ILIKE %s)"
         count_params.extend([f"%{search}%", f"%{search}%"])
     
-    cur.execute(count_query, count_params)
-    total = cur.fetchone()["total"]
-    
-    cur.close()
-    conn.close()
+    with router.read_connection(primary=sticky, min_lsn=lsn) as conn:
+        cur = conn.cursor()
+        cur.execute(query, params)
+        products = cur.fetchall()
+        cur.execute(count_query, count_params)
+        total = cur.fetchone()["total"]
+        cur.close()
     
-    return {
-        "products": [dict(p) for p in products],
+    return with_cache_headers(FastJSONResponse({
+        "products": products,
         "total": total,
         "limit": limit,
         "offset": offset
-    }
+    }), etag)
+
+def load_featured_products(primary=False):
+    with router.read_connection(primary=primary) as conn:
+        cur = conn.cursor()
+        execute_prepared(cur, FEATURED_PRODUCTS)
+        products = cur.fetchall()
+        cur.close()
+    return products
+
+def materialized_response(request: Request, name: str, sticky: bool):
+    # Readers inside their read-your-writes window get a live query instead
+    body = homepage.get(name)
+    if body is None or sticky:
+        return None
+    etag = homepage.etag(name)
+    response = not_modified(request, etag)
+    if response:
+        return response
+    return with_cache_headers(Response(content=body, media_type="application/json"), etag)
+
+@app.get("/products/home")
+async def get_homepage(request: Request):
+    if homepage.get("home") is None:
+        await homepage.refresh()
+    return materialized_response(request, "home", False)
 
 @app.get("/products/featured")
-async def get_featured_products():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM products WHERE is_featured = TRUE ORDER BY rating DESC LIMIT 8")
-    products = cur.fetchall()
-    cur.close()
-    conn.close()
-    return [dict(p) for p in products]
+async def get_featured_products(request: Request, sticky: bool = Depends(read_your_writes)):
+    response = materialized_response(request, "featured", sticky)
+    if response is not None:
+        return response
+    return FastJSONResponse(load_featured_products(primary=sticky))
 
 @app.get("/products/categories")
-async def get_categories():
+async def get_categories(request: Request, sticky: bool = Depends(read_your_writes)):
+    response = materialized_response(request, "categories", sticky)
+    if response is not None:
+        return response
+    etag, lsn = catalog_etag()
+    response = not_modified(request, etag)
+    if response:
+        return response
+    with router.read_connection(primary=sticky, min_lsn=lsn) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT DISTINCT category, COUNT(*) as count FROM products GROUP BY category ORDER BY count DESC")
+        categories = cur.fetchall()
+        cur.close()
+    return with_cache_headers(FastJSONResponse(categories), etag)
+
+def get_changes(since: int, limit: int):
+    """Settled changes after `since`, or None when some were already pruned."""
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute("SELECT DISTINCT category, COUNT(*) as count FROM products GROUP BY category ORDER BY count DESC")
-    categories = cur.fetchall()
+    # With every event pruned, everything up to the settled version is gone
+    cur.execute("SELECT COALESCE(MIN(version), %s) AS oldest FROM product_changes", (feed.version + 1,))
+    if since < cur.fetchone()["oldest"] - 1:
+        cur.close()
+        conn.close()
+        return None
+    # Only up to the settled version: a later one may still have an earlier,
+    # uncommitted one before it
+    cur.execute(
+        "SELECT version, product_id, operation, product, created_at FROM product_changes WHERE version > %s AND version <= %s ORDER BY version LIMIT %s",
+        (since, feed.version, limit)
+    )
+    changes = cur.fetchall()
     cur.close()
     conn.close()
-    return [dict(c) for c in categories]
+    return changes
 
-@app.get("/products/{product_id}")
-async def get_product(product_id: int):
+@app.get("/products/autocomplete")
+async def autocomplete_products(
+    q: str = Query(default="", max_length=100),
+    limit: int = Query(default=8, ge=1, le=AUTOCOMPLETE_MAX_LIMIT)
+):
+    # Answered from memory, so the search box can call it on every keystroke
+    if not autocomplete.ready:
+        await autocomplete.rebuild()
+    return with_cache_headers(FastJSONResponse({"query": q, "suggestions": autocomplete.suggest(q, limit)}), None)
+
+@app.get("/products/changes")
+async def get_product_changes(
+    since: int = 0,
+    limit: int = Query(default=100, ge=1, le=1000),
+    wait: int = Query(default=0, ge=0, le=60)
+):
+    # Long-poll: hold the request until something newer than `since` is announced
+    if wait and feed.version <= since:
+        await feed.wait(since, wait)
+    latest = feed.version
+    changes = get_changes(since, limit)
+    if changes is None:
+        # The reader has to reload everything and continue from `latest`
+        return FastJSONResponse({"changes": [], "version": latest, "latest": latest, "resync": True})
+    return FastJSONResponse({
+        "changes": changes,
+        "version": changes[-1]["version"] if changes else since,
+        "latest": latest
+    })
+
+@app.get("/products/changes/stream")
+async def stream_product_changes(request: Request, since: Optional[int] = None):
+    # Resume from Last-Event-ID on reconnect; otherwise only new changes
+    last_event_id = request.headers.get("last-event-id")
+    if since is None:
+        since = int(last_event_id) if last_event_id and last_event_id.isdigit() else feed.version
+    
+    async def events():
+        version = since
+        while not await request.is_disconnected():
+            changes = get_changes(version, 100)
+            if changes is None:
+                version = feed.version
+                yield f"id: {version}\nevent: resync\ndata: {{}}\n\n"
+                continue
+            for change in changes:
+                version = change["version"]
+                yield f"id: {version}\nevent: change\ndata: {dumps_json(change).decode()}\n\n"
+            if not changes and not await feed.wait(version, 15):
+                yield ": keepalive\n\n"
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/products/batch")
+async def get_products_batch(ids: List[int] = Query(...)):
+    # Used for checkout revalidation, so always read from the primary
+    if len(ids) > 200:
+        raise HTTPException(status_code=400, detail="Too many product ids")
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute("SELECT * FROM products WHERE id = %s", (product_id,))
-    product = cur.fetchone()
+    execute_prepared(cur, PRODUCTS_BY_IDS, (list(set(ids)),))
+    products = cur.fetchall()
     cur.close()
     conn.close()
-    
+    return FastJSONResponse(products)
+
+def load_product(product_id: int, primary=False):
+    with router.read_connection(primary=primary) as conn:
+        cur = conn.cursor()
+        execute_prepared(cur, PRODUCT_BY_ID, (product_id,))
+        product = cur.fetchone()
+        cur.close()
+    return dict(product) if product else None
+
+@app.get("/products/export")
+async def export_products(
+    format: str = "ndjson",
+    since: Optional[Union[datetime, date]] = None,
+    until: Optional[Union[datetime, date]] = None,
+    user: dict = Depends(verify_admin)
+):
+    where, params = date_filter("created_at", since, until)
+    return export_response(get_db_connection, "products", where, params, format, "products")
+
+@app.get("/products/images/{variant}")
+async def get_product_image(request: Request, variant: str, src: str, format: Optional[str] = None):
+    if variant not in VARIANTS:
+        raise HTTPException(status_code=404, detail="Unknown image variant")
+    headers = {"Cache-Control": IMAGE_CACHE_CONTROL}
+    if format is None:
+        # Negotiated, so shared caches must key on Accept
+        format = "webp" if "image/webp" in request.headers.get("accept", "") else "jpeg"
+        headers["Vary"] = "Accept"
+    elif format not in FORMATS:
+        raise HTTPException(status_code=400, detail="format must be webp or jpeg")
+    data, digest = await images.get(src, variant, format)
+    headers["ETag"] = f'"{digest[:32]}-{variant}-{format}"'
+    if etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    return Response(content=data, media_type=FORMATS[format], headers=headers)
+
+@app.get("/products/{product_id}")
+async def get_product(request: Request, product_id: int, sticky: bool = Depends(read_your_writes)):
+    product = await cached_read(("product", product_id), partial(load_product, product_id), sticky)
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
-    return dict(product)
+    # Tagged from the row being served, wherever it came from
+    product = dict(product)
+    etag = f'"p{product_id}-{product.pop("row_version")}"'
+    response = not_modified(request, etag)
+    if response:
+        return response
+    return with_cache_headers(FastJSONResponse(product), etag)
 
 @app.post("/products")
-async def create_product(product: ProductCreate, user: dict = Depends(verify_admin)):
+async def create_product(product: ProductCreate, response: Response, user: dict = Depends(verify_admin)):
     conn = get_db_connection()
     cur = conn.cursor()
     cur.execute("""
@@ -263,10 +718,11 @@ async def create_product(product: ProductCreate, user: dict = Depends(verify_adm
     conn.commit()
     cur.close()
     conn.close()
+    mark_write(response, user)
     return {"message": "Product created", "product_id": product_id}
 
 @app.put("/products/{product_id}")
-async def update_product(product_id: int, product: ProductUpdate, user: dict = Depends(verify_admin)):
+async def update_product(product_id: int, product: ProductUpdate, response: Response, user: dict = Depends(verify_admin)):
     conn = get_db_connection()
     cur = conn.cursor()
     
@@ -284,16 +740,18 @@ async def update_product(product_id: int, product: ProductUpdate, user: dict = D
     conn.commit()
     cur.close()
     conn.close()
+    mark_write(response, user)
     return {"message": "Product updated"}
 
 @app.delete("/products/{product_id}")
-async def delete_product(product_id: int, user: dict = Depends(verify_admin)):
+async def delete_product(product_id: int, response: Response, user: dict = Depends(verify_admin)):
     conn = get_db_connection()
     cur = conn.cursor()
     cur.execute("DELETE FROM products WHERE id = %s", (product_id,))
     conn.commit()
     cur.close()
     conn.close()
+    mark_write(response, user)
     return {"message": "Product deleted"}
 
 @app.put("/products/{product_id}/stock")
@@ -310,6 +768,38 @@ async def update_stock(product_id: int, quantity: int):
     conn.close()
     return {"message": "Stock updated"}
 
+@app.post("/products/stock/reservations")
+async def reserve_stock(reservation: StockReservation, service: dict = Depends(verify_service)):
+    # Checkout takes the stock of a whole order at once, under the order id,
+    # and gets the current prices back in the same call
+    if not reservation.items or any(item.quantity <= 0 for item in reservation.items):
+        raise HTTPException(status_code=400, detail="Items must have positive quantities")
+    conn = get_db_connection()
+    try:
+        products, created = reserve(conn, reservation.reservation_id, [item.dict() for item in reservation.items])
+    except InsufficientStock as e:
+        return FastJSONResponse(status_code=409, content={"detail": "Insufficient stock", "shortages": e.shortages})
+    except ReservationReleased:
+        raise HTTPException(status_code=409, detail="Reservation was released")
+    finally:
+        conn.close()
+    return FastJSONResponse({
+        "reservation_id": reservation.reservation_id,
+        "status": "reserved",
+        "created": created,
+        "products": products
+    })
+
+@app.delete("/products/stock/reservations/{reservation_id}")
+async def release_stock(reservation_id: str, service: dict = Depends(verify_service)):
+    conn = get_db_connection()
+    try:
+        released = release(conn, reservation_id)
+    finally:
+        conn.close()
+    return {"reservation_id": reservation_id, "released": released}
+
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    import sys
+    from .serve import Launcher
+    sys.exit(Launcher().run())
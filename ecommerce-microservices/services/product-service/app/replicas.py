@@ -0,0 +1,160 @@
+"""Read/write splitting for product-service.
+
+Read-only endpoints ask the ReplicaRouter for a connection. It picks a healthy
+replica whose replication lag is within bounds (round-robin or least-busy) and
+falls back to the primary when none qualifies, when the replica can't be
+reached, or when the reader recently wrote and must see its own writes. Reads
+that must include a given primary WAL position (`min_lsn`) only go to a
+replica whose last check showed it had replayed that far.
+
+The read-your-writes window travels with the client as a short-lived signed
+marker returned by mark_write, so it holds whichever worker or pod serves the
+next read. Markers are signed with their own key and typed, so one is never
+accepted as a bearer token by any service.
+"""
+import asyncio
+import itertools
+import time
+from contextlib import contextmanager
+
+import jwt
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+from .pool import ConnectionPool, PooledConnection
+
+MARKER_TYPE = "ryw"
+
+
+def lsn_value(lsn):
+    # "16/B374D848" -> comparable integer
+    high, _, low = lsn.partition("/")
+    return (int(high, 16) << 32) | int(low, 16)
+
+
+class Replica:
+    def __init__(self, dsn, cursor_factory=RealDictCursor, pool_size=10):
+        self.dsn = dsn
+        self.cursor_factory = cursor_factory
+        self.pool = ConnectionPool(self._open, size=pool_size)
+        self.in_flight = 0
+        self.lag = None  # seconds behind the primary; None until first check
+        self.replayed = None  # WAL position replayed at the last check (lsn_value)
+        self.healthy = True
+
+    def _open(self):
+        return psycopg2.connect(
+            self.dsn, connection_factory=PooledConnection, cursor_factory=self.cursor_factory, connect_timeout=3
+        )
+
+    def connect(self):
+        return self.pool.get()
+
+
+class ReplicaRouter:
+    def __init__(self, connect_primary, dsns, secret, max_lag=5.0, strategy="round_robin",
+                 sticky_seconds=10.0, check_interval=2.0, cursor_factory=RealDictCursor, pool_size=10):
+        self.connect_primary = connect_primary
+        self.replicas = [Replica(dsn, cursor_factory, pool_size) for dsn in dsns]
+        self.max_lag = max_lag
+        self.strategy = strategy
+        self.sticky_seconds = sticky_seconds
+        self.check_interval = check_interval
+        self.secret = secret
+        self._round_robin = itertools.count()
+
+    def mark_write(self, user_id):
+        """Return a marker routing `user_id`'s reads to the primary for the
+        read-your-writes window, or None for anonymous writers."""
+        if user_id is None:
+            return None
+        deadline = time.time() + self.sticky_seconds
+        return jwt.encode({"typ": MARKER_TYPE, "user_id": user_id, "exp": deadline}, self.secret, algorithm="HS256")
+
+    def is_sticky(self, marker, user_id):
+        if not marker or user_id is None:
+            return False
+        try:
+            payload = jwt.decode(marker, self.secret, algorithms=["HS256"])
+        except jwt.InvalidTokenError:  # expired, forged or malformed
+            return False
+        return payload.get("typ") == MARKER_TYPE and payload.get("user_id") == user_id
+
+    def _choose(self, min_lsn=None):
+        candidates = [
+            r for r in self.replicas
+            if r.healthy and r.lag is not None and r.lag <= self.max_lag
+            and (min_lsn is None or (r.replayed is not None and r.replayed >= min_lsn))
+        ]
+        if not candidates:
+            return None
+        if self.strategy == "least_busy":
+            return min(candidates, key=lambda r: r.in_flight)
+        return candidates[next(self._round_robin) % len(candidates)]
+
+    @contextmanager
+    def read_connection(self, primary=False, min_lsn=None):
+        replica = None if primary else self._choose(lsn_value(min_lsn) if min_lsn else None)
+        conn = None
+        if replica is not None:
+            try:
+                conn = replica.connect()
+                replica.in_flight += 1
+            except psycopg2.OperationalError as e:
+                print(f"Replica unavailable, reading from primary: {e}")
+                replica.healthy = False
+                replica = None
+        if conn is None:
+            conn = self.connect_primary()
+        try:
+            yield conn
+        finally:
+            conn.close()
+            if replica is not None:
+                replica.in_flight -= 1
+
+    def check_lag(self):
+        if not self.replicas:
+            return
+        conn = self.connect_primary()
+        cur = conn.cursor()
+        cur.execute("SELECT pg_current_wal_lsn()::text AS lsn")
+        primary_lsn = cur.fetchone()["lsn"]
+        cur.close()
+        conn.close()
+
+        for replica in self.replicas:
+            try:
+                conn = replica.connect()
+                cur = conn.cursor()
+                # A replica that has replayed everything the primary had is not
+                # lagging even if the last replayed transaction is old
+                cur.execute("""
+                    SELECT pg_is_in_recovery() AS in_recovery,
+                           pg_last_wal_replay_lsn() >= %s::pg_lsn AS caught_up,
+                           (CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn()
+                                 ELSE pg_current_wal_lsn() END)::text AS replayed,
+                           EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) AS lag
+                """, (primary_lsn,))
+                status = cur.fetchone()
+                cur.close()
+                conn.close()
+            except psycopg2.Error as e:
+                if replica.healthy:
+                    print(f"Replica lag check failed: {e}")
+                replica.healthy = False
+                continue
+            replica.healthy = True
+            replica.replayed = lsn_value(status["replayed"]) if status["replayed"] else None
+            if not status["in_recovery"] or status["caught_up"]:
+                replica.lag = 0.0
+            else:
+                replica.lag = float(status["lag"]) if status["lag"] is not None else None
+
+    async def monitor(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.check_lag)
+            except Exception as e:
+                print(f"Replica monitor error: {e}")
+            await asyncio.sleep(self.check_interval)
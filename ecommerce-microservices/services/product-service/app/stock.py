@@ -0,0 +1,128 @@
+"""Stock reservations for checkout.
+
+A reservation takes stock for every item of an order in one transaction, or
+for none of them, and is recorded under the caller's id (the order id), so
+that it can be given back. Both calls are idempotent:
+
+- reserving again returns the existing reservation instead of taking the
+  stock twice
+- releasing puts the stock back once; releasing an id that was never
+  reserved leaves a released record, so a reserve that arrives after its
+  release (a retry racing the compensation) is refused instead of leaking
+
+Rows are locked in id order before they are updated, so concurrent
+reservations for overlapping products wait for each other instead of
+deadlocking.
+"""
+import json
+
+from psycopg2.extras import execute_values
+
+from .homepage import PRODUCT_COLUMNS
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS stock_reservations (
+        reservation_id VARCHAR(50) PRIMARY KEY,
+        items JSONB NOT NULL,
+        status VARCHAR(20) NOT NULL DEFAULT 'reserved',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        released_at TIMESTAMP
+    )
+"""
+
+
+class InsufficientStock(Exception):
+    def __init__(self, shortages):
+        super().__init__("Insufficient stock")
+        self.shortages = shortages  # [{"product_id", "requested", "available"}]
+
+
+class ReservationReleased(Exception):
+    """The reservation id was already released (or released before it was made)."""
+
+
+def merge_items(items):
+    """[{"product_id", "quantity"}] with one entry per product, in id order."""
+    quantities = {}
+    for item in items:
+        quantities[item["product_id"]] = quantities.get(item["product_id"], 0) + item["quantity"]
+    return [{"product_id": product_id, "quantity": quantities[product_id]} for product_id in sorted(quantities)]
+
+
+def reserve(conn, reservation_id, items):
+    """Take stock for `items`; returns (products after the update, created)."""
+    items = merge_items(items)
+    ids = [item["product_id"] for item in items]
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            INSERT INTO stock_reservations (reservation_id, items) VALUES (%s, %s)
+            ON CONFLICT (reservation_id) DO NOTHING
+        """, (reservation_id, json.dumps(items)))
+        if cur.rowcount == 0:
+            conn.rollback()
+            cur.execute("SELECT items, status FROM stock_reservations WHERE reservation_id = %s", (reservation_id,))
+            existing = cur.fetchone()
+            if existing["status"] != "reserved":
+                raise ReservationReleased(reservation_id)
+            cur.execute(
+                f"SELECT {PRODUCT_COLUMNS} FROM products WHERE id = ANY(%s) ORDER BY id",
+                ([item["product_id"] for item in existing["items"]],)
+            )
+            return cur.fetchall(), False
+
+        cur.execute("SELECT id, stock FROM products WHERE id = ANY(%s) ORDER BY id FOR UPDATE", (ids,))
+        available = {row["id"]: row["stock"] for row in cur.fetchall()}
+        shortages = [
+            {"product_id": item["product_id"], "requested": item["quantity"], "available": available.get(item["product_id"], 0)}
+            for item in items
+            if available.get(item["product_id"], 0) < item["quantity"]
+        ]
+        if shortages:
+            conn.rollback()
+            raise InsufficientStock(shortages)
+        execute_values(cur, """
+            UPDATE products SET stock = products.stock - w.quantity
+            FROM (VALUES %s) AS w (id, quantity)
+            WHERE products.id = w.id
+        """, [(item["product_id"], item["quantity"]) for item in items])
+        cur.execute(f"SELECT {PRODUCT_COLUMNS} FROM products WHERE id = ANY(%s) ORDER BY id", (ids,))
+        products = cur.fetchall()
+        conn.commit()
+        return products, True
+    finally:
+        cur.close()
+
+
+def release(conn, reservation_id):
+    """Give the stock of a reservation back; False when there was nothing to give back."""
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            INSERT INTO stock_reservations (reservation_id, items, status, released_at)
+            VALUES (%s, '[]', 'released', CURRENT_TIMESTAMP)
+            ON CONFLICT (reservation_id) DO NOTHING
+        """, (reservation_id,))
+        if cur.rowcount == 1:
+            conn.commit()
+            return False
+        cur.execute("""
+            UPDATE stock_reservations SET status = 'released', released_at = CURRENT_TIMESTAMP
+            WHERE reservation_id = %s AND status = 'reserved'
+            RETURNING items
+        """, (reservation_id,))
+        row = cur.fetchone()
+        if row is None:
+            conn.rollback()
+            return False
+        items = sorted(row["items"], key=lambda item: item["product_id"])
+        cur.execute("SELECT id FROM products WHERE id = ANY(%s) ORDER BY id FOR UPDATE", ([item["product_id"] for item in items],))
+        execute_values(cur, """
+            UPDATE products SET stock = products.stock + w.quantity
+            FROM (VALUES %s) AS w (id, quantity)
+            WHERE products.id = w.id
+        """, [(item["product_id"], item["quantity"]) for item in items])
+        conn.commit()
+        return True
+    finally:
+        cur.close()
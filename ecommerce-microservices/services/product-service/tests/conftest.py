@@ -0,0 +1,64 @@
+"""Shared fixtures for the product service tests."""
+import http.server
+import io
+import os
+import sys
+import threading
+
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+
+def png(color, size=(1000, 800)):
+    buf = io.BytesIO()
+    Image.new("RGB", size, color).save(buf, "PNG")
+    return buf.getvalue()
+
+
+class Origin:
+    """A local image origin: `images` are served by path, `redirects` answer 302."""
+
+    def __init__(self):
+        self.images = {"/img": png("red"), "/copy": png("red"), "/blue": png("blue")}
+        self.redirects = {}
+        self.requests = []
+        origin = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                origin.requests.append(self.path)
+                if self.path in origin.redirects:
+                    self.send_response(302)
+                    self.send_header("Location", origin.redirects[self.path])
+                    self.end_headers()
+                    return
+                data = origin.images.get(self.path)
+                if data is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "image/png")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.port = self.server.server_address[1]
+
+    def url(self, path, host="127.0.0.1"):
+        return f"http://{host}:{self.port}{path}"
+
+
+@pytest.fixture
+def origin():
+    origin = Origin()
+    thread = threading.Thread(target=origin.server.serve_forever, daemon=True)
+    thread.start()
+    yield origin
+    origin.server.shutdown()
+    origin.server.server_close()
@@ -0,0 +1,108 @@
+import asyncio
+import io
+import os
+
+import pytest
+from fastapi import HTTPException
+from PIL import Image
+
+from app.images import MAX_REDIRECTS, ImageCache
+
+
+def make_cache(directory, verify=lambda url: True):
+    return ImageCache(str(directory), verify, allowed_hosts=["127.0.0.1"])
+
+
+def get(cache, url, variant="thumb", fmt="jpeg"):
+    return asyncio.run(cache.get(url, variant, fmt))
+
+
+def refused(cache, url):
+    with pytest.raises(HTTPException) as error:
+        get(cache, url)
+    return error.value
+
+
+def test_variant_is_rendered_once_then_served_from_disk(tmp_path, origin):
+    cache = make_cache(tmp_path)
+    url = origin.url("/img")
+
+    data, digest = get(cache, url)
+    with Image.open(io.BytesIO(data)) as img:
+        assert (img.format, img.size) == ("JPEG", (160, 160))
+    assert get(cache, url) == (data, digest)
+    assert origin.requests == ["/img"]
+    assert (cache.fetches, cache.renders, cache.hits) == (1, 1, 1)
+
+    # Another variant is rendered from the stored original
+    data, _ = get(cache, url, "detail", "webp")
+    with Image.open(io.BytesIO(data)) as img:
+        assert (img.format, img.size) == ("WEBP", (800, 640))
+    assert origin.requests == ["/img"]
+    assert cache.renders == 2
+
+
+def test_urls_with_the_same_content_share_blobs(tmp_path, origin):
+    cache = make_cache(tmp_path)
+    first = get(cache, origin.url("/img"))
+    second = get(cache, origin.url("/copy"))
+    assert first == second
+    assert (cache.fetches, cache.renders, cache.hits) == (2, 1, 1)
+    assert get(cache, origin.url("/blue"))[1] != first[1]
+
+
+def test_removed_blobs_are_rebuilt(tmp_path, origin):
+    cache = make_cache(tmp_path)
+    url = origin.url("/img")
+    data, digest = get(cache, url)
+
+    os.remove(cache._blob_path(digest, "thumb.jpeg"))
+    assert get(cache, url) == (data, digest)
+    assert origin.requests == ["/img"]
+    assert cache.renders == 2
+
+    # A new variant needs the original, so it is fetched again
+    os.remove(cache._blob_path(digest, "orig"))
+    get(cache, url, "card", "webp")
+    assert origin.requests == ["/img", "/img"]
+    assert cache.fetches == 2
+
+
+def test_only_allowed_hosts_and_known_urls_are_fetched(tmp_path, origin):
+    cache = make_cache(tmp_path)
+    assert refused(cache, origin.url("/img", host="localhost")).status_code == 404
+    assert refused(cache, f"ftp://127.0.0.1:{origin.port}/img").status_code == 404
+
+    unknown = make_cache(tmp_path / "unknown", verify=lambda url: url.endswith("/blue"))
+    assert refused(unknown, origin.url("/img")).status_code == 404
+    get(unknown, origin.url("/blue"))
+    assert origin.requests == ["/blue"]
+
+
+def test_redirects_are_held_to_the_allowlist(tmp_path, origin):
+    cache = make_cache(tmp_path)
+    origin.redirects["/moved"] = "/img"
+    origin.redirects["/away"] = origin.url("/img", host="localhost")
+
+    data, digest = get(cache, origin.url("/moved"))
+    assert digest == get(cache, origin.url("/img"))[1]
+
+    error = refused(cache, origin.url("/away"))
+    assert error.status_code == 502
+    assert "not allowed" in error.detail
+    assert origin.requests == ["/moved", "/img", "/img", "/away"]
+
+
+def test_redirects_are_followed_up_to_the_limit(tmp_path, origin):
+    cache = make_cache(tmp_path)
+    chain = [f"/hop{i}" for i in range(MAX_REDIRECTS)] + ["/img"]
+    origin.redirects.update(zip(chain, chain[1:]))
+    get(cache, origin.url(chain[0]))
+    assert origin.requests == chain
+
+    origin.requests.clear()
+    origin.redirects["/loop"] = "/loop"
+    error = refused(cache, origin.url("/loop"))
+    assert error.status_code == 502
+    assert "too many" in error.detail
+    assert origin.requests == ["/loop"] * (MAX_REDIRECTS + 1)
@@ -1,17 +1,39 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, status, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel, EmailStr
 from typing import Optional
 import psycopg2
-from psycopg2.extras import RealDictCursor
 import os
 import hashlib
 import jwt
 import datetime
 import time
+import orjson
+from decimal import Decimal
 
-app = FastAPI(title="User Service", version="1.0.0")
+from .admission import AdmissionMiddleware, RouteClass, admission_limiter, NORMAL
+from .compression import CompressionMiddleware, CompressionStats
+from .querylog import QueryLogMiddleware, query_logger
+from .pool import ConnectionPool, PooledConnection, Statement, execute_prepared
+
+def json_default(value):
+    # Same as jsonable_encoder: integral Decimals become int, the rest float
+    if isinstance(value, Decimal):
+        return int(value) if value.as_tuple().exponent >= 0 else float(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+def dumps_json(content) -> bytes:
+    return orjson.dumps(content, default=json_default, option=orjson.OPT_NON_STR_KEYS)
+
+class FastJSONResponse(JSONResponse):
+    # orjson encodes rows (datetimes included) straight to bytes; hot routes
+    # return this directly so FastAPI skips the generic jsonable_encoder pass
+    def render(self, content) -> bytes:
+        return dumps_json(content)
+
+app = FastAPI(title="User Service", version="1.0.0", default_response_class=FastJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -21,11 +43,33 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+compression_stats = CompressionStats()
+app.add_middleware(CompressionMiddleware, stats=compression_stats)
+
 security = HTTPBearer()
 JWT_SECRET = os.environ.get("JWT_SECRET", "ecommerce-secret-key-2024")
+ADMIN_EMAILS = {e.strip().lower() for e in os.environ.get("ADMIN_EMAILS", "").split(",") if e.strip()}
+
+# Admission control: login/register are limited per IP against credential stuffing
+AUTH = RouteClass("auth", rate=1, burst=10, priority=NORMAL)
+ACCOUNT = RouteClass("account", rate=10, burst=30, priority=NORMAL)
+
+def classify_request(method, path, query):
+    if path == "/health" or path.startswith("/debug/"):
+        return None
+    if path in ("/login", "/register"):
+        return AUTH
+    return ACCOUNT
+
+admission = admission_limiter()
+app.add_middleware(AdmissionMiddleware, classify=classify_request, jwt_secret=JWT_SECRET, limiter=admission)
+
+# Times every statement by shape; slow ones are logged and sampled for EXPLAIN
+query_log = query_logger()
+app.add_middleware(QueryLogMiddleware)
 
 # Database connection with retry
-def get_db_connection():
+def open_db_connection():
     max_retries = 5
     for i in range(max_retries):
         try:
@@ -35,7 +79,8 @@ def get_db_connection():
                 database=os.environ.get("DB_NAME", "userdb"),
                 user=os.environ.get("DB_USER", "postgres"),
                 password=os.environ.get("DB_PASSWORD", "postgres123"),
-                cursor_factory=RealDictCursor
+                connection_factory=PooledConnection,
+                cursor_factory=query_log.cursor_factory
             )
             return conn
         except psycopg2.OperationalError:
@@ -44,10 +89,23 @@ def get_db_connection():
             else:
                 raise
 
+# Requests reuse idle connections and the statements prepared on them;
+# anything that keeps session state (LISTEN, advisory locks) opens its own
+db_pool = ConnectionPool(
+    open_db_connection,
+    size=int(os.environ.get("DB_POOL_SIZE", "10")),
+    max_age=float(os.environ.get("DB_POOL_MAX_AGE_SECONDS", "1800")),
+)
+
+def get_db_connection():
+    return db_pool.get()
+
 def init_db():
     try:
-        conn = get_db_connection()
+        conn = open_db_connection()
         cur = conn.cursor()
+        # Workers and replicas starting together would otherwise race on the DDL
+        cur.execute("SELECT pg_advisory_lock(hashtext('schema:user-service'))")
         cur.execute("""
             CREATE TABLE IF NOT EXISTS users (
                 id SERIAL PRIMARY KEY,
@@ -118,10 +176,37 @@ def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+def verify_admin(payload: dict = Depends(verify_token)):
+    # Operational reports such as /debug/queries are limited to ADMIN_EMAILS
+    if payload.get("email", "").lower() not in ADMIN_EMAILS:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return payload
+
 @app.get("/health")
 async def health():
     return {"status": "healthy", "service": "user-service"}
 
+@app.get("/debug/compression")
+async def compression_report(admin: dict = Depends(verify_admin)):
+    return compression_stats.snapshot()
+
+@app.get("/debug/admission")
+async def admission_report(admin: dict = Depends(verify_admin)):
+    return admission.snapshot()
+
+@app.get("/debug/queries")
+async def query_report(
+    limit: int = Query(default=20, ge=1, le=500),
+    sort: str = Query(default="total", pattern="^(total|mean|max|calls)$"),
+    admin: dict = Depends(verify_admin)
+):
+    return {**query_log.report(limit, sort), "pool": db_pool.snapshot()}
+
+@app.delete("/debug/queries")
+async def reset_query_report(admin: dict = Depends(verify_admin)):
+    query_log.reset()
+    return {"message": "Query stats reset"}
+
 @app.post("/register")
 async def register(user: UserRegister):
     conn = get_db_connection()
@@ -148,16 +233,22 @@ async def register(user: UserRegister):
     token = create_token(user_id, user.email)
     return {"message": "Registration successful", "token": token, "user_id": user_id}
 
+# Hot fixed reads, prepared once per connection
+LOGIN_USER = Statement(
+    "login_user", "SELECT id, email, full_name FROM users WHERE email = $1 AND password_hash = $2", ("text", "text")
+)
+USER_PROFILE = Statement(
+    "user_profile", "SELECT id, email, full_name, phone, address, city, state, pincode FROM users WHERE id = $1",
+    ("integer",)
+)
+
 @app.post("/login")
 async def login(user: UserLogin):
     conn = get_db_connection()
     cur = conn.cursor()
     
     password_hash = hash_password(user.password)
-    cur.execute(
-        "SELECT id, email, full_name FROM users WHERE email = %s AND password_hash = %s",
-        (user.email, password_hash)
-    )
+    execute_prepared(cur, LOGIN_USER, (user.email, password_hash))
     db_user = cur.fetchone()
     cur.close()
     conn.close()
@@ -176,17 +267,14 @@ async def login(user: UserLogin):
 async def get_profile(payload: dict = Depends(verify_token)):
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute(
-        "SELECT id, email, full_name, phone, address, city, state, pincode FROM users WHERE id = %s",
-        (payload["user_id"],)
-    )
+    execute_prepared(cur, USER_PROFILE, (payload["user_id"],))
     user = cur.fetchone()
     cur.close()
     conn.close()
     
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    return dict(user)
+    return FastJSONResponse(user)
 
 @app.put("/profile")
 async def update_profile(user_update: UserUpdate, payload: dict = Depends(verify_token)):
@@ -226,5 +314,6 @@ async def validate_token(payload: dict = Depends(verify_token)):
     return {"valid": True, "user_id": payload["user_id"], "email": payload["email"]}
 
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    import sys
+    from .serve import Launcher
+    sys.exit(Launcher().run())
@@ -0,0 +1,128 @@
+"""Connection reuse and server-side prepared statements.
+
+A ConnectionPool keeps up to `size` idle connections. close() on a
+connection taken from it hands the connection back (rolling back anything
+left open) instead of closing it. Past `size`, connections are opened on
+demand and really closed, so the pool never makes a request wait: admission
+control is what bounds concurrency. A connection idle for longer than
+`ping_after` is checked before it is handed out again, and one older than
+`max_age` is replaced.
+
+Only connections without session state belong in the pool. LISTEN, session
+advisory locks and the like need a connection of their own, closed when done.
+
+Hot statements are declared as Statements and run with execute_prepared().
+The first use on a connection PREPAREs the statement on the server, and
+later uses only EXECUTE it, which skips parsing and planning. Prepared names
+are tracked per connection, so a replacement connection (after a timeout,
+a database restart or a failover) prepares them again on first use.
+"""
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """Connection that remembers its prepared statements and returns to its pool on close()."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = None
+        self.prepared = set()
+        self.created = self.released = time.monotonic()
+
+    def close(self):
+        pool, self.pool = self.pool, None
+        if pool is None or not pool.release(self):
+            super().close()
+
+
+class ConnectionPool:
+    def __init__(self, connect, size=10, ping_after=30.0, max_age=1800.0):
+        self.connect = connect  # opens a new PooledConnection
+        self.size = size
+        self.ping_after = ping_after
+        self.max_age = max_age
+        self.opened = 0
+        self.reused = 0
+        self._idle = []  # most recently released last
+        self._lock = threading.Lock()
+
+    def get(self):
+        while True:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                break
+            if self._usable(conn):
+                self.reused += 1
+                conn.pool = self
+                return conn
+            conn.close()
+        conn = self.connect()
+        self.opened += 1
+        conn.pool = self
+        return conn
+
+    def release(self, conn):
+        """Take `conn` back; False when the caller should close it instead."""
+        if conn.closed:
+            return False
+        try:
+            # Sends nothing unless a transaction was left open
+            conn.rollback()
+            if conn.autocommit:
+                conn.autocommit = False
+        except psycopg2.Error:
+            return False
+        with self._lock:
+            if len(self._idle) >= self.size:
+                return False
+            conn.released = time.monotonic()
+            self._idle.append(conn)
+        return True
+
+    def _usable(self, conn):
+        now = time.monotonic()
+        if conn.closed or now - conn.created > self.max_age:
+            return False
+        if now - conn.released > self.ping_after:
+            try:
+                cur = conn.cursor(cursor_factory=psycopg2.extensions.cursor)
+                cur.execute("SELECT 1")
+                cur.close()
+                conn.rollback()
+            except psycopg2.Error:
+                return False
+        return True
+
+    def snapshot(self):
+        return {"idle": len(self._idle), "size": self.size, "opened": self.opened, "reused": self.reused}
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+class Statement:
+    """A named statement with `$n` parameters of the given types."""
+
+    def __init__(self, name, sql, types=()):
+        self.name = name
+        self.sql = sql
+        params = f" ({', '.join(types)})" if types else ""
+        self.prepare_sql = f"PREPARE {name}{params} AS {sql}"
+        self.execute_sql = f"EXECUTE {name}" + (f" ({', '.join(['%s'] * len(types))})" if types else "")
+
+
+def execute_prepared(cur, statement, params=()):
+    """Run `statement` on `cur`, preparing it first if its connection hasn't yet."""
+    conn = cur.connection
+    if statement.name not in conn.prepared:
+        cur.execute(statement.prepare_sql)
+        conn.prepared.add(statement.name)
+    cur.execute(statement.execute_sql, params)
@@ -0,0 +1,238 @@
+"""Query instrumentation: per-shape timings and EXPLAIN capture for slow ones.
+
+Connections made with `query_log.cursor_factory` time every execute(). The
+statement is normalized to its shape (literals and parameters become `?`,
+IN lists and VALUES rows collapse to one), so the combinations a dynamic
+query like a search or a generated SET list produces are counted apart,
+while calls that differ only in their values are counted together. Each
+shape keeps its call count, total, mean and max time, and the routes that
+ran it.
+
+A statement slower than `slow_ms` is logged. A sample of them (at most one
+per shape per `explain_interval`) is explained on the same connection, so it
+sees the same transaction: reads with EXPLAIN (ANALYZE, BUFFERS), writes with
+a plain EXPLAIN, since running them again would repeat the write. The
+EXPLAIN runs inside a savepoint that is rolled back, and its failure never
+reaches the caller.
+
+Stats are kept per worker process.
+"""
+import contextvars
+import os
+import random
+import re
+import threading
+import time
+from datetime import datetime
+
+import psycopg2.extensions
+import psycopg2.sql
+from psycopg2.extras import RealDictCursor
+
+from .compression import route_path
+
+# Only these can be explained (DDL and the like are just timed); reads among
+# them are explained with ANALYZE. A prepared statement's EXECUTE doesn't say
+# whether it writes, so it only gets a plain EXPLAIN
+EXPLAINABLE = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "VALUES", "TABLE", "EXECUTE")
+WRITES = re.compile(
+    r"\b(INSERT|UPDATE|DELETE|MERGE|FOR UPDATE|FOR NO KEY UPDATE|FOR SHARE|FOR KEY SHARE"
+    r"|NEXTVAL|SETVAL|PG_ADVISORY_\w+|PG_SLEEP|PG_NOTIFY)\b",
+    re.IGNORECASE
+)
+
+STRING = re.compile(r"'(?:[^']|'')*'")
+PARAMETER = re.compile(r"%\(\w+\)s|%s")
+NUMBER = re.compile(r"(?<![\w.$])-?\d+(?:\.\d+)?(?![\w.])")
+WHITESPACE = re.compile(r"\s+")
+LIST = re.compile(r"\?(?:\s*,\s*\?)+")
+ROWS = re.compile(r"\(\?\)(?:\s*,\s*\(\?\))+")
+
+# The request being served, set by QueryLogMiddleware; route labels are
+# resolved when a query runs, after routing has filled in the endpoint
+current_scope = contextvars.ContextVar("query_log_scope", default=None)
+
+
+def normalize(query):
+    shape = STRING.sub("?", query)
+    shape = PARAMETER.sub("?", shape)
+    shape = NUMBER.sub("?", shape)
+    shape = WHITESPACE.sub(" ", shape).strip()
+    shape = LIST.sub("?", shape)
+    return ROWS.sub("(?)", shape)
+
+
+def route_label():
+    scope = current_scope.get()
+    if scope is None:
+        return "(background)"
+    endpoint = scope.get("endpoint")
+    name = endpoint.__name__ if endpoint is not None else route_path(scope)
+    return f"{scope['method']} {name}"
+
+
+class QueryShape:
+    def __init__(self, query):
+        self.query = query
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.slow = 0
+        self.rows = 0
+        self.routes = {}
+        self.explained_at = None
+        self.explain = None
+
+    def snapshot(self):
+        return {
+            "query": self.query,
+            "calls": self.calls,
+            "total_ms": round(self.total * 1000, 3),
+            "mean_ms": round(self.total * 1000 / self.calls, 3),
+            "max_ms": round(self.max * 1000, 3),
+            "slow": self.slow,
+            "rows": self.rows,
+            "routes": dict(sorted(self.routes.items(), key=lambda item: -item[1])),
+            "explain": self.explain,
+        }
+
+
+class QueryLog:
+    # A shape keeps at most this many distinct routes
+    max_routes = 10
+
+    def __init__(self, slow_ms=100.0, explain_sample=0.1, explain_interval=300.0, max_shapes=500):
+        self.slow = slow_ms / 1000
+        self.explain_sample = explain_sample
+        self.explain_interval = explain_interval
+        self.max_shapes = max_shapes
+        self.shapes = {}
+        self.statements = 0
+        self.evicted = 0
+        self._lock = threading.Lock()
+        log = self
+
+        class Cursor(RealDictCursor):
+            def execute(self, query, vars=None):
+                start = time.perf_counter()
+                result = super().execute(query, vars)
+                log.record(self, query, vars, time.perf_counter() - start)
+                return result
+
+        self.cursor_factory = Cursor
+
+    def record(self, cursor, query, vars, elapsed):
+        if isinstance(query, psycopg2.sql.Composable):
+            query = query.as_string(cursor)
+        elif isinstance(query, bytes):
+            query = query.decode()
+        text = normalize(query)
+        route = route_label()
+        with self._lock:
+            self.statements += 1
+            shape = self.shapes.get(text)
+            if shape is None:
+                if len(self.shapes) >= self.max_shapes:
+                    # Make room by forgetting the cheapest shape so far
+                    del self.shapes[min(self.shapes, key=lambda key: self.shapes[key].total)]
+                    self.evicted += 1
+                shape = self.shapes[text] = QueryShape(text)
+            shape.calls += 1
+            shape.total += elapsed
+            shape.max = max(shape.max, elapsed)
+            shape.rows += max(cursor.rowcount, 0)
+            if route in shape.routes or len(shape.routes) < self.max_routes:
+                shape.routes[route] = shape.routes.get(route, 0) + 1
+            if elapsed < self.slow:
+                return
+            shape.slow += 1
+            now = time.monotonic()
+            capture = (
+                text.split(" ", 1)[0].upper() in EXPLAINABLE
+                and random.random() < self.explain_sample
+                and (shape.explained_at is None or now - shape.explained_at >= self.explain_interval)
+            )
+            if capture:
+                shape.explained_at = now
+        print(f"Slow query ({elapsed * 1000:.0f} ms, {route}): {text[:500]}")
+        if capture:
+            plan = self.explain(cursor.connection, query, vars, text)
+            plan["ms"] = round(elapsed * 1000, 3)
+            plan["route"] = route
+            with self._lock:
+                shape.explain = plan
+
+    def explain(self, conn, query, vars, text):
+        keyword = text.split(" ", 1)[0].upper()
+        analyze = keyword in ("SELECT", "WITH", "VALUES", "TABLE") and not WRITES.search(text)
+        options = "ANALYZE, BUFFERS" if analyze else "COSTS"
+        savepoint = not conn.autocommit
+        plan = error = None
+        cur = conn.cursor(cursor_factory=psycopg2.extensions.cursor)
+        try:
+            if savepoint:
+                cur.execute("SAVEPOINT query_log_explain")
+            try:
+                cur.execute(f"EXPLAIN ({options}) {query}", vars)
+                plan = "\n".join(row[0] for row in cur.fetchall())
+            except psycopg2.Error as e:
+                error = str(e).strip()
+            if savepoint:
+                cur.execute("ROLLBACK TO SAVEPOINT query_log_explain")
+                cur.execute("RELEASE SAVEPOINT query_log_explain")
+        except psycopg2.Error as e:
+            error = error or str(e).strip()
+        finally:
+            cur.close()
+        return {"at": datetime.now().isoformat(timespec="seconds"), "analyze": analyze, "plan": plan, "error": error}
+
+    def report(self, limit=20, sort="total"):
+        key = {
+            "total": lambda shape: shape.total,
+            "mean": lambda shape: shape.total / shape.calls,
+            "max": lambda shape: shape.max,
+            "calls": lambda shape: shape.calls,
+        }[sort]
+        with self._lock:
+            top = sorted(self.shapes.values(), key=key, reverse=True)[:limit]
+            queries = [shape.snapshot() for shape in top]
+            return {
+                "pid": os.getpid(),
+                "slow_ms": self.slow * 1000,
+                "statements": self.statements,
+                "shapes": len(self.shapes),
+                "evicted": self.evicted,
+                "queries": queries,
+            }
+
+    def reset(self):
+        with self._lock:
+            self.shapes.clear()
+            self.statements = 0
+            self.evicted = 0
+
+
+class QueryLogMiddleware:
+    """Makes the current request known to the queries it runs."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        token = current_scope.set(scope)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_scope.reset(token)
+
+
+def query_logger():
+    return QueryLog(
+        slow_ms=float(os.environ.get("QUERY_SLOW_MS", "100")),
+        explain_sample=float(os.environ.get("QUERY_EXPLAIN_SAMPLE", "0.1")),
+        explain_interval=float(os.environ.get("QUERY_EXPLAIN_INTERVAL", "300")),
+        max_shapes=int(os.environ.get("QUERY_LOG_MAX_SHAPES", "500")),
+    )